@@ -0,0 +1,335 @@
+# Copyright (c) 2019 American Express Travel Related Services Company, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except
+# in compliance with the License. You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License
+# is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+# or implied. See the License for the specific language governing permissions and limitations under
+# the License.
+
+""" Measures the throughput of the data and training paths
+of easyDist on synthetic data and a local cluster:
+    * Dataset.read_data and give_next, and read_data preprocessing
+      the chunks with a pool of processes
+    * batches of examples of similar length (bucket_width) and
+      the fraction of the fed sequence positions which hold tokens
+    * the preprocessing of examples/rnn/preprocessing.py, and the
+      helpers of preprocess_utils.py against the row by row parsing
+      the example used before
+    * training steps with 1, 2, 4 and 8 local workers
+The results are written as a JSON report. If a baseline report
+exists, every metric is compared against it and the script exits
+with status 1 when one regressed by more than the tolerance.
+Run it from the benchmarks directory:
+    python run_benchmarks.py --out report.json"""
+from __future__ import print_function
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import numpy as np
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(BENCH_DIR, '..', 'src'))
+sys.path.append(os.path.join(BENCH_DIR, '..', 'examples', 'rnn'))
+from data_reader import Dataset
+from s3_download import MB
+from createRnnData import generate
+
+#Metrics ending with these suffixes are better when lower, all others when higher
+LOWER_IS_BETTER = ('_seconds', 'failed_workers')
+
+
+def write_chunks(data_dir, examples, chunks, min_length, max_length):
+    """ Writes csv chunks in the format of the rnn example with
+    the generator of the example and returns their keys"""
+    paths = generate(examples=examples, chunks=chunks, min_length=min_length,
+                     max_length=max_length, out_dir=data_dir)
+    return [os.path.basename(path) for path in paths]
+
+
+def give_bytes(data_dir, keys):
+    """ Returns the total size of the chunks"""
+    return sum(os.path.getsize(os.path.join(data_dir, key)) for key in keys)
+
+
+def bench_read_data(data_dir, keys, batch_size):
+    """ Times Dataset.read_data on a file:// bucket and a full
+    pass of give_next over the data that was read"""
+    data = Dataset()
+    seconds = data.read_data('file://'+data_dir, keys)
+    num_batches = int(data.give_num_batches(batch_size))
+    start = time.time()
+    for i in range(num_batches):
+        data.give_next(batch_size, i)
+    give_next_seconds = max(time.time()-start, 1e-9)
+    return {'read_data_seconds': seconds,
+            'read_data_examples_per_sec': data.train_size/seconds,
+            'read_data_mb_per_sec': give_bytes(data_dir, keys)/MB/seconds,
+            'give_next_batches_per_sec': num_batches/give_next_seconds,
+            'give_next_examples_per_sec': num_batches*batch_size/give_next_seconds}
+
+
+def bench_bucketing(data_dir, keys, batch_size, bucket_width):
+    """ Times a pass over the bucketed batches, with the padding
+    no example of a batch needs dropped, and returns the padding
+    efficiency with and without buckets"""
+    data = Dataset(bucket_width=bucket_width, seed=0)
+    data.read_data('file://'+data_dir, keys)
+    data.trim = True
+    efficiency = data.give_padding_efficiency(batch_size)
+    start = time.time()
+    num_batches = sum(1 for _ in data.batches(batch_size))
+    seconds = max(time.time()-start, 1e-9)
+    return {'padding_efficiency': efficiency['padded'],
+            'bucketed_padding_efficiency': efficiency['bucketed'],
+            'bucketed_batches_per_sec': num_batches/seconds,
+            'bucketed_examples_per_sec': data.train_size/seconds}
+
+
+def bench_parallel_read_data(data_dir, keys, processes):
+    """ Times Dataset.read_data preprocessing the chunks one
+    at a time and in a pool of processes"""
+    results = {}
+    for count in sorted(set([1, processes])):
+        data = Dataset(processes=count)
+        seconds = data.read_data('file://'+data_dir, keys)
+        results['read_data_%d_processes_seconds' % count] = seconds
+    results['speedup'] = results['read_data_1_processes_seconds'] /\
+        results['read_data_%d_processes_seconds' % processes]
+    return results
+
+
+def bench_preprocessing(data_dir, keys):
+    """ Times the preprocess method of the rnn example on chunks
+    that are already in memory, which excludes the reads"""
+    from preprocessing import Preprocessing
+    bodies = []
+    for key in keys:
+        with open(os.path.join(data_dir, key), 'rb') as chunk:
+            bodies.append(chunk.read())
+    pre = Preprocessing()
+    start = time.time()
+    _, _, train_size = pre.preprocess(keys, [io.BytesIO(body) for body in bodies])
+    seconds = time.time()-start
+    return {'preprocess_seconds': seconds,
+            'preprocess_examples_per_sec': train_size/seconds,
+            'preprocess_mb_per_sec': sum(len(body) for body in bodies)/MB/seconds}
+
+
+def legacy_preprocess(bodies):
+    """ The preprocessing of the rnn example before it used
+    preprocess_utils: a concat per chunk and a float list per row"""
+    import pandas as pd
+    df = None
+    for body in bodies:
+        temp = pd.read_csv(io.BytesIO(body), encoding='utf8')
+        df = temp if df is None else pd.concat([df, temp])
+    x1 = [list(map(float, y.split(' '))) for y in df['x1'].values]
+    labels = np.array([int(x) for x in df['y'].values]).reshape(len(x1), 1)
+    return [np.array(x1, dtype=object)], [labels], len(x1)
+
+
+def bench_preprocess_kernels(data_dir, keys, maxlen):
+    """ Times the parsing of the same chunks by the legacy row by
+    row code and by the vectorized helpers of preprocess_utils"""
+    from preprocess_utils import read_csv_objects, parse_sequences, parse_labels
+    bodies = []
+    for key in keys:
+        with open(os.path.join(data_dir, key), 'rb') as chunk:
+            bodies.append(chunk.read())
+    start = time.time()
+    _, _, rows = legacy_preprocess(bodies)
+    legacy_seconds = time.time()-start
+    start = time.time()
+    df = read_csv_objects([io.BytesIO(body) for body in bodies])
+    parse_sequences(df['x1'].values, maxlen)
+    parse_labels(df['y'].values)
+    seconds = time.time()-start
+    return {'legacy_seconds': legacy_seconds,
+            'legacy_examples_per_sec': rows/legacy_seconds,
+            'vectorized_seconds': seconds,
+            'vectorized_examples_per_sec': rows/seconds,
+            'speedup': legacy_seconds/seconds}
+
+
+def bench_training(data_dir, workers, batch_size, length):
+    """ Trains a small rnn for one epoch on local clusters of
+    every size in workers and returns the aggregate samples per
+    second reported by the step metrics of the workers. The
+    sequences all have the given length to match the model"""
+    import keras.backend as K
+    from keras.models import Model
+    from keras.layers import Dense, Embedding, LSTM, Input
+    from dist_exec import ExecutionEnvironment
+    results = {}
+    base_dir = os.getcwd()
+    for num_workers in workers:
+        work_dir = tempfile.mkdtemp()
+        try:
+            #The local cluster and the graphs are created in the working directory,
+            #the workers import the preprocessing file from it
+            shutil.copy(os.path.join(BENCH_DIR, '..', 'examples', 'rnn', 'preprocessing.py'),
+                        work_dir)
+            os.chdir(work_dir)
+            #save_graph exports the whole session graph, which must only hold this model
+            K.clear_session()
+            inputs = Input(shape=(length,))
+            hidden = LSTM(32)(Embedding(4001, 32)(inputs))
+            model = Model(inputs=[inputs], outputs=Dense(1, activation='sigmoid')(hidden))
+            model.compile(loss='binary_crossentropy', optimizer='adam')
+            env = ExecutionEnvironment(bucket_name='file://'+data_dir, prefix='chunk',
+                                       epochs=1, batch_size=batch_size, opt='adam',
+                                       backend='local', num_workers=num_workers,
+                                       cache_size=0, metrics_every=1)
+            start = time.time()
+            exit_codes = env.fit()
+            seconds = time.time()-start
+            speeds = []
+            for worker in range(num_workers):
+                samples = []
+                path = os.path.join(env.local_cluster.give_task_dir('worker_%d' % worker),
+                                    'metrics.jsonl')
+                if os.path.isfile(path):
+                    with open(path) as metrics:
+                        samples = [json.loads(line)['samples_per_sec'] for line in metrics]
+                #The first steps include the graph warm up
+                if len(samples) > 2:
+                    samples = samples[2:]
+                if samples:
+                    speeds.append(float(np.median(samples)))
+            results['train_%d_workers' % num_workers] = {
+                'fit_seconds': seconds,
+                'failed_workers': sum(1 for code in exit_codes.values() if code != 0),
+                'samples_per_sec': sum(speeds)}
+        finally:
+            os.chdir(base_dir)
+            shutil.rmtree(work_dir)
+    if 'train_1_workers' in results and results['train_1_workers']['samples_per_sec'] > 0:
+        single = results['train_1_workers']['samples_per_sec']
+        for num_workers in workers:
+            result = results['train_%d_workers' % num_workers]
+            result['scaling_efficiency'] = result['samples_per_sec']/(single*num_workers)
+    return results
+
+
+def compare(report, baseline, tolerance):
+    """ Returns the metrics of the report which are worse than
+    the baseline by more than tolerance (a fraction)"""
+    regressions = []
+    for name, metrics in baseline['results'].items():
+        for metric, old in metrics.items():
+            new = report['results'].get(name, {}).get(metric)
+            if new is None:
+                continue
+            lower_is_better = metric.endswith(LOWER_IS_BETTER)
+            if not old:
+                #Nothing to scale by, only a count going up from zero is worse
+                if lower_is_better and new > 0:
+                    regressions.append({'benchmark': name, 'metric': metric,
+                                        'baseline': old, 'value': new, 'change': None})
+                continue
+            change = (new-old)/float(old)
+            if lower_is_better:
+                change = -change
+            if change < -tolerance:
+                regressions.append({'benchmark': name, 'metric': metric,
+                                    'baseline': old, 'value': new, 'change': change})
+    return regressions
+
+
+def main():
+    """ Runs the selected benchmarks and writes the report"""
+    flags = PARSER.parse_args()
+    report = {'time': time.time(),
+              'environment': {'python': platform.python_version(),
+                              'numpy': np.__version__,
+                              'platform': platform.platform(),
+                              'cpus': multiprocessing.cpu_count()},
+              'config': vars(flags),
+              'results': {}}
+    data_root = tempfile.mkdtemp()
+    try:
+        data_dir = os.path.join(data_root, 'data')
+        keys = write_chunks(data_dir, flags.examples, flags.chunks,
+                            flags.min_length, flags.max_length)
+        report['results']['read_data'] = bench_read_data(data_dir, keys, flags.batch_size)
+        report['results']['bucketing'] = bench_bucketing(data_dir, keys, flags.batch_size,
+                                                         flags.bucket_width)
+        report['results']['parallel_read_data'] = bench_parallel_read_data(data_dir, keys,
+                                                                           flags.processes)
+        report['results']['preprocessing'] = bench_preprocessing(data_dir, keys)
+        report['results']['preprocess_kernels'] = bench_preprocess_kernels(data_dir, keys,
+                                                                           flags.maxlen)
+        if flags.workers:
+            try:
+                import tensorflow
+                import keras
+            except ImportError as error:
+                print('Skipping the training benchmarks: ', error)
+                report['skipped'] = {'training': str(error)}
+            else:
+                #Fixed length sequences, as the model has a fixed input length
+                train_dir = os.path.join(data_root, 'train')
+                write_chunks(train_dir, flags.train_examples, max(flags.workers)*2,
+                             flags.train_length, flags.train_length)
+                report['results'].update(bench_training(
+                    train_dir, flags.workers, flags.batch_size, flags.train_length))
+    finally:
+        shutil.rmtree(data_root)
+
+    status = 0
+    if os.path.isfile(flags.baseline):
+        with open(flags.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        report['baseline'] = flags.baseline
+        report['regressions'] = compare(report, baseline, flags.tolerance)
+        for regression in report['regressions']:
+            print('Regression in %(benchmark)s %(metric)s: %(value).4g against %(baseline).4g'
+                  % regression)
+        status = 1 if report['regressions'] else 0
+    else:
+        print('No baseline at %s, nothing to compare against' % flags.baseline)
+    with open(flags.out, 'w') as out:
+        json.dump(report, out, indent=2, sort_keys=True)
+    print(json.dumps(report['results'], indent=2, sort_keys=True))
+    if flags.save_baseline:
+        shutil.copy(flags.out, flags.baseline)
+        print('Stored the report as the baseline ', flags.baseline)
+    return status
+
+
+PARSER = argparse.ArgumentParser(description=__doc__,
+                                 formatter_class=argparse.RawDescriptionHelpFormatter)
+PARSER.add_argument("--out", type=str, default='report.json')
+PARSER.add_argument("--baseline", type=str, default=os.path.join(BENCH_DIR, 'baseline.json'))
+PARSER.add_argument("--save_baseline", action='store_true')
+#Largest tolerated relative slowdown against the baseline
+PARSER.add_argument("--tolerance", type=float, default=0.2)
+PARSER.add_argument("--examples", type=int, default=8000)
+PARSER.add_argument("--chunks", type=int, default=8)
+PARSER.add_argument("--min_length", type=int, default=150)
+PARSER.add_argument("--max_length", type=int, default=450)
+PARSER.add_argument("--batch_size", type=int, default=32)
+#Tokens per length bucket of the bucketing benchmark
+PARSER.add_argument("--bucket_width", type=int, default=50)
+#Processes of the parallel read_data benchmark
+PARSER.add_argument("--processes", type=int, default=multiprocessing.cpu_count())
+#Padded sequence length of the preprocessing kernels
+PARSER.add_argument("--maxlen", type=int, default=400)
+#Local cluster sizes of the training benchmark, none skips it
+PARSER.add_argument("--workers", type=lambda value: [int(v) for v in value.split(',') if v],
+                    default=[1, 2, 4, 8])
+PARSER.add_argument("--train_examples", type=int, default=4096)
+PARSER.add_argument("--train_length", type=int, default=100)
+
+if __name__ == '__main__':
+    sys.exit(main())
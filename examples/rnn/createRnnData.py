@@ -10,31 +10,144 @@
 # or implied. See the License for the specific language governing permissions and limitations under
 # the License.
 
-import numpy as numpy
-import pandas as pd
-import random
-
-max_features = 4000
-num_examples = 32000
-min_length = 150
-max_length = 450
-chunks = 16
-
-df = pd.DataFrame(columns = ['x1','y'])
-
-for i in range(num_examples):
-	exampleLength = random.sample(range(min_length,max_length),1)[0]
-	example = [str(num) for num in random.sample(range(1,max_features+1),exampleLength)]
-	example =' '.join(example)
-	label = str(random.sample(range(0,2),1)[0])
-	df.loc[len(df)]=[example,label]
-
-chunkSize = int(num_examples/chunks)
-for i in range(chunks):
-	start = i*chunkSize
-	end = (i+1)*chunkSize
-	print('Chunk',i)
-	print(start,end)
-	df[start:end].to_csv('chunk'+str(i+1)+'.csv',index=False)
+""" Creates synthetic training data for the rnn example: csv
+chunks with a space separated sequence of token ids (x1) and a
+binary label (y) per line. The rows are built with vectorized
+numpy and the chunks are written by a pool of processes, either
+to a local directory or straight into an S3 bucket (or a local
+stand-in for S3 given by --endpoint_url). For example
+    python createRnnData.py --examples 10000000 --chunks 64 --out_dir ./rnnData"""
+from __future__ import print_function
+import argparse
+import multiprocessing
+import os
+import tempfile
+import time
+import numpy as np
 
+#Rows formatted at once, bounds the memory of a process
+BLOCK_ROWS = 50000
 
+
+def give_lengths(random, rows, config):
+    """ Draws the sequence length of every row from the
+    configured distribution, clipped to [min_length, max_length]"""
+    low, high = config['min_length'], config['max_length']
+    if config['length_distribution'] == 'normal':
+        lengths = random.normal((low+high)/2.0, (high-low)/6.0, size=rows)
+    elif config['length_distribution'] == 'lognormal':
+        #Most sequences are short with a long tail up to max_length
+        lengths = low+random.lognormal(0, 1, size=rows)*(high-low)/8.0
+    else:
+        lengths = random.randint(low, high+1, size=rows)
+    return np.clip(np.round(lengths), low, high).astype(np.int64)
+
+
+def format_rows(tokens, lengths, labels):
+    """ Formats the rows as csv lines without any python level
+    loop: every token becomes a fixed width byte row of its
+    digits followed by a separator, the unused digit positions
+    are masked out and the rest is flattened in order"""
+    width = len(str(max(int(tokens.max()), 1)))
+    #Digits, then ' ' or ',', then the label and the new line of the last token of a row
+    chars = np.zeros((len(tokens), width+3), dtype=np.uint8)
+    mask = np.zeros(chars.shape, dtype=bool)
+    digits = np.floor(np.log10(np.maximum(tokens, 1))).astype(np.int64)+1
+    for position in range(width):
+        power = width-1-position
+        chars[:, position] = 48+(tokens//10**power) % 10
+        mask[:, position] = digits > power
+    ends = np.cumsum(lengths)-1
+    chars[:, width] = ord(' ')
+    chars[ends, width] = ord(',')
+    mask[:, width] = True
+    chars[ends, width+1] = 48+labels
+    chars[ends, width+2] = ord('\n')
+    mask[ends, width+1:] = True
+    return chars[mask].tobytes()
+
+
+def write_chunk(args):
+    """ Writes one chunk of rows to a file object, a block of
+    rows at a time, and returns the path or key and its size"""
+    chunk, rows, config = args
+    random = np.random.RandomState(config['seed']+chunk)
+    name = '%s%d.csv' % (config['prefix'], chunk+1)
+    if config['bucket']:
+        handle, path = tempfile.mkstemp(suffix='.csv')
+        out = os.fdopen(handle, 'wb')
+    else:
+        path = os.path.join(config['out_dir'], name)
+        out = open(path, 'wb')
+    with out:
+        out.write(b'x1,y\n')
+        for start in range(0, rows, BLOCK_ROWS):
+            block = min(BLOCK_ROWS, rows-start)
+            lengths = give_lengths(random, block, config)
+            tokens = random.randint(1, config['max_features']+1, size=int(lengths.sum()))
+            labels = (random.random_sample(block) < config['positive_fraction']).astype(np.uint8)
+            out.write(format_rows(tokens, lengths, labels))
+    size = os.path.getsize(path)
+    if config['bucket']:
+        import boto3
+        client = boto3.client('s3', endpoint_url=config['endpoint_url'])
+        #Multipart uploads for large chunks
+        client.upload_file(path, config['bucket'], config['key_prefix']+name)
+        os.remove(path)
+        return config['key_prefix']+name, size
+    return path, size
+
+
+def generate(examples=32000, chunks=16, max_features=4000, min_length=150, max_length=450,
+             length_distribution='uniform', positive_fraction=0.5, out_dir='.', prefix='chunk',
+             bucket=None, key_prefix='', endpoint_url=None, processes=None, seed=0):
+    """ Writes the chunks and returns their names (paths, or keys
+    of the bucket) in order"""
+    config = dict(max_features=max_features, min_length=min_length, max_length=max_length,
+                  length_distribution=length_distribution, positive_fraction=positive_fraction,
+                  out_dir=out_dir, prefix=prefix, bucket=bucket, key_prefix=key_prefix,
+                  endpoint_url=endpoint_url, seed=seed)
+    if not bucket and not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    rows = [len(part) for part in np.array_split(np.arange(examples), chunks)]
+    tasks = [(chunk, rows[chunk], config) for chunk in range(chunks)]
+    start = time.time()
+    processes = processes or multiprocessing.cpu_count()
+    if processes > 1 and chunks > 1:
+        pool = multiprocessing.Pool(min(processes, chunks))
+        try:
+            written = pool.map(write_chunk, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        written = [write_chunk(task) for task in tasks]
+    seconds = time.time()-start
+    total = sum(size for _, size in written)
+    print('Wrote %d rows in %d chunks (%.1f MB) in %.1fs at %.1f MB/s' % (
+        examples, chunks, total/1024.0/1024.0, seconds, total/1024.0/1024.0/max(seconds, 1e-9)))
+    return [name for name, _ in written]
+
+
+if __name__ == '__main__':
+    PARSER = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    PARSER.add_argument("--examples", type=int, default=32000)
+    PARSER.add_argument("--chunks", type=int, default=16)
+    PARSER.add_argument("--max_features", type=int, default=4000)
+    PARSER.add_argument("--min_length", type=int, default=150)
+    PARSER.add_argument("--max_length", type=int, default=450)
+    PARSER.add_argument("--length_distribution", type=str, default='uniform',
+                        choices=['uniform', 'normal', 'lognormal'])
+    #Fraction of rows labelled 1
+    PARSER.add_argument("--positive_fraction", type=float, default=0.5)
+    PARSER.add_argument("--out_dir", type=str, default='.')
+    PARSER.add_argument("--prefix", type=str, default='chunk')
+    #Upload the chunks to this bucket under key_prefix instead of writing them to out_dir
+    PARSER.add_argument("--bucket", type=str, default=None)
+    PARSER.add_argument("--key_prefix", type=str, default='')
+    PARSER.add_argument("--endpoint_url", type=str, default=None)
+    PARSER.add_argument("--processes", type=int, default=None)
+    PARSER.add_argument("--seed", type=int, default=0)
+    FLAGS = PARSER.parse_args()
+    generate(**vars(FLAGS))
@@ -20,6 +20,10 @@ import time
 import boto3
 import io
 import os
+from preprocess_utils import read_csv_objects, parse_sequences, parse_labels
+
+#Sequences are padded or truncated to the input length of the model in modelDef.py
+maxlen = 400
 
 class Preprocessing:
     def __init__(self):
@@ -34,27 +38,29 @@ class Preprocessing:
         Embed your pre-processing code here
         After processing, it returns inputs, outputs and train_size
         '''
-        #Reading the Data and concatenating the chunks
-        loop = 0
-        df = None
-        for i in len(objects):
-            print('Reading Key: ', keys[i])
-            temp = pd.read_csv(io.BytesIO(objects[i].read()), encoding='utf8')
-            if loop == 0:
-                df = temp
-                loop += 1
-            else:
-                df = pd.concat([df,temp])
-        x1 = df['x1'].values
-        x1 = [list(map(float,y.split(' ')))for y in x1]
-
-        labels = [int(x) for x in df['y'].values]
-        labels = np.array(labels)
+        #Reading the Data and concatenating the chunks once
+        print('Reading Keys: ', keys)
+        df = read_csv_objects(objects, encoding='utf8')
+        inputs,outputs,train_size = self.to_arrays(df)
+
+        print('Training Size is ', train_size)
+        return (inputs,outputs,train_size)
+
+    def preprocess_chunk(self,key,header,records):
+        #Optional, used when training with --stream or --preprocess_processes > 1. Pre Process
+        #a buffer of records (csv lines without the header) of a single key, or all of its
+        #records when preprocessing in parallel, and return (inputs,outputs,size)
+        df = pd.read_csv(io.StringIO('\n'.join([header]+records)), encoding='utf8')
+        return self.to_arrays(df)
+
+    def to_arrays(self,df):
+        #Token ids are parsed straight into a padded int32 array of shape (rows, maxlen)
+        x1 = parse_sequences(df['x1'].values, maxlen)
+
+        labels = parse_labels(df['y'].values)
         labels = labels.reshape(len(labels),1)
 
-        inputs=[np.array(x1)]
+        inputs=[x1]
         outputs=[labels]
         train_size = len(x1)
-
-        print('Training Size is ', train_size)
         return (inputs,outputs,train_size)
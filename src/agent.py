@@ -0,0 +1,354 @@
+# Copyright (c) 2019 American Express Travel Related Services Company, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except
+# in compliance with the License. You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License
+# is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+# or implied. See the License for the specific language governing permissions and limitations under
+# the License.
+
+""" This module provides the agent which stays resident on
+every machine of the cluster and runs the training jobs, and
+the pool used by the master to drive the agents of all machines
+at once. The agents only listen on 127.0.0.1 and are reached
+through ssh tunnels. Checkpoints are pulled from the workers
+while they train, as soon as each one is complete"""
+from __future__ import print_function
+import argparse
+import hashlib
+import itertools
+import os
+import shutil
+import signal
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+try:
+    from xmlrpc.client import Binary
+except ImportError:
+    from xmlrpclib import Binary
+from coordinator import serve, connect
+
+AGENT_PORT = 2224
+#Largest piece of output or file returned by a single call
+READ_SIZE = 1024*1024
+
+
+class WorkerAgent:
+    """ Starts the submitted jobs right away and keeps their
+    output so that it can be streamed back with poll"""
+    exported = ['ping', 'submit', 'poll', 'kill', 'read_file', 'list_files', 'give_hash']
+
+    def __init__(self, work_dir='.'):
+        self.work_dir = os.path.abspath(work_dir)
+        self.jobs = {}
+        self.job_ids = itertools.count()
+
+    def ping(self):
+        """ Tells the master that the agent is up"""
+        return True
+
+    def give_path(self, name):
+        """ Returns the path of a file within the work directory"""
+        path = os.path.abspath(os.path.join(self.work_dir, name))
+        if os.path.commonprefix([path, self.work_dir+os.sep]) != self.work_dir+os.sep:
+            raise ValueError('%s is outside of the work directory' % name)
+        return path
+
+    def submit(self, spec):
+        """ Starts a job and returns its id. The spec holds the
+        shell script to run, optional artifacts (name to content)
+        written to the work directory first and an optional env"""
+        for name, content in spec.get('artifacts', {}).items():
+            path = self.give_path(name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'wb') as artifact:
+                artifact.write(content.data if isinstance(content, Binary) else content.encode())
+        job_id = '%d-%d' % (os.getpid(), next(self.job_ids))
+        job_dir = self.give_path(os.path.join('jobs', job_id))
+        os.makedirs(job_dir)
+        script = os.path.join(job_dir, 'run.sh')
+        with open(script, 'w') as script_file:
+            script_file.write(spec['script'])
+        env = dict(os.environ)
+        env.update(spec.get('env', {}))
+        stdout = open(os.path.join(job_dir, 'stdout'), 'wb')
+        stderr = open(os.path.join(job_dir, 'stderr'), 'wb')
+        #In a session of its own, so that kill also stops the processes the script started
+        process = subprocess.Popen(['bash', script], cwd=self.work_dir, env=env,
+                                   stdout=stdout, stderr=stderr, preexec_fn=os.setsid)
+        stdout.close()
+        stderr.close()
+        self.jobs[job_id] = {'process': process, 'dir': job_dir}
+        return job_id
+
+    def poll(self, job_id, stdout_offset=0, stderr_offset=0):
+        """ Returns the output of a job from the given offsets
+        and its exit status, None while it is running"""
+        job = self.jobs[job_id]
+        #Check the status first so that no output is missed
+        returncode = job['process'].poll()
+        status = {'returncode': returncode}
+        for stream, offset in [('stdout', stdout_offset), ('stderr', stderr_offset)]:
+            with open(os.path.join(job['dir'], stream), 'rb') as output:
+                output.seek(offset)
+                data = output.read(READ_SIZE)
+            status[stream] = Binary(data)
+            status[stream+'_offset'] = offset+len(data)
+        #Report the exit only once all of the output was read
+        if returncode is not None and (len(status['stdout'].data) == READ_SIZE or
+                                       len(status['stderr'].data) == READ_SIZE):
+            status['returncode'] = None
+        return status
+
+    def kill(self, job_id):
+        """ Stops a running job and all of its processes"""
+        process = self.jobs[job_id]['process']
+        if process.poll() is None:
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except OSError:
+                process.kill()
+            process.wait()
+        return True
+
+    def read_file(self, name, offset=0, size=READ_SIZE):
+        """ Returns a piece of a file of the work directory and
+        its total size, or None if it does not exist"""
+        path = self.give_path(name)
+        if not os.path.isfile(path):
+            return None
+        with open(path, 'rb') as read:
+            read.seek(offset)
+            return {'data': Binary(read.read(min(size, READ_SIZE))),
+                    'size': os.path.getsize(path)}
+
+    def list_files(self, name):
+        """ Returns the size of every file below a directory of
+        the work directory by relative path"""
+        path = self.give_path(name)
+        files = {}
+        for directory, _, file_names in os.walk(path):
+            for file_name in file_names:
+                file_path = os.path.join(directory, file_name)
+                try:
+                    files[os.path.relpath(file_path, path)] = os.path.getsize(file_path)
+                except OSError:
+                    #Removed while listing
+                    continue
+        return files
+
+    def give_hash(self, name):
+        """ Returns the sha256 of a file of the work directory,
+        or None if it does not exist"""
+        path = self.give_path(name)
+        if not os.path.isfile(path):
+            return None
+        return give_hash(path)
+
+
+class AgentPool:
+    """ Drives the agents of many machines concurrently. The
+    output of every job is appended to log_dir as it arrives,
+    in the layout of pssh (outs_train/<host>, errs_train/<host>)"""
+    def __init__(self, addresses, log_dir, poll_secs=2):
+        self.addresses = addresses
+        self.log_dir = log_dir
+        self.poll_secs = poll_secs
+        self.job_ids = {}
+        for stream in ['outs_train', 'errs_train']:
+            if not os.path.isdir(os.path.join(log_dir, stream)):
+                os.makedirs(os.path.join(log_dir, stream))
+
+    def _map(self, function, hosts):
+        """ Calls function for every host concurrently"""
+        with ThreadPoolExecutor(max_workers=max(1, len(hosts))) as pool:
+            futures = dict((host, pool.submit(function, host)) for host in hosts)
+            return dict((host, future.result()) for host, future in futures.items())
+
+    def submit(self, specs):
+        """ Submits a spec per host and returns the job ids"""
+        self.job_ids.update(self._map(
+            lambda host: connect(self.addresses[host]).submit(specs[host]), list(specs)))
+        return dict((host, self.job_ids[host]) for host in specs)
+
+    def wait(self, results=None, checkpoint_dirs=None, hosts=None):
+        """ Follows the jobs of hosts (all by default) until they
+        finish. The checkpoints of a host are copied to its
+        checkpoint_dirs entry while it trains, the result files
+        (remote name to local path) of a host are copied once it
+        is done. The jobs of the other hosts, parameter servers
+        which serve until they are stopped, are killed then.
+        Returns the exit status of every followed host"""
+        results = results or {}
+        checkpoint_dirs = checkpoint_dirs or {}
+        hosts = list(self.job_ids) if hosts is None else list(hosts)
+        try:
+            return self._map(lambda host: self._follow(host, results.get(host, {}),
+                                                       checkpoint_dirs.get(host)), hosts)
+        finally:
+            self.kill([host for host in self.job_ids if host not in hosts])
+
+    def kill(self, hosts):
+        """ Stops the jobs of the given hosts"""
+        self._map(lambda host: connect(self.addresses[host]).kill(self.job_ids[host]), hosts)
+
+    def _follow(self, host, result_files, checkpoint_dir):
+        """ Streams the output of the job of a host to the log
+        files and collects its checkpoints until it exits, then
+        copies its result files"""
+        proxy = connect(self.addresses[host])
+        collector = None
+        if checkpoint_dir is not None:
+            collector = CheckpointCollector(self.addresses[host], checkpoint_dir)
+        offsets = [0, 0]
+        paths = [os.path.join(self.log_dir, stream, host)
+                 for stream in ['outs_train', 'errs_train']]
+        while True:
+            status = proxy.poll(self.job_ids[host], offsets[0], offsets[1])
+            for index, stream in enumerate(['stdout', 'stderr']):
+                if status[stream].data:
+                    with open(paths[index], 'ab') as log:
+                        log.write(status[stream].data)
+                offsets[index] = status[stream+'_offset']
+            if collector is not None:
+                collector.sweep()
+            if status['returncode'] is not None:
+                break
+            time.sleep(self.poll_secs)
+        print('Host %s finished with exit status %d' % (host, status['returncode']))
+        for name, path in result_files.items():
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            fetch_file(proxy, name, path)
+        return status['returncode']
+
+
+class CheckpointCollector:
+    """ Copies the completed checkpoints of a worker (the
+    step_N directories of remote_dir, the .tmp directories
+    are still being written) into local_dir. Files are copied
+    into a .part directory, resumed if a copy was interrupted
+    and verified against the sha256 on the worker"""
+    def __init__(self, address, local_dir, remote_dir='models'):
+        self.address = address
+        self.local_dir = local_dir
+        self.remote_dir = remote_dir
+        if not os.path.isdir(local_dir):
+            os.makedirs(local_dir)
+        self.collected = set(name for name in os.listdir(local_dir)
+                             if not name.endswith('.part'))
+
+    def sweep(self):
+        """ Copies the checkpoints that completed since the last
+        sweep and returns their names"""
+        proxy = connect(self.address)
+        files = proxy.list_files(self.remote_dir)
+        checkpoints = {}
+        for relative_path in files:
+            parts = relative_path.split('/')
+            if len(parts) > 1 and parts[0].startswith('step_') and not parts[0].endswith('.tmp'):
+                checkpoints.setdefault(parts[0], []).append(relative_path)
+        collected = []
+        for checkpoint in sorted(checkpoints, key=lambda name: int(name.split('_')[1])):
+            if checkpoint in self.collected:
+                continue
+            part_dir = os.path.join(self.local_dir, checkpoint+'.part')
+            complete = True
+            for relative_path in checkpoints[checkpoint]:
+                path = os.path.join(self.local_dir, relative_path.replace(checkpoint, checkpoint+'.part', 1))
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                if not fetch_file(proxy, self.remote_dir+'/'+relative_path, path):
+                    #Expired on the worker while it was copied
+                    complete = False
+                    break
+            if not complete:
+                shutil.rmtree(part_dir, ignore_errors=True)
+                continue
+            os.rename(part_dir, os.path.join(self.local_dir, checkpoint))
+            self.collected.add(checkpoint)
+            collected.append(checkpoint)
+            print('Collected checkpoint ', self.address, checkpoint)
+        return collected
+
+
+def fetch_file(proxy, name, path, attempts=2):
+    """ Copies a file from an agent in pieces, continuing a
+    previous partial copy at path. Returns False if the file
+    does not exist or does not match the sha256 on the agent"""
+    for _ in range(attempts):
+        offset = os.path.getsize(path) if os.path.isfile(path) else 0
+        with open(path, 'ab') as copy:
+            while True:
+                piece = proxy.read_file(name, offset)
+                if piece is None:
+                    print('Missing result file ', name)
+                    return False
+                if offset > piece['size']:
+                    #The file was rewritten, start over
+                    break
+                copy.write(piece['data'].data)
+                offset += len(piece['data'].data)
+                if offset >= piece['size']:
+                    break
+        if give_hash(path) == proxy.give_hash(name):
+            return True
+        os.remove(path)
+    print('Could not verify ', name)
+    return False
+
+
+def give_hash(path, block_size=1024*1024):
+    """ Returns the sha256 of a file"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as hashed_file:
+        for block in iter(lambda: hashed_file.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def start_agents(transfer_engine, hosts, port=AGENT_PORT):
+    """ Starts the agent on every host where it is not running"""
+    #The pattern is anchored at the end of the command line so that it
+    #cannot match the remote shell running this command, only the agent
+    #is sent to the background so that ssh does not wait for it
+    command = ("pgrep -f '[a]gent[.]py --port=%d$' > /dev/null || "
+               '(nohup python agent.py --port=%d > agent.log 2>&1 < /dev/null &)') % (port, port)
+    return transfer_engine.run(hosts, command)
+
+
+def open_tunnels(transfer_engine, hosts, port=AGENT_PORT, first_local_port=12224):
+    """ Forwards a local port to the agent of every host and
+    returns the ssh processes and the local agent addresses"""
+    tunnels = []
+    addresses = {}
+    for index, host in enumerate(hosts):
+        local_port = first_local_port+index
+        tunnels.append(subprocess.Popen(
+            transfer_engine.ssh_command+['-N', '-L', '%d:127.0.0.1:%d' % (local_port, port),
+                                         transfer_engine.give_target(host)]))
+        addresses[host] = '127.0.0.1:%d' % local_port
+    #Wait until every agent answers through its tunnel
+    for host in hosts:
+        for _ in range(30):
+            try:
+                connect(addresses[host]).ping()
+                break
+            except (IOError, OSError):
+                time.sleep(1)
+    return tunnels, addresses
+
+
+if __name__ == '__main__':
+    PARSER = argparse.ArgumentParser()
+    PARSER.add_argument("-p", "--port", type=int, default=AGENT_PORT)
+    PARSER.add_argument("-w_dir", "--work_dir", type=str, default='.')
+    FLAGS = PARSER.parse_args()
+    SERVER = serve('127.0.0.1', FLAGS.port, [WorkerAgent(FLAGS.work_dir)])
+    while True:
+        time.sleep(3600)
@@ -25,10 +25,11 @@ instanceId=$(tail -n+2 $input | head -n1)
 IFS=' ' read -ra instanceId <<< "$instanceId"
 ips=$(tail -n+3 $input | head -n1)
 
-i=$(( -1 ))
+#The first $2 (default 1) machines are parameter servers
+i=$(( -${2:-1} ))
 for ip in ${ips[@]}; do
 echo $i
-        if [ $i -eq -1 ]; then
+        if [ $i -lt 0 ]; then
         	echo 'PS'
 	else
                 scp -i "/home/ec2-user/aux/easyDist.pem" ec2-user@"$ip":m_"$i"_logs.zip /home/ec2-user/experiments/exp$1/.
@@ -0,0 +1,133 @@
+# Copyright (c) 2019 American Express Travel Related Services Company, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except
+# in compliance with the License. You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License
+# is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+# or implied. See the License for the specific language governing permissions and limitations under
+# the License.
+
+""" This module saves the model (graph + weights) of a
+worker while it trains. Checkpoints are written from a
+snapshot on a background thread so that the training loop
+does not wait for the disk, and old checkpoints are
+deleted according to a retention policy"""
+from __future__ import print_function
+import os
+import shutil
+import threading
+import time
+import tensorflow as tf
+
+class Checkpointer:
+    """ Takes in-graph snapshots of all the global variables
+    into local copies on the worker and writes them to
+    directory/step_N from a background thread.
+    The last keep checkpoints and the best one are retained.
+    Besides the explicit saves, a checkpoint is taken every
+    every_steps global steps and/or every_secs seconds.
+    This class must be created before the graph is finalized"""
+    def __init__(self, worker_device, directory='./models/', keep=3, every_steps=0, every_secs=0):
+        self.directory = directory
+        self.keep = keep
+        self.every_steps = every_steps
+        self.every_secs = every_secs
+        variables = tf.global_variables()
+        with tf.device(worker_device):
+            #The copies are in no collection, they are neither initialized nor
+            #checked by the supervisor and are never placed on a parameter server
+            self.copies = [tf.Variable(tf.zeros(var.get_shape(), dtype=var.dtype.base_dtype),
+                                       trainable=False, collections=[],
+                                       name='snapshot/'+var.op.name)
+                           for var in variables]
+            self.init_op = tf.variables_initializer(self.copies)
+            self.snapshot_op = tf.group(*[copy.assign(var)
+                                          for copy, var in zip(self.copies, variables)])
+        #The copies are saved under the names of the original variables
+        self.saver = tf.train.Saver(dict(zip([var.op.name for var in variables], self.copies)),
+                                    max_to_keep=None, save_relative_paths=True)
+        self.graph_def = None
+        self.lock = threading.Lock()
+        self.writer = None
+        self.pending = None
+        self.saved_steps = []
+        self.best_step = None
+        self.last_step = 0
+        self.last_time = time.time()
+
+    def start(self, sess):
+        """ Initializes the local copies once the session exists"""
+        sess.run(self.init_op)
+        self.graph_def = sess.graph_def
+
+    def maybe_save(self, sess, step):
+        """ Takes a checkpoint if the step or time interval
+        has passed or a periodic save is still pending"""
+        due = (self.every_steps and step-self.last_step >= self.every_steps) or \
+              (self.every_secs and time.time()-self.last_time >= self.every_secs)
+        if due or self.pending is not None:
+            self.save(sess, step)
+
+    def save(self, sess, step, best=False):
+        """ Snapshots the variables and writes them in the
+        background. If the previous checkpoint is still being
+        written a periodic save is deferred to the next
+        maybe_save, while a best save waits for the copies to
+        be free, so that it holds the weights of this step"""
+        with self.lock:
+            busy = self.writer is not None and self.writer.is_alive()
+        if busy:
+            if not best:
+                self.pending = step
+                return False
+            self.writer.join()
+        self.pending = None
+        self.last_step = step
+        self.last_time = time.time()
+        sess.run(self.snapshot_op)
+        self.writer = threading.Thread(target=self._write, args=(sess, step, best))
+        self.writer.start()
+        return True
+
+    def close(self, sess):
+        """ Waits for the checkpoints that are being written
+        and writes the pending one"""
+        if self.writer is not None:
+            self.writer.join()
+        if self.pending is not None:
+            self.save(sess, self.pending)
+            self.writer.join()
+
+    def _write(self, sess, step, best):
+        """ Writes a checkpoint into a temporary directory which
+        is renamed once complete, then applies the retention"""
+        path = os.path.join(self.directory, 'step_%d' % step)
+        temp_path = path+'.tmp'
+        tf.train.write_graph(graph_or_graph_def=self.graph_def,
+                             logdir=temp_path,
+                             name='my_graph.prototxt')
+        self.saver.save(sess, os.path.join(temp_path, 'mmmg_model'), write_meta_graph=False)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        os.rename(temp_path, path)
+        with self.lock:
+            if step not in self.saved_steps:
+                self.saved_steps.append(step)
+            if best:
+                self.best_step = step
+            for old_step in give_expired(self.saved_steps, self.keep, self.best_step):
+                shutil.rmtree(os.path.join(self.directory, 'step_%d' % old_step),
+                              ignore_errors=True)
+                self.saved_steps.remove(old_step)
+        print('Saved checkpoint at step ', step)
+
+
+def give_expired(saved_steps, keep, best_step):
+    """ Returns the checkpoints that are neither among the
+    last keep ones nor the best one"""
+    retained = set(sorted(saved_steps)[-keep:] if keep > 0 else [])
+    retained.add(best_step)
+    return [step for step in saved_steps if step not in retained]
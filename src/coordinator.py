@@ -0,0 +1,240 @@
+# Copyright (c) 2019 American Express Travel Related Services Company, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except
+# in compliance with the License. You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License
+# is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+# or implied. See the License for the specific language governing permissions and limitations under
+# the License.
+
+""" This module provides the small coordination services
+which run on the parameter server next to the tensorflow
+server, and the clients used by the workers to reach them.
+The services are exposed over XML-RPC"""
+from __future__ import print_function
+import collections
+import os
+import resource
+import socket
+import threading
+import time
+try:
+    from xmlrpc.server import SimpleXMLRPCServer
+    from xmlrpc.client import ServerProxy, Fault, ProtocolError
+except ImportError:
+    from SimpleXMLRPCServer import SimpleXMLRPCServer
+    from xmlrpclib import ServerProxy, Fault, ProtocolError
+
+class ChunkDispatcher:
+    """ Hands out the chunks of every epoch to the workers
+    on demand. A worker asks for its next chunk once it has
+    trained on the previous one, so fast workers take over
+    the chunks that slow workers would otherwise delay"""
+    exported = ['next_chunk', 'give_assignments']
+
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+        self.lock = threading.Lock()
+        #Remaining chunks and assigned chunks per worker for every epoch
+        self.remaining = {}
+        self.assignments = {}
+
+    def next_chunk(self, worker, epoch):
+        """ Returns the next chunk of the epoch for a worker,
+        or an empty string once all chunks are handed out"""
+        with self.lock:
+            if epoch not in self.remaining:
+                self.remaining[epoch] = collections.deque(self.chunks)
+                self.assignments[epoch] = {}
+            if not self.remaining[epoch]:
+                return ''
+            chunk = self.remaining[epoch].popleft()
+            self.assignments[epoch].setdefault(str(worker), []).append(chunk)
+            return chunk
+
+    def give_assignments(self, epoch):
+        """ Returns the chunks handed out to every worker
+        during an epoch"""
+        with self.lock:
+            return dict(self.assignments.get(epoch, {}))
+
+
+class StepAgreement:
+    """ Agrees on the number of steps of every epoch of
+    synchronous training. Every worker proposes the number of
+    batches it holds and all of them train the smallest one,
+    as a synchronous step waits for the gradients of the
+    other workers and would never complete once too many of
+    them ran out of data"""
+    exported = ['propose_steps']
+
+    def __init__(self, num_workers):
+        self.num_workers = num_workers
+        self.lock = threading.Lock()
+        self.proposals = {}
+
+    def propose_steps(self, worker, epoch, steps):
+        """ Records the steps a worker can train during an
+        epoch and returns the agreed steps, -1 until all the
+        workers proposed theirs"""
+        with self.lock:
+            proposals = self.proposals.setdefault(epoch, {})
+            proposals[str(worker)] = steps
+            if len(proposals) < self.num_workers:
+                return -1
+            return min(proposals.values())
+
+
+class MetricsCollector:
+    """ Keeps the latest metrics reported by every worker and
+    aggregates them into a rolling view of the cluster"""
+    exported = ['report', 'give_cluster_view']
+
+    def __init__(self, stale_secs=60):
+        self.stale_secs = stale_secs
+        self.lock = threading.Lock()
+        self.latest = {}
+
+    def report(self, worker, metrics):
+        """ Stores the latest metrics of a worker"""
+        metrics = dict(metrics)
+        metrics['received'] = time.time()
+        with self.lock:
+            self.latest[str(worker)] = metrics
+        return True
+
+    def give_cluster_view(self):
+        """ Returns the aggregate samples/sec of the workers that
+        reported recently, the slowest of them, the highest global
+        step and the lag of every worker behind that step"""
+        now = time.time()
+        with self.lock:
+            workers = dict((worker, dict(metrics)) for worker, metrics in self.latest.items())
+        global_step = max([metrics.get('step', 0) for metrics in workers.values()] or [0])
+        for metrics in workers.values():
+            metrics['age'] = now-metrics['received']
+            metrics['lag'] = global_step-metrics.get('step', 0)
+        active = dict((worker, metrics) for worker, metrics in workers.items()
+                      if metrics['age'] <= self.stale_secs)
+        speeds = dict((worker, metrics.get('samples_per_sec', 0.0))
+                      for worker, metrics in active.items())
+        return {'time': now,
+                'global_step': global_step,
+                'active_workers': len(active),
+                'samples_per_sec': sum(speeds.values()),
+                'slowest_worker': min(speeds, key=speeds.get) if speeds else None,
+                'workers': workers}
+
+
+class MetricsReporter:
+    """ Sends the latest metrics of a worker to the collector
+    every interval seconds from a background thread, so that
+    training never waits on the parameter server"""
+    def __init__(self, address, worker, interval=10):
+        self.address = address
+        self.worker = worker
+        self.interval = interval
+        self.latest = None
+        self.sent = None
+        self.failed = False
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def update(self, metrics):
+        """ Replaces the metrics to be sent next"""
+        self.latest = metrics
+
+    def close(self):
+        """ Sends the last metrics and stops reporting"""
+        self.stop_event.set()
+        self.thread.join()
+
+    def _run(self):
+        proxy = connect(self.address)
+        while True:
+            stopping = self.stop_event.wait(self.interval)
+            metrics = self.latest
+            if metrics is not None and metrics is not self.sent:
+                try:
+                    metrics = dict(metrics)
+                    metrics['memory_mb'] = give_memory_mb()
+                    metrics['host'] = socket.gethostname()
+                    proxy.report(self.worker, metrics)
+                    self.sent = self.latest
+                except (IOError, OSError, Fault, ProtocolError) as error:
+                    #Reporting is best effort, the next interval tries again
+                    if not self.failed:
+                        print('Could not report metrics to ', self.address, error)
+                    self.failed = True
+            if stopping:
+                break
+
+
+def give_memory_mb():
+    """ Returns the resident memory of this process in MB"""
+    try:
+        with open('/proc/self/statm') as statm:
+            pages = int(statm.read().split()[1])
+        return pages*os.sysconf('SC_PAGE_SIZE')/1024.0/1024.0
+    except (IOError, OSError, ValueError):
+        #Peak resident memory, in KB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0
+
+
+def serve(host, port, services):
+    """ Serves the exported methods of the given services
+    from a background thread and returns the server"""
+    server = SimpleXMLRPCServer((host, int(port)), allow_none=True, logRequests=False)
+    for service in services:
+        for name in service.exported:
+            server.register_function(getattr(service, name), name)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    print('Coordinator listening on %s:%d' % (host, server.server_address[1]))
+    return server
+
+
+def connect(address):
+    """ Returns a proxy to the coordinator at host:port"""
+    return ServerProxy('http://%s' % address, allow_none=True)
+
+
+def agree_steps(address, worker, epoch, steps, poll_secs=1):
+    """ Proposes the steps of a worker for an epoch and waits
+    until all the workers agreed on the steps to train"""
+    proxy = connect(address)
+    while True:
+        agreed = proxy.propose_steps(worker, epoch, steps)
+        if agreed >= 0:
+            return agreed
+        time.sleep(poll_secs)
+
+
+def give_replicas(num_workers, replicas_to_aggregate=0, backup_workers=0):
+    """ Returns the number of workers whose gradients every
+    synchronous step aggregates: replicas_to_aggregate, or all
+    workers but the backup workers if it is 0. Raises a
+    ValueError for counts the cluster cannot satisfy"""
+    if backup_workers < 0 or backup_workers >= num_workers:
+        raise ValueError('backup_workers must be between 0 and %d' % (num_workers-1))
+    if replicas_to_aggregate < 0 or replicas_to_aggregate > num_workers:
+        raise ValueError('replicas_to_aggregate must be between 1 and %d, or 0 for all'
+                         ' but the backup workers' % num_workers)
+    return replicas_to_aggregate or num_workers-backup_workers
+
+
+def remote_chunks(address, worker, epoch):
+    """ Yields the chunks handed to a worker by the
+    dispatcher until the epoch is exhausted"""
+    proxy = connect(address)
+    while True:
+        chunk = proxy.next_chunk(worker, epoch)
+        if not chunk:
+            break
+        yield chunk
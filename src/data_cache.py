@@ -0,0 +1,191 @@
+# Copyright (c) 2019 American Express Travel Related Services Company, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except
+# in compliance with the License. You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License
+# is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+# or implied. See the License for the specific language governing permissions and limitations under
+# the License.
+
+""" This module keeps the data of a worker on its local
+disk across training runs so that repeated experiments
+on the same VM do not download the same chunks again"""
+from __future__ import print_function
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+
+GB = 1024*1024*1024
+
+class DiskCache:
+    """ Base class of the on disk caches. The least recently
+    used entries are evicted once the cache grows beyond
+    max_bytes"""
+    def __init__(self, cache_dir, max_bytes=10*GB):
+        self.cache_dir = os.path.expanduser(cache_dir)
+        self.max_bytes = max_bytes
+        if os.path.isdir(self.cache_dir) is False:
+            os.makedirs(self.cache_dir)
+
+    def give_entries(self):
+        """ Returns (last use, size, path) for every entry
+        in the cache ordered from least to most recently used.
+        An entry is either a file or a directory of files"""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.endswith('.tmp'):
+                continue
+            #Entries may be evicted by another process sharing the cache meanwhile
+            try:
+                if os.path.isdir(path):
+                    size = sum(os.path.getsize(os.path.join(path, part))
+                               for part in os.listdir(path))
+                else:
+                    size = os.path.getsize(path)
+                entries.append((os.path.getmtime(path), size, path))
+            except (IOError, OSError):
+                continue
+        return sorted(entries)
+
+    def evict(self, keep=None):
+        """ Deletes least recently used entries until the
+        cache fits within max_bytes"""
+        entries = self.give_entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+            except (IOError, OSError):
+                pass
+            total -= size
+
+
+class ChunkCache(DiskCache):
+    """ On disk cache of S3 objects keyed by bucket, key and
+    ETag. An object that changed on S3 has a new ETag and
+    therefore misses the cache"""
+
+    def give_path(self, bucket, key, etag):
+        """ Returns the location of an entry in the cache"""
+        name = hashlib.sha1(('%s/%s/%s' % (bucket, key, etag)).encode('utf8')).hexdigest()
+        return os.path.join(self.cache_dir, name)
+
+    def get(self, bucket, key, etag):
+        """ Returns the cached contents of an object or None"""
+        path = self.give_path(bucket, key, etag)
+        try:
+            with open(path, 'rb') as cached:
+                data = cached.read()
+        except (IOError, OSError):
+            return None
+        #The modification time orders the entries for eviction
+        os.utime(path, None)
+        return data
+
+    def put(self, bucket, key, etag, data):
+        """ Stores the contents of an object and evicts
+        old entries if the cache is full"""
+        if len(data) > self.max_bytes:
+            return
+        path = self.give_path(bucket, key, etag)
+        temp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(temp_path, 'wb') as cached:
+            cached.write(data)
+        os.rename(temp_path, path)
+        self.evict(keep=path)
+
+
+class PreprocessedCache(DiskCache):
+    """ On disk cache of the (inputs, outputs, train_size)
+    returned by the user's preprocessing. An entry is keyed
+    by the keys and ETags of the shard together with a hash
+    of the preprocessing code, so that a change to either
+    of them misses the cache. Every array is stored as a
+    .npy file inside the directory of the entry"""
+
+    @staticmethod
+    def give_key(bucket, keys, etags, code_files, settings=None):
+        """ Returns the cache key for a shard, the file, or
+        list of files, of its preprocessing code and the
+        settings the arrays were stored with"""
+        digest = hashlib.sha1()
+        if isinstance(code_files, str):
+            code_files = [code_files]
+        for code_file in code_files:
+            with open(code_file, 'rb') as code:
+                digest.update(code.read())
+        for key, etag in zip(keys, etags):
+            digest.update(('\n%s/%s/%s' % (bucket, key, etag)).encode('utf8'))
+        if settings:
+            digest.update(json.dumps(settings, sort_keys=True).encode('utf8'))
+        return digest.hexdigest()
+
+    def get(self, key):
+        """ Returns the cached (inputs, outputs, train_size)
+        for a key from give_key or None"""
+        path = os.path.join(self.cache_dir, key)
+        try:
+            with open(os.path.join(path, 'meta.json')) as meta_file:
+                meta = json.load(meta_file)
+            inputs = [self.load_array(path, 'inputs_%d' % i) for i in range(meta['inputs'])]
+            outputs = [self.load_array(path, 'outputs_%d' % i) for i in range(meta['outputs'])]
+            os.utime(path, None)
+        except (IOError, OSError, ValueError):
+            return None
+        return inputs, outputs, meta['train_size']
+
+    def put(self, key, inputs, outputs, train_size):
+        """ Stores the (inputs, outputs, train_size) for
+        a key from give_key, unless the entry is larger than
+        the cache or another process already stored it"""
+        if sum(getattr(array, 'nbytes', 0) for array in list(inputs)+list(outputs)) > \
+                self.max_bytes:
+            return
+        path = os.path.join(self.cache_dir, key)
+        if os.path.isdir(path):
+            return
+        #A directory of its own, the cache may be shared by several workers
+        temp_path = tempfile.mkdtemp(prefix=key+'.', suffix='.tmp', dir=self.cache_dir)
+        for prefix, arrays in [('inputs', inputs), ('outputs', outputs)]:
+            for i, array in enumerate(arrays):
+                try:
+                    array = np.asarray(array)
+                except ValueError:
+                    #Ragged sequences are stored as object arrays
+                    array = np.array(list(array) + [None], dtype=object)[:-1]
+                np.save(os.path.join(temp_path, '%s_%d.npy' % (prefix, i)), array)
+        with open(os.path.join(temp_path, 'meta.json'), 'w') as meta_file:
+            json.dump({'inputs': len(inputs), 'outputs': len(outputs),
+                       'train_size': int(train_size)}, meta_file)
+        try:
+            os.replace(temp_path, path)
+        except OSError:
+            #Stored by another process in the meantime, the entries are the same
+            shutil.rmtree(temp_path, ignore_errors=True)
+            if not os.path.isdir(path):
+                raise
+        self.evict(keep=path)
+
+    @staticmethod
+    def load_array(path, name):
+        """ Loads a single cached array as a read only
+        memory map, object arrays are read into memory"""
+        file_name = os.path.join(path, name+'.npy')
+        try:
+            return np.load(file_name, mmap_mode='r')
+        except ValueError:
+            return np.load(file_name, allow_pickle=True)
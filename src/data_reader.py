@@ -14,33 +14,275 @@
 to the training files present on S3. It also
 interfaces with trainer.py and provides batched
 training inputs"""
+import io
+import multiprocessing
+import os
+import shutil
+import tempfile
 import time
-import boto3
+import numpy as np
+from s3_download import Downloader, BucketClient
+from data_cache import ChunkCache, PreprocessedCache
+
+#Shared memory through which the preprocessing processes hand back their arrays
+SHM_DIR = '/dev/shm'
+#Chunks and the Preprocessing instance of a parallel read_data, inherited by the
+#forked processes instead of being pickled to them
+_CHUNKS = {}
+#Share of cache_size given to the preprocessed data, the rest holds the chunks
+PREPROCESSED_SHARE = 0.5
+#Integer types tried by compact_array, narrowest first
+INT_TYPES = [np.uint8, np.int8, np.uint16, np.int16, np.uint32, np.int32]
 
 class Dataset:
     """ Controls the flow of data to the network
     This class gets instantiated and used from
     trainer.py """
-    def __init__(self):
+    def __init__(self, max_in_flight=8, cache_dir=None, cache_size=0, memmap_dir=None,
+                 s3_endpoint=None, processes=0, bucket_width=0, padding='pre', seed=None,
+                 compact=False, allow_float16=False):
         self.inputs = []
         self.outputs = []
         self.objects = []
+        #Constant sample weights shared by all the batches
+        self.weights = np.ones(0, dtype=np.float32)
 
         self.train_size = 0
-        self.client = boto3.client('s3')
-        self.resource = boto3.resource('s3')
+        #Directory in which the arrays are memory mapped (None keeps them in memory)
+        self.memmap_dir = os.path.expanduser(memmap_dir) if memmap_dir else None
+        self.memmap_reads = 0
+        #Buckets named file://<directory> are read from local disk
+        self.client = BucketClient(s3_endpoint)
+        #Chunks and preprocessed data are kept on local disk between runs
+        #if a cache size is given, both caches together stay within it
+        cache = None
+        self.preprocessed_cache = None
+        if cache_dir and cache_size > 0:
+            preprocessed_size = int(cache_size*PREPROCESSED_SHARE)
+            cache = ChunkCache(os.path.join(cache_dir, 'chunks'), cache_size-preprocessed_size)
+            self.preprocessed_cache = PreprocessedCache(os.path.join(cache_dir, 'preprocessed'),
+                                                        preprocessed_size)
+        self.downloader = Downloader(self.client, max_in_flight=max_in_flight, cache=cache)
+        #With more than one process every chunk is preprocessed on its own by the
+        #preprocess_chunk method of the user, in a pool of processes
+        self.processes = processes
+        #With a bucket_width, every batch holds examples whose sequence length (the
+        #non zero tokens of the first input) falls in the same bucket of bucket_width
+        #tokens. The batches of all buckets are shuffled together every epoch
+        self.bucket_width = bucket_width
+        #Side on which the sequences are padded, and whether the padding columns not
+        #needed by any example of a batch are dropped (the model must then accept
+        #sequences of any length)
+        if padding not in ['pre', 'post']:
+            raise ValueError("padding must be 'pre' or 'post', not %r" % (padding,))
+        self.padding = padding
+        self.trim = False
+        self.lengths = None
+        self.batch_plan = None
+        self.random = np.random.RandomState(seed)
+        #With compact, the arrays are stored in the narrowest types that hold their
+        #values exactly (float16 only if allowed) and batches are cast to feed_dtypes,
+        #the types of the placeholders, when they are handed out
+        self.compact = compact
+        self.allow_float16 = allow_float16
+        self.feed_dtypes = None
+        self.memory = {}
 
     def give_num_batches(self, batch_size):
         """ Returns total number of batches"""
+        if self.bucket_width > 0:
+            return len(self.give_batch_plan(batch_size))
         return self.train_size / batch_size
 
     def give_next(self, batch_size, i):
-        """ Gives batch number 'i' of size batch_size"""
+        """ Gives batch number 'i' of size batch_size.
+        Batches of numpy arrays are views, not copies,
+        except for bucketed batches"""
+        if self.bucket_width > 0:
+            return self.give_bucketed(self.give_batch_plan(batch_size)[i])
         start = i*batch_size
         end = min((i+1)*batch_size, self.train_size)
-        return [inp[start:end] for inp in self.inputs] +\
-               [out[start:end] for out in self.outputs] +\
-               [[1]*(end-start)]
+        return self.cast([inp[start:end] for inp in self.inputs] +
+                         [out[start:end] for out in self.outputs] +
+                         [self.give_weights(end-start)])
+
+    def cast(self, batch):
+        """ Casts the arrays of a batch whose type differs
+        from the feed_dtypes"""
+        if self.feed_dtypes is None:
+            return batch
+        return [arr.astype(dtype) if dtype is not None and arr.dtype != dtype else arr
+                for arr, dtype in zip(batch, self.feed_dtypes)] + batch[len(self.feed_dtypes):]
+
+    def give_weights(self, size):
+        """ Returns the sample weights of a batch of the given
+        size. The weights are allocated once and sliced"""
+        if len(self.weights) < size:
+            self.weights = np.ones(size, dtype=np.float32)
+        return self.weights[:size]
+
+    def batches(self, batch_size):
+        """ Yields all the batches of the data read
+        by read_data in order, or in a new shuffled
+        order of the buckets"""
+        if self.bucket_width > 0:
+            self.plan_batches(batch_size)
+        for i in range(int(self.give_num_batches(batch_size))):
+            yield self.give_next(batch_size, i)
+
+    def give_lengths(self):
+        """ Returns the sequence length of every example,
+        the number of non zero tokens of the first input"""
+        if self.lengths is None:
+            sequences = self.inputs[0]
+            self.lengths = np.zeros(self.train_size, dtype=np.int64)
+            #A block at a time, memory mapped inputs are not read at once
+            for start in range(0, self.train_size, 100000):
+                block = np.asarray(sequences[start:start+100000])
+                self.lengths[start:start+len(block)] = np.count_nonzero(
+                    block.reshape(len(block), -1), axis=1)
+        return self.lengths
+
+    def plan_batches(self, batch_size):
+        """ Groups the examples into batches of at most
+        batch_size examples of the same length bucket, in a
+        random order within and across the buckets. Returns
+        the index array of every batch"""
+        buckets = self.give_lengths()//self.bucket_width
+        order = self.random.permutation(self.train_size)
+        order = order[np.argsort(buckets[order], kind='mergesort')]
+        #Batches never span two buckets
+        ends = np.append(np.flatnonzero(np.diff(buckets[order])), len(order)-1)+1
+        plan = []
+        start = 0
+        for end in ends.tolist():
+            for first in range(start, end, batch_size):
+                #Sorted, so that memory mapped arrays are read front to back
+                plan.append(np.sort(order[first:min(first+batch_size, end)]))
+            start = end
+        self.random.shuffle(plan)
+        self.batch_plan = (batch_size, plan)
+        return plan
+
+    def give_batch_plan(self, batch_size):
+        """ Returns the current batches of the buckets"""
+        if self.batch_plan is None or self.batch_plan[0] != batch_size:
+            self.plan_batches(batch_size)
+        return self.batch_plan[1]
+
+    def give_bucketed(self, indices):
+        """ Returns the batch of the given examples, with the
+        padding columns of the first input that hold no
+        token of any example dropped if trim is set"""
+        batch = [inp[indices] for inp in self.inputs] + [out[indices] for out in self.outputs]
+        if self.trim:
+            width = max(int(self.lengths[indices].max()), 1)
+            if self.padding == 'pre':
+                batch[0] = batch[0][:, -width:]
+            else:
+                batch[0] = batch[0][:, :width]
+        return self.cast(batch + [self.give_weights(len(indices))])
+
+    def give_padding_efficiency(self, batch_size):
+        """ Returns the fraction of the fed sequence positions
+        which hold tokens, for batches of the whole padded
+        width and for the batches of the buckets"""
+        lengths = self.give_lengths()
+        tokens = float(lengths.sum())
+        width = int(np.prod(self.inputs[0].shape[1:])) if self.train_size else 0
+        padded = tokens/max(self.train_size*width, 1)
+        bucketed = padded
+        if self.bucket_width > 0 and self.trim:
+            fed = sum(len(indices)*max(int(lengths[indices].max()), 1)
+                      for indices in self.give_batch_plan(batch_size))
+            bucketed = tokens/max(fed, 1)
+        return {'padded': padded, 'bucketed': bucketed}
+
+    def stream_batches(self, bucket, keys, batch_size, buffer_size=10000):
+        """ Streams the specified chunks from S3 and yields
+        batches of size batch_size without holding the whole
+        shard in memory.
+        The records of every object are read line by line and
+        handed to the preprocess_chunk method of the user's
+        Preprocessing class, buffer_size records at a time.
+        Records left over at the end of a chunk are carried
+        into the next one, an incomplete final batch is dropped"""
+        from preprocessing import Preprocessing
+        pre = Preprocessing()
+
+        def read_chunks():
+            for key in keys:
+                body = self.client.get_object(Bucket=bucket, Key=key)['Body']
+                for arrays in self._read_chunks(pre, key, body, buffer_size):
+                    yield arrays
+        return self.carry_batches(read_chunks(), batch_size)
+
+    def read_batches(self, bucket, keys, batch_size):
+        """ Reads the chunks one after the other with read_data
+        and yields their batches. Examples left over at the end
+        of a chunk are carried into the next one, an incomplete
+        final batch is dropped"""
+        if self.bucket_width > 0:
+            #The batches of the buckets already hold every example
+            for key in keys:
+                self.read_data(bucket, [key])
+                for batch in self.batches(batch_size):
+                    yield batch
+            return
+
+        def read_chunks():
+            for key in keys:
+                self.read_data(bucket, [key])
+                yield list(self.inputs)+list(self.outputs)
+        for batch in self.carry_batches(read_chunks(), batch_size):
+            yield self.cast(batch)
+
+    def carry_batches(self, chunks, batch_size):
+        """ Yields batches of size batch_size from the arrays
+        (inputs followed by outputs) of consecutive chunks,
+        completing the last batch of a chunk with the first
+        examples of the next one"""
+        carry = None
+        for arrays in chunks:
+            start = 0
+            size = len(arrays[0])
+            if carry is not None:
+                #Complete the batch started in the previous chunk
+                start = min(batch_size-len(carry[0]), size)
+                carry = [np.concatenate([old, new[:start]])
+                         for old, new in zip(carry, arrays)]
+                if len(carry[0]) < batch_size:
+                    continue
+                yield carry + [self.give_weights(batch_size)]
+                carry = None
+            while start+batch_size <= size:
+                yield [arr[start:start+batch_size] for arr in arrays] +\
+                      [self.give_weights(batch_size)]
+                start += batch_size
+            if start < size:
+                carry = [arr[start:] for arr in arrays]
+
+    def _read_chunks(self, pre, key, body, buffer_size):
+        """ Reads the lines of a single S3 object and yields the
+        preprocessed arrays (inputs followed by outputs) for every
+        buffer_size records"""
+        lines = (line.decode('utf8') for line in body.iter_lines() if line)
+        header = next(lines, None)
+        records = []
+        for line in lines:
+            records.append(line)
+            if len(records) == buffer_size:
+                yield self._preprocess_chunk(pre, key, header, records)
+                records = []
+        if records:
+            yield self._preprocess_chunk(pre, key, header, records)
+
+    @staticmethod
+    def _preprocess_chunk(pre, key, header, records):
+        """ Calls the user's chunk level preprocessing and returns
+        its inputs followed by its outputs as arrays"""
+        inputs, outputs, _ = pre.preprocess_chunk(key, header, records)
+        return [np.asarray(arr) for arr in list(inputs)+list(outputs)]
 
     def read_data(self, bucket, keys):
         """This method returns the concatenation of the
@@ -51,12 +293,275 @@ class Dataset:
         This function also gets the S3 Objects and return
         the list containingthe objects to the preprocessing function"""
         start = time.time()
-        from preprocessing import Preprocessing
+        import preprocessing
         print(len(keys), " Training Files Present")
 
-        for key in range(len(keys)):
-            obj = self.resource.Object(bucket, key).get()['Body']
-            self.objects.append(obj)
-        pre = Preprocessing()
-        pre.preprocess(keys, self.objects)
+        heads = self.downloader.heads(bucket, keys)
+        if self.preprocessed_cache is not None:
+            #Skip the download and preprocessing if neither the chunks nor the code changed
+            #Entries are stored compacted, the settings are part of the key
+            cache_key = self.preprocessed_cache.give_key(
+                bucket, keys, [etag for _, etag in heads], give_code_files(preprocessing),
+                {'compact': self.compact, 'allow_float16': self.allow_float16})
+            cached = self.preprocessed_cache.get(cache_key)
+            if cached is not None:
+                print('Read the preprocessed data from the local cache')
+                self.inputs, self.outputs, self.train_size = cached
+                self.compact_arrays()
+                self.store_arrays()
+                self.lengths = self.batch_plan = None
+                return time.time()-start
+
+        #Download all the chunks concurrently, the preprocessing reads them as file objects
+        bodies = self.downloader.fetch(bucket, keys, heads)
+        pre = preprocessing.Preprocessing()
+        if self.processes > 1 and len(keys) > 1 and hasattr(pre, 'preprocess_chunk') and \
+                can_fork():
+            self.inputs, self.outputs, self.train_size = self.preprocess_parallel(pre, keys,
+                                                                                  bodies)
+        else:
+            #Read in place, io.BytesIO would copy every body
+            self.objects = [BodyReader(body) for body in bodies]
+            self.inputs, self.outputs, self.train_size = pre.preprocess(keys, self.objects)
+            self.objects = []
+        del bodies
+        self.compact_arrays()
+        #Chunks overwritten during the download no longer match the ETags of the key
+        changed = any(stats.get('changed') for stats in self.downloader.stats.values())
+        if self.preprocessed_cache is not None and not changed:
+            self.preprocessed_cache.put(cache_key, self.inputs, self.outputs, self.train_size)
+            #Use the memory mapped files of the cache entry instead of a second copy
+            cached = self.preprocessed_cache.get(cache_key)
+            if cached is not None:
+                self.inputs, self.outputs, _ = cached
+        self.store_arrays()
+        self.lengths = self.batch_plan = None
         return time.time()-start
+
+    def preprocess_parallel(self, pre, keys, bodies):
+        """ Preprocesses every chunk with preprocess_chunk in a
+        pool of processes. The processes write their arrays to
+        shared memory, from where they are concatenated in the
+        order of keys. Returns (inputs, outputs, train_size)"""
+        start = time.time()
+        shm_dir = tempfile.mkdtemp(dir=SHM_DIR if os.path.isdir(SHM_DIR) else None)
+        _CHUNKS.update(pre=pre, keys=keys, bodies=bodies, out_dir=shm_dir)
+        try:
+            pool = multiprocessing.Pool(min(self.processes, len(keys)))
+            try:
+                results = pool.map(_preprocess_chunk_file, range(len(keys)), chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+            results = [result for result in results if result[0] is not None]
+            if not results:
+                return pre.preprocess(keys, [BodyReader(body) for body in bodies])
+            num_inputs = results[0][0]
+            parts = list(zip(*[paths for _, paths, _ in results]))
+            arrays = [np.concatenate([_load(path) for path in paths]) for paths in parts]
+            train_size = sum(size for _, _, size in results)
+        finally:
+            _CHUNKS.clear()
+            shutil.rmtree(shm_dir)
+        print('Preprocessed %d chunks with %d processes in %.2fs' % (
+            len(keys), min(self.processes, len(keys)), time.time()-start))
+        return arrays[:num_inputs], arrays[num_inputs:], train_size
+
+    def compact_arrays(self):
+        """ Stores the inputs and outputs in the narrowest
+        types that hold their values exactly, if compact is
+        set, and records their size before and after"""
+        if not self.compact:
+            return
+        before = give_nbytes(self.inputs+self.outputs)
+        self.inputs = [compact_array(arr, self.allow_float16) for arr in self.inputs]
+        self.outputs = [compact_array(arr, self.allow_float16) for arr in self.outputs]
+        self.memory = {'before_bytes': before, 'after_bytes': give_nbytes(self.inputs+self.outputs)}
+        print('Compacted the arrays from %.1f MB to %.1f MB' % (
+            self.memory['before_bytes']/1024.0/1024.0, self.memory['after_bytes']/1024.0/1024.0))
+
+    def store_arrays(self):
+        """ Moves the inputs and outputs into contiguous
+        memory mapped files in memmap_dir, so that only the
+        pages of the current batches need to be in memory.
+        Arrays which are already memory mapped and ragged
+        sequences are left as they are"""
+        if self.memmap_dir is None:
+            return
+        if os.path.isdir(self.memmap_dir) is False:
+            os.makedirs(self.memmap_dir)
+        self.memmap_reads += 1
+        self.inputs = [self._memmap(arr, 'inputs_%d' % i) for i, arr in enumerate(self.inputs)]
+        self.outputs = [self._memmap(arr, 'outputs_%d' % i) for i, arr in enumerate(self.outputs)]
+
+    def _memmap(self, array, name):
+        """ Writes a single array to a memory mapped file
+        and returns the read only mapping. The file is
+        unlinked right away, its pages stay valid until the
+        mapping is dropped and no run leaves a copy behind"""
+        if isinstance(array, np.memmap):
+            return array
+        try:
+            array = np.ascontiguousarray(array)
+        except ValueError:
+            return array
+        if array.dtype == object or array.size == 0:
+            return array
+        path = os.path.join(self.memmap_dir, '%s.%d.%d.dat' % (name, os.getpid(),
+                                                                self.memmap_reads))
+        mapped = np.memmap(path, dtype=array.dtype, mode='w+', shape=array.shape)
+        mapped[:] = array
+        mapped.flush()
+        del mapped
+        try:
+            return np.memmap(path, dtype=array.dtype, mode='r', shape=array.shape)
+        finally:
+            os.remove(path)
+
+
+class BodyReader(io.RawIOBase):
+    """ A read only file object over a downloaded chunk
+    which reads the chunk in place instead of copying it"""
+    def __init__(self, body):
+        super(BodyReader, self).__init__()
+        self.body = body
+        self.view = memoryview(body)
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += len(self.view)
+        self.position = max(offset, 0)
+        return self.position
+
+    def readinto(self, buffer):
+        piece = self.view[self.position:self.position+len(buffer)]
+        buffer[:len(piece)] = piece
+        self.position += len(piece)
+        return len(piece)
+
+    def readall(self):
+        data = self.view[self.position:].tobytes()
+        self.position += len(data)
+        return data
+
+    def readline(self, size=-1):
+        end = self.body.find(b'\n', self.position)
+        end = len(self.view) if end < 0 else end+1
+        if size is not None and size >= 0:
+            end = min(end, self.position+size)
+        data = self.view[self.position:end].tobytes()
+        self.position += len(data)
+        return data
+
+    def close(self):
+        self.view.release()
+        super(BodyReader, self).close()
+
+
+def can_fork():
+    """ Tells if the pool of preprocess_parallel can be used.
+    Its processes inherit the chunks, which needs the fork
+    start method, otherwise the chunks are preprocessed at
+    once by preprocess"""
+    get_start_method = getattr(multiprocessing, 'get_start_method', None)
+    if get_start_method is None:
+        return hasattr(os, 'fork')
+    return get_start_method() == 'fork'
+
+
+def give_code_files(preprocessing):
+    """ Returns the files of the preprocessing code: the user's
+    module, the helpers of preprocess_utils.py and the files the
+    module lists in an optional DEPENDENCIES variable"""
+    import preprocess_utils
+    base_dir = os.path.dirname(os.path.abspath(preprocessing.__file__))
+    return [preprocessing.__file__, preprocess_utils.__file__] +\
+           [os.path.join(base_dir, path) for path in getattr(preprocessing, 'DEPENDENCIES', [])]
+
+
+def give_nbytes(arrays):
+    """ Returns the total size in bytes of the arrays"""
+    return sum(getattr(arr, 'nbytes', 0) for arr in arrays)
+
+
+def give_blocks(array, block_size=1024*1024):
+    """ Yields the array in blocks of rows holding about
+    block_size values, so that scans of memory mapped arrays
+    only allocate temporaries of the size of a block"""
+    array = np.atleast_1d(array)
+    rows = max(block_size//max(array[0].size, 1), 1)
+    for start in range(0, len(array), rows):
+        yield array[start:start+rows]
+
+
+def compact_array(array, allow_float16=False):
+    """ Returns the array in the narrowest integer type that
+    holds all its values if they are whole numbers, else in
+    float32 (or float16) if that holds them exactly. Arrays
+    which cannot be narrowed are returned as they are"""
+    try:
+        array = np.asarray(array)
+    except ValueError:
+        return array
+    if array.size == 0 or array.dtype.kind not in 'iuf':
+        return array
+    if array.dtype.kind == 'f':
+        whole = True
+        for block in give_blocks(array):
+            if not np.isfinite(block).all():
+                return array
+            whole = whole and np.array_equal(np.floor(block), block)
+        if not whole:
+            for dtype in ([np.float16] if allow_float16 else [])+[np.float32]:
+                if np.dtype(dtype).itemsize < array.dtype.itemsize and \
+                        all(np.array_equal(block.astype(dtype), block)
+                            for block in give_blocks(array)):
+                    return array.astype(dtype)
+            return array
+    low = min(block.min() for block in give_blocks(array))
+    high = max(block.max() for block in give_blocks(array))
+    for dtype in INT_TYPES:
+        info = np.iinfo(dtype)
+        if np.dtype(dtype).itemsize < array.dtype.itemsize and info.min <= low and \
+                high <= info.max:
+            return array.astype(dtype)
+    return array
+
+
+def _preprocess_chunk_file(index):
+    """ Preprocesses a single chunk in a process of the pool
+    and saves its arrays as .npy files. Returns the number of
+    inputs, the paths of the arrays and the size, or None
+    inputs for an empty chunk"""
+    key = _CHUNKS['keys'][index]
+    lines = [line for line in bytes(_CHUNKS['bodies'][index]).decode('utf8').splitlines() if line]
+    if not lines:
+        #An empty chunk has not even a header to preprocess
+        return None, [], 0
+    inputs, outputs, size = _CHUNKS['pre'].preprocess_chunk(key, lines[0], lines[1:])
+    paths = []
+    for i, array in enumerate(list(inputs)+list(outputs)):
+        paths.append(os.path.join(_CHUNKS['out_dir'], '%d_%d.npy' % (index, i)))
+        np.save(paths[-1], np.asarray(array))
+    return len(inputs), paths, size
+
+
+def _load(path):
+    """ Maps an array written by a process of the pool, arrays
+    of python objects cannot be mapped and are read"""
+    try:
+        return np.load(path, mmap_mode='r')
+    except ValueError:
+        return np.load(path, allow_pickle=True)
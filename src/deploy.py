@@ -16,13 +16,14 @@ support is only for the AWS environment"""
 from subprocess import Popen
 import os
 import boto3
+from transfer import TransferEngine
 
 USER = 'ec2-user'
 
 class AWS:
     """ Class for AWS integration and cluster provisioning """
     def __init__(self, expriment_name, iam_role, worker_type, worker_num,
-                 worker_size=100, ps_type='t2.nano'):
+                 worker_size=100, ps_type='t2.nano', ps_num=1):
 
         self.experiments_directory = '../experiments/'+expriment_name
         if os.path.isdir(self.experiments_directory) is False:
@@ -33,6 +34,7 @@ class AWS:
         self.worker_type = worker_type
         self.worker_size = worker_size
         self.ps_type = ps_type
+        self.ps_num = ps_num
         self.ec2 = boto3.client('ec2')
         self.ec2_resource = boto3.resource('ec2')
         self.sg_id = None
@@ -111,6 +113,9 @@ class AWS:
             #res_file.write(' '.join(self.psIp+self.workerIps))
             res_file.write(' '.join(self.all_ips))
             res_file.write('\n')
+            #The first ps_num machines are the parameter servers
+            res_file.write(str(self.ps_num))
+            res_file.write('\n')
         print(".......\nMachine Launch Complete\n.......\n")
 
 
@@ -121,16 +126,16 @@ class AWS:
         self.create_security_group()
         self.create_key()
 
-        #First Launch PS Machine
-        print("Launching PS Machine")
+        #First Launch PS Machines
+        print("Launching PS Machines")
         #Get the ami-id for the most recent Amazon Linux Deep Learning AMI
         ami = os.popen('aws ec2 describe-images --filters "Name=name,Values=Deep Learning AMI (Amazon Linux) Version*" --query \'sort_by(Images, &CreationDate)[-1].ImageId\' --output text').read()[:-1]
 
         ps_response = self.ec2_resource.create_instances(
             ImageId=ami,
             InstanceType=self.ps_type,
-            MinCount=1,
-            MaxCount=1,
+            MinCount=self.ps_num,
+            MaxCount=self.ps_num,
             SecurityGroupIds=[self.sg_id],
             KeyName='easyDist',
             IamInstanceProfile={'Name': self.iam_role}
@@ -190,14 +195,20 @@ class AWS:
         """ Moves all the required easyDist files
         and dependencies to all of the cluster virtual
         machines """
-        for ip_address in self.all_ips:
-            os.system('scp -i ./aux/easyDist.pem -o StrictHostKeyChecking=no' \
-            ' -r ./aux %s@"%s": ' % (USER, ip_address))
-            os.system('scp -i ./aux/easyDist.pem -o StrictHostKeyChecking=no' \
-            ' -r ../tests %s@"%s": ' % (USER, ip_address))
-            for file_name in ['./dataReader.py',
-                              './codeFile.py',
-                              'distExec.py',
-                              self.resource_name]:
-                os.system('scp -i ./aux/easyDist.pem -o StrictHostKeyChecking=no ' \
-                    '-r %s %s@"%s": ' % (file_name, USER, ip_address))
+        files = ['./aux', '../tests',
+                 './data_reader.py',
+                 './codeFile.py',
+                 'dist_exec.py',
+                 'trainer.py',
+                 's3_download.py',
+                 'data_cache.py',
+                 'prefetch.py',
+                 'coordinator.py',
+                 'checkpoint.py',
+                 'profiler.py',
+                 'transfer.py',
+                 'agent.py',
+                 'local_cluster.py',
+                 'preprocess_utils.py',
+                 self.resource_name]
+        return TransferEngine(USER, './aux/easyDist.pem').push(self.all_ips, files)
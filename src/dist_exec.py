@@ -16,54 +16,163 @@ to train the network.
 This module is responsible mainly for graph extraction, transfer
 and the issuance of the training call """
 from __future__ import print_function
+import heapq
 import subprocess
 import os
 import keras.backend as K
 import tensorflow as tf
-import boto3
+from coordinator import connect, give_replicas
+from transfer import TransferEngine
+from agent import AgentPool, start_agents, open_tunnels
+from local_cluster import LocalCluster
+from s3_download import BucketClient
 
 KEY_NAME = 'easyDist.pem'
 USER = 'ec2-user'
+#Files needed by trainer.py on every worker
+WORKER_FILES = ['data_reader.py', 'trainer.py', 's3_download.py', 'data_cache.py',
+                'prefetch.py', 'coordinator.py', 'checkpoint.py',
+                'profiler.py', 'agent.py', 'preprocess_utils.py']
+#Files collected from every worker after training in agent mode
+RESULT_FILES = ['metrics.jsonl', 'GPUlog.csv']
 
 class ExecutionEnvironment:
     """ This class is responsible for extracting the Keras
     graph and using it to set up a distributed tensorflow cluster
     across all the VMs."""
-    def __init__(self, bucket_name, prefix, epochs, batch_size, opt, port="2222",test=False):
+    def __init__(self, bucket_name, prefix, epochs, batch_size, opt, port="2222",test=False,
+                 stream=False, buffer_size=10000, cache_size=10, prefetch=4,
+                 input_mode='feed', dynamic=False, coordinator_port="2223",
+                 sync=False, backup_workers=0, replicas_to_aggregate=0,
+                 keep_checkpoints=3, checkpoint_steps=0, checkpoint_secs=0,
+                 metrics_every=10, launcher='ssh', agent_port="2224",
+                 backend='aws', num_workers=2, ps_num=1, s3_endpoint=None,
+                 preprocess_processes=0, bucket_width=0, padding='pre', compact=False,
+                 allow_float16=False):
         self.epochs = epochs
         self.batch_size = batch_size
         self.opt = opt
         self.test = test
-        worker_ip_file = open("resources.txt", "r")
-        #Extract IP addresses (remove the trailing new line chrachter)
-        self.instance_ids, all_ips = [line[:-1].split() for line in worker_ip_file.readlines()]
-        self.ps_ip = all_ips[0]
-        self.worker_ips = all_ips[1:]
+        #Copies files to all hosts concurrently over reused ssh connections
+        self.transfer_engine = TransferEngine(USER, './aux/'+KEY_NAME)
+        #The 'local' backend runs ps_num parameter servers and num_workers workers
+        #as processes of this machine instead of the machines in resources.txt
+        self.backend = backend
+        self.local_cluster = None
+        if backend == 'local':
+            self.local_cluster = LocalCluster(num_workers, ps_num)
+            self.instance_ids = []
+            self.ps_num = ps_num
+            self.ps_ips = ['localhost']*ps_num
+            self.worker_ips = ['localhost']*num_workers
+            self.ps_hosts = self.local_cluster.give_ps_hosts()
+            self.worker_hosts = self.local_cluster.give_worker_hosts()
+        else:
+            worker_ip_file = open("resources.txt", "r")
+            #Extract IP addresses (remove the trailing new line chrachter)
+            lines = [line.split() for line in worker_ip_file.readlines()]
+            self.instance_ids, all_ips = lines[0], lines[1]
+            #The optional third line holds the number of parameter servers
+            self.ps_num = int(lines[2][0]) if len(lines) > 2 and lines[2] else 1
+            self.ps_ips = all_ips[:self.ps_num]
+            self.worker_ips = all_ips[self.ps_num:]
+            self.ps_hosts = [ip+':'+port for ip in self.ps_ips]
+            self.worker_hosts = [ip+':'+port for ip in self.worker_ips]
+        self.ps_ip = self.ps_ips[0]
+        #Buckets named file://<directory> are read from local disk, s3_endpoint
+        #points to a local stand-in for S3
         self.bucket_name = bucket_name
         if test is False: 
-            self.client = boto3.client('s3')
-            self.data_chunks = [a['Key'] for a in
-                                self.client.list_objects(Bucket=bucket_name, Prefix=prefix)['Contents']]
+            self.client = BucketClient(s3_endpoint)
+            objects = self.client.list_objects(Bucket=bucket_name, Prefix=prefix)['Contents']
+            self.data_chunks = [a['Key'] for a in objects]
+            self.chunk_sizes = [a['Size'] for a in objects]
         else:
             self.data_chunks = ['dummy_1','dummy_2','dummy_3','dummy_4']
+            self.chunk_sizes = [4, 3, 2, 1]
         self.saved = -1
         self.trained = -1
         self.create_graph_directory = True
         self.create_run_directory = True
         self.port = port
         self.executions = []
-        
-    def fit(self):
+        #'agent' runs the jobs through the resident agents of the machines
+        #instead of pssh, agent_port is the port they listen on
+        self.launcher = launcher
+        self.agent_port = agent_port
+        self.run_scripts = {}
+        #Additional trainer.py flags common to all the machines
+        #cache_size is the size in GB of the chunk and preprocessed data caches
+        #of every worker together, split evenly between them (0 disables them)
+        #prefetch is the number of batches prepared ahead of the training step (0 disables it)
+        #input_mode 'tf_data' feeds the graph through a tf.data pipeline instead of feed_dict
+        #Every metrics_every steps workers append their step timings to metrics.jsonl
+        #Workers keep their last keep_checkpoints checkpoints and the best one, besides
+        #the best epochs a checkpoint is taken every checkpoint_steps steps or
+        #checkpoint_secs seconds (0 disables them)
+        #With preprocess_processes > 1 workers preprocess their chunks in parallel with the
+        #preprocess_chunk method of the user's Preprocessing class
+        #With a bucket_width, batches group examples of similar sequence length, the
+        #padding is dropped if the first input of the model has no fixed length. padding
+        #is the side ('pre' or 'post') on which the preprocessing pads the sequences
+        self.trainer_flags = {'cache_size': cache_size, 'prefetch': prefetch,
+                              'input_mode': input_mode, 'keep_checkpoints': keep_checkpoints,
+                              'checkpoint_steps': checkpoint_steps,
+                              'checkpoint_secs': checkpoint_secs,
+                              'metrics_every': metrics_every,
+                              'preprocess_processes': preprocess_processes,
+                              'bucket_width': bucket_width, 'padding': padding}
+        #Address of the coordination services (metrics, dynamic chunks) on the parameter server
+        self.trainer_flags['coordinator'] = self.ps_ip+':'+coordinator_port
+        if self.local_cluster is not None:
+            self.trainer_flags['coordinator'] = self.local_cluster.give_coordinator()
+        if s3_endpoint:
+            self.trainer_flags['s3_endpoint'] = s3_endpoint
+        #With compact workers store their data in the narrowest types that hold it exactly,
+        #float16 only if allow_float16 is set
+        if compact:
+            self.trainer_flags['compact'] = None
+            if allow_float16:
+                self.trainer_flags['allow_float16'] = None
+        #In dynamic mode workers request chunks from the parameter server when they need them
+        self.dynamic = dynamic
+        if dynamic:
+            self.trainer_flags['dynamic'] = None
+        #In sync mode every step aggregates the gradients of replicas_to_aggregate
+        #workers (all but backup_workers by default). Every epoch all the workers
+        #train the number of batches of the worker with the fewest, so that none
+        #waits for the gradients of workers which ran out of data
+        if sync:
+            if dynamic or stream:
+                raise ValueError('sync needs the batch count of every worker upfront and'
+                                 ' cannot be combined with dynamic or stream')
+            give_replicas(len(self.worker_ips), replicas_to_aggregate, backup_workers)
+            self.trainer_flags['sync'] = None
+            self.trainer_flags['backup_workers'] = backup_workers
+            self.trainer_flags['replicas_to_aggregate'] = replicas_to_aggregate
+        if stream:
+            self.trainer_flags['stream'] = None
+            self.trainer_flags['buffer_size'] = buffer_size
+
+    def fit(self, force_transfer=False):
         """ Starts training the network after the graph
-        transfer and tensorflow setup is complete"""
+        transfer and tensorflow setup is complete. Only files
+        that changed since the last fit are sent to the hosts,
+        unless force_transfer is set"""
+        if self.local_cluster is not None:
+            return self.fit_local()
         print("Creating Execution Scripts on Remote Workers")
         self.create_run_scripts()
         self.save_graph()
-        self.transfer_graph()
+        self.transfer_graph(force=force_transfer)
         self.trained += 1
-        execution = Execution(self.trained, self.worker_ips)
-        execution.start_training()
+        execution = Execution(self.trained, self.worker_ips, self.ps_num,
+                              self.trainer_flags['coordinator'])
+        if self.launcher == 'agent':
+            execution.use_agents(self.run_scripts, self.transfer_engine, int(self.agent_port))
+        #Appended first, so that cluster_status queries this training while it runs
         self.executions.append(execution)
+        execution.start_training()
     ''' 
     def status(self, worker, error_file=True, lines=5):
         """Gives the current training status for a single
@@ -71,6 +180,38 @@ class ExecutionEnvironment:
         self.executions[-1].give_status(worker, error_file, lines)
     '''
 
+    def fit_local(self):
+        """ Trains the network on the processes of the local
+        cluster and returns the exit status of every worker"""
+        graph_number = self.save_graph()
+        self.trained += 1
+        commands = {}
+        trainer = self.give_trainer_command(self.local_cluster.give_trainer())
+        for task in range(self.ps_num):
+            #In dynamic mode the first parameter server hands out all the chunks
+            ps_keys = ",".join(self.data_chunks) if self.dynamic and task == 0 else "."
+            commands['ps_%d' % task] = trainer+' -j_name ps -t_id %d --bucket=. --keys=%s' % (
+                task, ps_keys)
+        partitions = partition_chunks(self.data_chunks, self.chunk_sizes, len(self.worker_ips))
+        print_partitions(partitions, dict(zip(self.data_chunks, self.chunk_sizes)))
+        for worker in range(len(self.worker_ips)):
+            commands['worker_%d' % worker] = trainer+' -j_name worker -t_id %d --bucket=%s'\
+                ' --keys=%s --cache_dir=%s' % (
+                    worker, self.bucket_name, ",".join(partitions[worker]),
+                    self.local_cluster.give_cache_dir('worker_%d' % worker))
+        execution = Execution(self.trained, self.worker_ips, self.ps_num,
+                              self.trainer_flags['coordinator'])
+        execution.use_local_cluster(self.local_cluster, commands,
+                                    './graphs/graph%s' % str(graph_number))
+        self.executions.append(execution)
+        execution.start_training()
+        return execution.exit_codes
+
+    def cluster_status(self):
+        """ Returns the live view of the current training
+        collected on the parameter server"""
+        return self.executions[-1].cluster_status()
+
     def save_graph(self):
         """ Extracts the current Keras Computational
         Graph and saves it """
@@ -93,32 +234,55 @@ class ExecutionEnvironment:
         op_names = [str(op.name)+':0' for op in placeholders]
         print('\n\nYour Placeholder Tensors are ', op_names)
         print('Please ensure that this ordering is followed \
-               when in the dataReader File. (Inputs, Outputs, Weights)')
+               when in the data_reader File. (Inputs, Outputs, Weights)')
         print('By Default, the weights are set to 1')
         print('----------------------------------------')
         return self.saved
 
-    def transfer_graph(self, graph_number=-1):
-        """Transfers Most Recent Graph to all VMs """
+    def transfer_graph(self, graph_number=-1, force=False):
+        """Transfers Most Recent Graph to all VMs. The graph and
+        the worker files are compressed and only sent to hosts
+        that do not have the same version yet"""
         if graph_number == -1:
             graph_number = self.saved
-        for i in range(len(self.worker_ips)):
-            print('Transferring')
-            os.system('ssh -i ./aux/%s -o StrictHostKeyChecking=no \
-                %s@"%s" \'mkdir Graph\'' % (KEY_NAME, USER, self.worker_ips[i]))
-
-            os.system('scp -i ./aux/%s -o StrictHostKeyChecking=no \
-                dataReader.py %s@"%s":.' % (KEY_NAME, USER, self.worker_ips[i]))
-
-            os.system('scp -i ./aux/%s -o StrictHostKeyChecking=no \
-                trainer.py %s@"%s":.' % (KEY_NAME, USER, self.worker_ips[i]))
+        #Additional parameter servers run trainer.py as well
+        hosts = self.worker_ips + self.ps_ips[1:]
+        print('Transferring')
+        graph_dir = './graphs/graph%s' % str(graph_number)
+        files = WORKER_FILES + [(os.path.join(graph_dir, name), 'Graph/'+name)
+                                for name in sorted(os.listdir(graph_dir))]
+        #Every host also receives its own run script
+        files_by_host = dict((host, files+[("runscripts/%s.sh" % host, 'run.sh')])
+                             for host in hosts)
+        results = self.transfer_engine.push_each(files_by_host, force=force)
+        for host in hosts:
+            if results[host]['ok']:
+                print('Successfully Transferred Graph to Host ', host)
+            else:
+                print('Failed to Transfer Graph to Host ', host)
+        return results
 
-            if os.system('scp -i ./aux/%s -o StrictHostKeyChecking=no \
-                ./graphs/graph"%s"/* %s@"%s":Graph/.'
-                         % (KEY_NAME, str(graph_number), USER, self.worker_ips[i])) == 0:
-                print('Successfully Transferred Graph to Worker ', i)
+    def give_trainer_flags(self):
+        """ Formats the optional trainer.py flags as
+        command line arguments"""
+        flags = ''
+        for flag, value in sorted(self.trainer_flags.items()):
+            if value is None:
+                flags += ' --%s' % flag
             else:
-                print('Failed to Transfer Graph to Worker ', i)
+                flags += ' --%s=%s' % (flag, str(value))
+        return flags
+
+    def give_trainer_command(self, trainer='python trainer.py'):
+        """ Returns the trainer.py command line shared by all the
+        machines, without the job name, task, bucket and keys"""
+        return """%s \
+        --epochs=%s --batch_size=%s --optimizer=%s --ps_hosts=%s \
+        --worker_hosts=%s%s""" % (trainer, str(self.epochs),
+                                  str(self.batch_size), self.opt,
+                                  ",".join(self.ps_hosts),
+                                  ",".join(self.worker_hosts),
+                                  self.give_trainer_flags())
 
     def create_run_scripts(self):
         """ Creates the run scripts for each machines,
@@ -127,62 +291,161 @@ class ExecutionEnvironment:
         if self.create_run_directory:
             os.system("mkdir runscripts > /dev/null")
             self.create_run_directory = False
-        #Create IP address with ports
-        ps_ip_with_port = self.ps_ip+':'+self.port
-        worker_ips_with_port = [ip+':'+self.port for ip in self.worker_ips]
-
         file_ps = open("run.sh", "w")
         common_string = """mkdir models > /dev/null
         source activate tensorflow_p36
         nvidia-smi --query-gpu=timestamp,name,pci.bus_id,driver_version,pstate,\
         pcie.link.gen.max,pcie.link.gen.current,temperature.gpu,utilization.gpu,\
-        utilization.memory --format=csv -l 30 > GPUlog.csv & python trainer.py \
-        --epochs=%s --batch_size=%s --optimizer=%s --ps_hosts=%s \
-        --worker_hosts=%s""" % (str(self.epochs),
-                                str(self.batch_size), self.opt,
-                                ps_ip_with_port,
-                                ",".join(worker_ips_with_port))
+        utilization.memory --format=csv -l 30 > GPUlog.csv & """+self.give_trainer_command()
 
 
-        ps_string = common_string+""" -j_name ps -t_id 0 --bucket=. --keys=.
+        #In dynamic mode the parameter server hands out all the chunks
+        ps_keys = ",".join(self.data_chunks) if self.dynamic else "."
+        ps_string = common_string+""" -j_name ps -t_id 0 --bucket=. --keys=%s
         zip outs_train.zip ./outs_train/*
         zip errs_train.zip ./errs_train/*
         zip outs_data.zip ./outs_data/*
-        zip ps.zip outs_train.zip outs_data.zip errs_train.zip ip* GPUlog.csv"""
+        zip ps.zip outs_train.zip outs_data.zip errs_train.zip ip* GPUlog.csv""" % ps_keys
         file_ps.write(ps_string)
         file_ps.close()
+        self.run_scripts[self.ps_ip] = ps_string
 
-        chunks_per_worker = len(self.data_chunks)/len(self.worker_ips)
+        #The remaining parameter servers only serve their share of the variables
+        for task, ip_address in enumerate(self.ps_ips[1:], 1):
+            ps_task_string = common_string+""" -j_name ps -t_id %d --bucket=. --keys=.""" % task
+            self.write_run_script(ip_address, ps_task_string)
+
+        partitions = partition_chunks(self.data_chunks, self.chunk_sizes, len(self.worker_ips))
+        print_partitions(partitions, dict(zip(self.data_chunks, self.chunk_sizes)))
 
         for worker, ip_address in enumerate(self.worker_ips):
-            start_index = worker * chunks_per_worker
-            end_index = min((worker+1)*chunks_per_worker, len(self.data_chunks))
-            worker_string = common_string+""" -j_name worker -t_id %s --bucket=%s --keys=%s
-            zip -r m_%s_logs.zip ip* GPU*
+            worker_string = common_string+""" -j_name worker -t_id %s --bucket=%s --keys=%s""" % (
+                str(worker), self.bucket_name, ",".join(partitions[worker]))
+            #The agents collect the checkpoints and logs while the workers train
+            if self.launcher != 'agent':
+                worker_string += """
+            zip -r m_%s_logs.zip ip* GPU* metrics.jsonl
             zip -r m_%s_models.zip log.csv epochLog.csv models/*
-            rm -r models/""" % (str(worker), self.bucket_name,
-                                ",".join(self.data_chunks[int(start_index):int(end_index)]),
-                                str(worker), str(worker))
-            filename = "runscripts/%s.sh"%(ip_address)
-            run_script = open(filename, "w")
-            run_script.write(worker_string)
-            run_script.close()
-            if self.test is False:
-                os.system('scp -i ./aux/%s -o StrictHostKeyChecking=no \
-                    ./"%s" %s@"%s":run.sh' % (KEY_NAME, filename, USER, ip_address))
+            rm -r models/""" % (str(worker), str(worker))
+            self.write_run_script(ip_address, worker_string)
+
+    def write_run_script(self, ip_address, script):
+        """ Writes the run script of a remote machine, which
+        transfer_graph copies to the machine as run.sh"""
+        filename = "runscripts/%s.sh"%(ip_address)
+        run_script = open(filename, "w")
+        run_script.write(script)
+        run_script.close()
+        self.run_scripts[ip_address] = script
+
+
+def partition_chunks(chunks, sizes, num_workers):
+    """ Assigns every chunk to a worker such that the number
+    of bytes per worker is balanced. The chunks are handed out
+    from largest to smallest, each to the currently least loaded
+    worker. Returns the chunks of every worker in their
+    original order"""
+    loads = [(0, worker) for worker in range(num_workers)]
+    assigned = [[] for _ in range(num_workers)]
+    by_size = sorted(range(len(chunks)), key=lambda index: (-sizes[index], index))
+    for index in by_size:
+        load, worker = heapq.heappop(loads)
+        assigned[worker].append(index)
+        heapq.heappush(loads, (load+sizes[index], worker))
+    return [[chunks[index] for index in sorted(indices)] for indices in assigned]
+
+
+def print_partitions(partitions, sizes):
+    """ Prints the number of chunks and bytes assigned
+    to every worker"""
+    total = max(sum(sizes.values()), 1)
+    print('Data Distribution Across Workers')
+    for worker, chunks in enumerate(partitions):
+        load = sum(sizes[chunk] for chunk in chunks)
+        print('Worker %d: %d chunks, %.1f MB (%.1f%%)' % (worker, len(chunks),
+                                                          load/1024.0/1024.0,
+                                                          100.0*load/total))
+    print('----------------------------------------')
 
 
 class Execution:
     """ This class starts and monitors the actual training by
     issuing the required shell commands"""
 
-    def __init__(self, experiment_number, worker_ips):
+    def __init__(self, experiment_number, worker_ips, ps_num=1, coordinator=None):
         self.worker_ips = worker_ips
         self.experiment_number = experiment_number
+        self.ps_num = ps_num
+        self.coordinator = coordinator
+        self.run_scripts = None
+        self.transfer_engine = None
+        self.agent_port = None
+        self.local_cluster = None
+        self.graph_dir = None
+        self.exit_codes = {}
+
+    def use_local_cluster(self, local_cluster, commands, graph_dir):
+        """ Runs the given command of every task (ps_<i>,
+        worker_<i>) on the local cluster"""
+        self.local_cluster = local_cluster
+        self.run_scripts = commands
+        self.graph_dir = graph_dir
+
+    def use_agents(self, run_scripts, transfer_engine, agent_port):
+        """ Launches the run script of every host through its
+        resident agent instead of startTraining.sh"""
+        self.run_scripts = run_scripts
+        self.transfer_engine = transfer_engine
+        self.agent_port = agent_port
 
     def start_training(self):
         """Starts Distributed Tensorflow Training of the graph"""
-        os.system('sh ./aux/startTraining.sh %d'%(self.experiment_number))
+        if self.local_cluster is not None:
+            self.local_cluster.prepare(self.graph_dir, self.run_scripts)
+            self.exit_codes = self.local_cluster.run(
+                self.run_scripts, 'experiments/exp%d' % self.experiment_number)
+            return
+        if self.run_scripts is None:
+            os.system('sh ./aux/startTraining.sh %d %d'%(self.experiment_number, self.ps_num))
+            return
+        hosts = sorted(self.run_scripts)
+        start_agents(self.transfer_engine, hosts, self.agent_port)
+        tunnels, addresses = open_tunnels(self.transfer_engine, hosts, self.agent_port)
+        try:
+            pool = AgentPool(addresses, 'experiments/exp%d' % self.experiment_number)
+            pool.submit(dict((host, {'script': script})
+                             for host, script in self.run_scripts.items()))
+            #All machines run and report back at the same time, the checkpoints
+            #of every worker are copied as soon as they are written
+            worker_dirs = dict((ip, 'experiments/exp%d/worker_%d' % (self.experiment_number, worker))
+                               for worker, ip in enumerate(self.worker_ips))
+            results = dict((ip, dict((name, os.path.join(worker_dir, name))
+                                     for name in RESULT_FILES))
+                           for ip, worker_dir in worker_dirs.items())
+            checkpoint_dirs = dict((ip, os.path.join(worker_dir, 'models'))
+                                   for ip, worker_dir in worker_dirs.items())
+            #The parameter servers serve until they are stopped once the workers are done
+            self.exit_codes = pool.wait(results, checkpoint_dirs, hosts=self.worker_ips)
+        finally:
+            for tunnel in tunnels:
+                tunnel.terminate()
+
+    def cluster_status(self):
+        """ Queries the metrics collector on the parameter
+        server and prints the progress of every worker"""
+        view = connect(self.coordinator).give_cluster_view()
+        print('Global step %d, %.1f samples/sec across %d active workers' % (
+            view['global_step'], view['samples_per_sec'], view['active_workers']))
+        for worker, metrics in sorted(view['workers'].items(), key=lambda item: int(item[0])):
+            print('Worker %s: step %d (lag %d), %.1f samples/sec, loss %.4f, queue %s, %.0f MB,'
+                  ' reported %.0fs ago' % (worker, metrics.get('step', 0), metrics['lag'],
+                                           metrics.get('samples_per_sec', 0.0),
+                                           metrics.get('loss', 0.0),
+                                           metrics.get('queue_depth', '-'),
+                                           metrics.get('memory_mb', 0.0), metrics['age']))
+        if view['slowest_worker'] is not None:
+            print('Slowest worker is ', view['slowest_worker'])
+        return view
     '''
     def give_status(self, worker, error_file=True, lines=5):
         """Gives the current training status for a single worker"""
@@ -31,6 +31,7 @@ class EasydistUi(QWidget):
         self.ps_type = None
         self.worker_type = None
         self.worker_number = None
+        self.ps_number = None
         self.iam_role = None
 
         self.init_ui()
@@ -152,13 +153,14 @@ class EasydistUi(QWidget):
         self.ps_type = QComboBox(self)
         for item in ps_machines:
             self.ps_type.addItem(item)
-        ps_number = QComboBox(self)
-        ps_number.addItem("1")
+        self.ps_number = QComboBox(self)
+        for i in range(1, 5):
+            self.ps_number.addItem(str(i))
         ps_size = QLineEdit(self)
         ps_size.setText('75')
         grid1.addWidget(QLabel("Parameter Server", self), 0, 1)
         grid1.addWidget(self.ps_type, 1, 1)
-        grid1.addWidget(ps_number, 2, 1)
+        grid1.addWidget(self.ps_number, 2, 1)
         grid1.addWidget(ps_size, 3, 1)
 
         worker_machines = ['--select--', 'c3.2xlarge', 'p2.xlarge', 'p3.2xlarge', 'c5.xlarge', 't2.nano']
@@ -200,12 +202,14 @@ class EasydistUi(QWidget):
         worker_number = int(self.worker_number.currentText())
 
         ps_type = self.ps_type.currentText()
+        ps_number = int(self.ps_number.currentText())
 
         exp_name = self.exp_name.text()
         iam_role = self.iam_role.currentText()
-        print(exp_name, iam_role, worker_type, worker_number, ps_type)
+        print(exp_name, iam_role, worker_type, worker_number, ps_type, ps_number)
 
-        self.cluster = AWS(exp_name, iam_role, worker_type, worker_number, ps_type=ps_type)
+        self.cluster = AWS(exp_name, iam_role, worker_type, worker_number, ps_type=ps_type,
+                           ps_num=ps_number)
         self.cluster.launch()
 
     def terminate_machines(self):
@@ -0,0 +1,121 @@
+# Copyright (c) 2019 American Express Travel Related Services Company, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except
+# in compliance with the License. You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License
+# is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+# or implied. See the License for the specific language governing permissions and limitations under
+# the License.
+
+""" This module runs the parameter servers and workers of
+a training as processes of the local machine, each on its own
+localhost port and in its own work directory. It lets the same
+ExecutionEnvironment be used without any cloud machines"""
+from __future__ import print_function
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import time
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def give_free_port():
+    """ Returns a localhost port which is currently free"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('localhost', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class LocalCluster:
+    """ Holds the ports and work directories of a local cluster
+    with ps_num parameter servers and num_workers workers"""
+    def __init__(self, num_workers, ps_num=1, work_dir='./local_cluster'):
+        self.num_workers = num_workers
+        self.ps_num = ps_num
+        self.work_dir = os.path.abspath(work_dir)
+        self.ps_ports = [give_free_port() for _ in range(ps_num)]
+        self.worker_ports = [give_free_port() for _ in range(num_workers)]
+        self.coordinator_port = give_free_port()
+
+    def give_ps_hosts(self):
+        """ Returns the parameter server addresses"""
+        return ['localhost:%d' % port for port in self.ps_ports]
+
+    def give_worker_hosts(self):
+        """ Returns the worker addresses"""
+        return ['localhost:%d' % port for port in self.worker_ports]
+
+    def give_coordinator(self):
+        """ Returns the address of the coordination services"""
+        return 'localhost:%d' % self.coordinator_port
+
+    def give_trainer(self):
+        """ Returns the command starting trainer.py"""
+        return '%s -u %s' % (sys.executable, os.path.join(SRC_DIR, 'trainer.py'))
+
+    def give_task_dir(self, task):
+        """ Returns the work directory of a task such as worker_0"""
+        return os.path.join(self.work_dir, task)
+
+    def give_cache_dir(self, task):
+        """ Returns the data cache directory of a task, which
+        outlives its work directory so that later trainings
+        reuse it, and is not shared with the other workers"""
+        return os.path.join(self.work_dir, 'cache', task)
+
+    def prepare(self, graph_dir, tasks):
+        """ Creates a fresh work directory for every task holding
+        a copy of the graph and a models directory, as the
+        machines of a cluster would"""
+        for task in tasks:
+            task_dir = self.give_task_dir(task)
+            if os.path.isdir(task_dir):
+                shutil.rmtree(task_dir)
+            os.makedirs(os.path.join(task_dir, 'models'))
+            shutil.copytree(graph_dir, os.path.join(task_dir, 'Graph'))
+
+    def run(self, commands, log_dir):
+        """ Starts the shell command of every task (ps_<i> or
+        worker_<i>), waits for the workers and then stops the
+        parameter servers, which serve until killed. The output
+        of every task goes to log_dir. Returns the exit status of
+        every worker"""
+        if not os.path.isdir(log_dir):
+            os.makedirs(log_dir)
+        env = dict(os.environ)
+        #The modules of easyDist and the user's preprocessing file
+        paths = [SRC_DIR, os.getcwd()]
+        if env.get('PYTHONPATH'):
+            paths.append(env['PYTHONPATH'])
+        env['PYTHONPATH'] = os.pathsep.join(paths)
+        processes = {}
+        logs = []
+        try:
+            for task in sorted(commands):
+                log = open(os.path.join(log_dir, task+'.log'), 'wb')
+                logs.append(log)
+                #exec so that terminating the shell stops the task itself
+                processes[task] = subprocess.Popen('exec '+commands[task], shell=True, env=env,
+                                                   cwd=self.give_task_dir(task),
+                                                   stdout=log, stderr=subprocess.STDOUT)
+            start = time.time()
+            exit_codes = dict((task, process.wait()) for task, process in processes.items()
+                              if task.startswith('worker'))
+            print('Local training finished in %.1fs with exit status %s' % (
+                time.time()-start, exit_codes))
+            return exit_codes
+        finally:
+            for process in processes.values():
+                if process.poll() is None:
+                    process.terminate()
+                    process.wait()
+            for log in logs:
+                log.close()
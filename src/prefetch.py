@@ -0,0 +1,117 @@
+# Copyright (c) 2019 American Express Travel Related Services Company, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except
+# in compliance with the License. You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License
+# is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+# or implied. See the License for the specific language governing permissions and limitations under
+# the License.
+
+""" This module prepares the batches of a worker in the
+background so that assembling the next batches overlaps
+with the training step that is currently running"""
+from __future__ import print_function
+import multiprocessing
+import threading
+import time
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+_DONE = '__easydist_done__'
+
+class Prefetcher:
+    """ Iterates over batches produced ahead of time by a
+    background thread, or by a forked process if the batches
+    are expensive to decode. At most depth batches are kept
+    in the queue. The queue statistics tell if training is
+    input bound (the queue is mostly empty) or compute bound
+    (the queue is mostly full).
+    The process is forked from the training process, whose
+    TensorFlow session is running by then. It must only run
+    the python and numpy code of the batches, never TensorFlow,
+    as locks held by the threads of the session are not
+    released in the forked process"""
+    def __init__(self, batches, depth=4, use_process=False):
+        self.depth = depth
+        self.gets = 0
+        self.empty_gets = 0
+        self.total_depth = 0
+        self.wait_time = 0.0
+        if use_process:
+            self.queue = multiprocessing.Queue(depth)
+            self.stop_event = multiprocessing.Event()
+            self.producer = multiprocessing.Process(target=_produce,
+                                                    args=(batches, self.queue, self.stop_event))
+        else:
+            self.queue = queue.Queue(depth)
+            self.stop_event = threading.Event()
+            self.producer = threading.Thread(target=_produce,
+                                             args=(batches, self.queue, self.stop_event))
+        self.producer.daemon = True
+        self.producer.start()
+
+    def __iter__(self):
+        while True:
+            current_depth = self.give_depth() or 0
+            start = time.time()
+            kind, item = self.queue.get()
+            self.wait_time += time.time()-start
+            if kind == _DONE:
+                break
+            if kind == 'error':
+                raise item
+            self.gets += 1
+            self.total_depth += current_depth
+            if current_depth == 0:
+                self.empty_gets += 1
+            yield item
+        self.producer.join()
+
+    def give_depth(self):
+        """ Returns the number of batches in the queue, or None
+        where the size of a process queue is not available
+        (macOS)"""
+        try:
+            return self.queue.qsize()
+        except NotImplementedError:
+            return None
+
+    def close(self):
+        """ Stops the producer if the batches are not
+        consumed until the end"""
+        self.stop_event.set()
+
+    def give_stats(self):
+        """ Returns the queue statistics of the batches
+        consumed so far"""
+        gets = max(self.gets, 1)
+        empty_fraction = float(self.empty_gets)/gets
+        return {'batches': self.gets,
+                'depth': self.depth,
+                'mean_queue_depth': float(self.total_depth)/gets,
+                'empty_fraction': empty_fraction,
+                'wait_seconds': self.wait_time,
+                'bound': 'input' if empty_fraction > 0.5 else 'compute'}
+
+
+def _produce(batches, batch_queue, stop_event):
+    """ Puts the batches into the queue until they are
+    exhausted or the consumer stops the prefetching"""
+    try:
+        for batch in batches:
+            while not stop_event.is_set():
+                try:
+                    batch_queue.put(('batch', batch), timeout=1)
+                    break
+                except queue.Full:
+                    continue
+            if stop_event.is_set():
+                return
+        batch_queue.put((_DONE, None))
+    except Exception as error: # pylint: disable=broad-except
+        batch_queue.put(('error', error))
@@ -0,0 +1,105 @@
+# Copyright (c) 2019 American Express Travel Related Services Company, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except
+# in compliance with the License. You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License
+# is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+# or implied. See the License for the specific language governing permissions and limitations under
+# the License.
+
+""" This module records where the time of every training
+step of a worker goes and appends the samples to a JSON
+lines metrics file"""
+from __future__ import print_function
+import collections
+import contextlib
+import json
+import time
+import numpy as np
+
+class StepProfiler:
+    """ Accumulates the time spent in the phases of a step
+    (data fetch, feed construction, sess.run, waits...).
+    Every sample_every steps a JSON line with the phase times,
+    the samples per second, the step time percentiles over
+    the last window steps and the loss is appended to path"""
+    def __init__(self, path, batch_size, worker=0, sample_every=10, window=500):
+        self.batch_size = batch_size
+        self.worker = worker
+        self.sample_every = max(sample_every, 1)
+        self.metrics_file = open(path, 'a') if path else None
+        self.step_times = collections.deque(maxlen=window)
+        self.phases = collections.defaultdict(float)
+        self.steps = 0
+        self.step_start = time.time()
+        self.last_sample = None
+
+    def start_step(self):
+        """ Starts timing a step, time since the end of the
+        previous step is not attributed to it"""
+        self.phases = collections.defaultdict(float)
+        self.step_start = time.time()
+
+    def add(self, name, seconds):
+        """ Adds time to a phase of the current step"""
+        self.phases[name] += seconds
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """ Times the enclosed block as a phase of the current step"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time()-start)
+
+    def timed(self, iterable, name):
+        """ Iterates over iterable and times each next()
+        as a phase of the step it belongs to"""
+        iterator = iter(iterable)
+        while True:
+            start = time.time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.add(name, time.time()-start)
+            yield item
+
+    def end_step(self, step, loss, **extra):
+        """ Closes the current step and writes a sample if
+        it is one of the sampled steps. Returns the sample
+        or None"""
+        now = time.time()
+        sample = None
+        step_time = now-self.step_start
+        self.step_times.append(step_time)
+        self.steps += 1
+        if self.steps % self.sample_every == 0:
+            percentiles = np.percentile(self.step_times, [50, 90, 99])
+            sample = {'time': now,
+                      'worker': self.worker,
+                      'step': int(step),
+                      'local_step': self.steps,
+                      'loss': float(loss),
+                      'step_time': step_time,
+                      'samples_per_sec': self.batch_size/max(step_time, 1e-9),
+                      'step_time_p50': float(percentiles[0]),
+                      'step_time_p90': float(percentiles[1]),
+                      'step_time_p99': float(percentiles[2]),
+                      'phases': dict(self.phases)}
+            sample.update(extra)
+            self.last_sample = sample
+            if self.metrics_file is not None:
+                self.metrics_file.write(json.dumps(sample)+'\n')
+                self.metrics_file.flush()
+        self.start_step()
+        return sample
+
+    def close(self):
+        """ Closes the metrics file"""
+        if self.metrics_file is not None:
+            self.metrics_file.close()
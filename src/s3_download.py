@@ -0,0 +1,241 @@
+# Copyright (c) 2019 American Express Travel Related Services Company, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except
+# in compliance with the License. You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License
+# is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+# or implied. See the License for the specific language governing permissions and limitations under
+# the License.
+
+""" This module downloads the training chunks of a
+worker from S3. The objects are fetched concurrently
+and large objects are split into byte ranges which
+are downloaded in parallel. Buckets named file://<directory>
+are read from the local file system instead of S3"""
+from __future__ import print_function
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import boto3
+from botocore.exceptions import ClientError
+
+MB = 1024*1024
+LOCAL_PREFIX = 'file://'
+
+
+class LocalBody:
+    """ Stands in for the streaming body of an S3 object"""
+    def __init__(self, path, first=0, last=None):
+        self.file = open(path, 'rb')
+        self.file.seek(first)
+        self.remaining = None if last is None else last-first+1
+
+    def read(self, size=-1):
+        """ Reads the remaining bytes of the body"""
+        if self.remaining is not None:
+            size = self.remaining if size < 0 else min(size, self.remaining)
+        data = self.file.read(size)
+        if self.remaining is not None:
+            self.remaining -= len(data)
+        if not data:
+            self.file.close()
+        return data
+
+    def iter_lines(self):
+        """ Yields the lines of the body without line endings"""
+        with self.file:
+            for line in self.file:
+                yield line.rstrip(b'\r\n')
+
+
+class LocalClient:
+    """ Serves the S3 calls used by easyDist from a local
+    directory, the bucket being file://<directory>"""
+    @staticmethod
+    def give_path(bucket, key=''):
+        """ Returns the local path of an object"""
+        return os.path.join(bucket[len(LOCAL_PREFIX):], key)
+
+    def head_object(self, Bucket, Key):
+        """ Returns the size and a version tag of a file"""
+        stat = os.stat(self.give_path(Bucket, Key))
+        return {'ContentLength': stat.st_size,
+                'ETag': '"%d-%d"' % (stat.st_size, int(stat.st_mtime*1e6))}
+
+    def get_object(self, Bucket, Key, Range=None, IfMatch=None):
+        """ Returns the body of a file or of a byte range. Like
+        S3, fails with PreconditionFailed if IfMatch is not the
+        current ETag"""
+        path = self.give_path(Bucket, Key)
+        if IfMatch is not None and IfMatch != self.head_object(Bucket, Key)['ETag']:
+            raise ClientError({'Error': {'Code': 'PreconditionFailed',
+                                         'Message': '%s changed' % Key}}, 'GetObject')
+        if Range is None:
+            return {'Body': LocalBody(path)}
+        first, last = Range[len('bytes='):].split('-')
+        return {'Body': LocalBody(path, int(first), int(last))}
+
+    def list_objects(self, Bucket, Prefix=''):
+        """ Lists the files below the bucket directory whose
+        relative path starts with Prefix"""
+        root = self.give_path(Bucket)
+        contents = []
+        for directory, _, file_names in os.walk(root):
+            for file_name in file_names:
+                path = os.path.join(directory, file_name)
+                key = os.path.relpath(path, root).replace(os.sep, '/')
+                if key.startswith(Prefix):
+                    contents.append({'Key': key, 'Size': os.path.getsize(path)})
+        return {'Contents': sorted(contents, key=lambda content: content['Key'])}
+
+
+class BucketClient:
+    """ Sends the calls for file:// buckets to a LocalClient
+    and all others to S3. endpoint_url points the S3 client
+    to a local stand-in for S3"""
+    def __init__(self, endpoint_url=None):
+        self.endpoint_url = endpoint_url
+        self.local = LocalClient()
+        self.s3 = None
+
+    def give_client(self, bucket):
+        """ Returns the client serving a bucket"""
+        if bucket.startswith(LOCAL_PREFIX):
+            return self.local
+        if self.s3 is None:
+            self.s3 = boto3.client('s3', endpoint_url=self.endpoint_url)
+        return self.s3
+
+    def head_object(self, Bucket, Key):
+        """ See LocalClient.head_object"""
+        return self.give_client(Bucket).head_object(Bucket=Bucket, Key=Key)
+
+    def get_object(self, Bucket, Key, **kwargs):
+        """ See LocalClient.get_object"""
+        return self.give_client(Bucket).get_object(Bucket=Bucket, Key=Key, **kwargs)
+
+    def list_objects(self, Bucket, Prefix=''):
+        """ See LocalClient.list_objects"""
+        return self.give_client(Bucket).list_objects(Bucket=Bucket, Prefix=Prefix)
+
+
+def is_precondition_failed(error):
+    """ Tells if a request failed because the object no
+    longer has the ETag given by IfMatch (HTTP 412)"""
+    response = getattr(error, 'response', None) or {}
+    return response.get('Error', {}).get('Code') in ('PreconditionFailed', '412')
+
+
+class Downloader:
+    """ Fetches several S3 objects at once using a thread
+    pool. The size of the pool bounds the number of
+    requests in flight. If a ChunkCache is given, objects
+    whose ETag is cached are read from local disk instead"""
+    def __init__(self, client=None, max_in_flight=8, part_size=8*MB, cache=None):
+        self.client = client if client is not None else BucketClient()
+        self.max_in_flight = max_in_flight
+        self.part_size = part_size
+        self.cache = cache
+        #Per key download statistics of the last fetch
+        self.stats = {}
+
+    def head(self, bucket, key):
+        """ Returns the size and ETag of an object"""
+        response = self.client.head_object(Bucket=bucket, Key=key)
+        return response['ContentLength'], response['ETag']
+
+    def heads(self, bucket, keys):
+        """ Returns the (size, ETag) of all the given keys"""
+        with ThreadPoolExecutor(max_workers=self.max_in_flight) as pool:
+            return list(pool.map(lambda key: self.head(bucket, key), keys))
+
+    def fetch(self, bucket, keys, heads=None, attempts=3):
+        """ Downloads the given keys and returns their
+        contents in the order of keys. heads can be passed
+        if the sizes and ETags are already known. Every range
+        must match the ETag of the head, objects overwritten
+        during the download are downloaded again as a whole,
+        up to attempts times"""
+        self.stats = {}
+        if heads is None:
+            heads = self.heads(bucket, keys)
+        with ThreadPoolExecutor(max_workers=self.max_in_flight) as pool:
+            bodies = []
+            remaining = {}
+            futures = {}
+            for key, (size, etag) in zip(keys, heads):
+                cached = self.cache.get(bucket, key, etag) if self.cache is not None else None
+                if cached is not None:
+                    print('Read %s from the local cache' % key)
+                    self.stats[key] = {'bytes': size, 'cached': True}
+                    bodies.append(cached)
+                    continue
+                body = bytearray(size)
+                bodies.append(body)
+                ranges = self.give_ranges(size)
+                remaining[key] = len(ranges)
+                self.stats[key] = {'bytes': size}
+                for first, last in ranges:
+                    future = pool.submit(self._get_range, bucket, key, etag, first, last)
+                    futures[future] = (key, body, first)
+            for key in remaining:
+                if remaining[key] == 0:
+                    self._finish(key)
+            changed = set()
+            for future in as_completed(futures):
+                key, body, first = futures[future]
+                try:
+                    data = future.result()
+                except ClientError as error:
+                    if not is_precondition_failed(error):
+                        raise
+                    changed.add(key)
+                    continue
+                body[first:first+len(data)] = data
+                remaining[key] -= 1
+                if remaining[key] == 0:
+                    self._finish(key)
+        if self.cache is not None:
+            for key, (_, etag), body in zip(keys, heads, bodies):
+                if key in remaining and key not in changed:
+                    self.cache.put(bucket, key, etag, body)
+        if changed:
+            if attempts <= 1:
+                raise RuntimeError('%s kept changing while being downloaded' % sorted(changed))
+            print('%s changed while being downloaded, downloading again' % sorted(changed))
+            stats = self.stats
+            changed_keys = [key for key in keys if key in changed]
+            fresh = dict(zip(changed_keys, self.fetch(bucket, changed_keys, attempts=attempts-1)))
+            stats.update(self.stats)
+            self.stats = stats
+            for key in changed_keys:
+                self.stats[key]['changed'] = True
+            bodies = [fresh.get(key, body) for key, body in zip(keys, bodies)]
+        return bodies
+
+    def give_ranges(self, size):
+        """ Splits an object of the given size into inclusive
+        byte ranges of at most part_size bytes"""
+        return [(first, min(first+self.part_size, size)-1)
+                for first in range(0, size, self.part_size)]
+
+    def _get_range(self, bucket, key, etag, first, last):
+        """ Downloads a single byte range of an object, which
+        must still have the given ETag"""
+        #The throughput of a key is measured from its first request
+        self.stats[key].setdefault('start', time.time())
+        response = self.client.get_object(Bucket=bucket, Key=key, IfMatch=etag,
+                                          Range='bytes=%d-%d' % (first, last))
+        return response['Body'].read()
+
+    def _finish(self, key):
+        """ Records and reports the throughput for a key"""
+        stats = self.stats[key]
+        stats['seconds'] = max(time.time()-stats.pop('start', time.time()), 1e-6)
+        stats['mb_per_sec'] = stats['bytes']/MB/stats['seconds']
+        print('Downloaded %s (%.1f MB) in %.2fs at %.1f MB/s' % (key, stats['bytes']/MB,
+                                                              stats['seconds'],
+                                                              stats['mb_per_sec']))
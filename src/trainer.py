@@ -16,10 +16,18 @@ into it and then trains it using the data given
 to it by data_reader.py"""
 from __future__ import print_function
 import argparse
+import itertools
 import time
+import numpy as np
 import keras.backend as K
 import tensorflow as tf
 from data_reader import Dataset
+from data_cache import GB
+from prefetch import Prefetcher
+from coordinator import ChunkDispatcher, MetricsCollector, MetricsReporter, StepAgreement, \
+    serve, remote_chunks, agree_steps, give_replicas
+from checkpoint import Checkpointer
+from profiler import StepProfiler
 
 def main():
     """ The main driver function which creates
@@ -36,11 +44,21 @@ def main():
 
     cluster = tf.train.ClusterSpec({"ps":ps_hosts, "worker":worker_hosts})
     #Creating Tensorflow Cluster Specification
-    server = tf.train.Server(cluster, job_name=FLAGS.job_name, task_index=FLAGS.task_index)
-    #Create a server object for individual machines
 
 
     if FLAGS.job_name == "ps":
+        #Create a server object for individual machines
+        server = tf.train.Server(cluster, job_name=FLAGS.job_name, task_index=FLAGS.task_index)
+        if FLAGS.coordinator and FLAGS.task_index == 0:
+            #Collect the metrics of the workers and hand out the chunks on demand
+            services = [MetricsCollector()]
+            if FLAGS.dynamic:
+                services.append(ChunkDispatcher(keys))
+            if FLAGS.sync:
+                services.append(StepAgreement(len(worker_hosts)))
+            #Only on the interface of the cluster address, unless told otherwise
+            host, port = FLAGS.coordinator.rsplit(':', 1)
+            serve(FLAGS.coordinator_bind or host, port, services)
         server.join()
 
     elif FLAGS.job_name == "worker":
@@ -48,12 +66,45 @@ def main():
         epochs = FLAGS.epochs
         batch_size = FLAGS.batch_size
 
+        #Initialize data class (See data_reader.py)
+        data = Dataset(max_in_flight=FLAGS.max_in_flight, cache_dir=FLAGS.cache_dir,
+                       cache_size=int(FLAGS.cache_size*GB), memmap_dir=FLAGS.memmap_dir,
+                       s3_endpoint=FLAGS.s3_endpoint,
+                       processes=FLAGS.preprocess_processes, bucket_width=FLAGS.bucket_width,
+                       padding=FLAGS.padding, compact=FLAGS.compact, allow_float16=FLAGS.allow_float16)
+        tf_data = FLAGS.input_mode == 'tf_data'
+        #Read the related chunks
+        if FLAGS.stream or FLAGS.dynamic:
+            #Chunks are streamed from S3 or handed out by the parameter server
+            #every epoch, the batch count is not known upfront
+            read_time = 0
+            num_batches = 'unknown'
+        else:
+            read_time = data.read_data(bucket, keys)
+            num_batches = int(data.give_num_batches(batch_size))
+        #The server is only started once the data is read, read_data may fork
+        #processes which must not inherit the threads of the server
+        server = tf.train.Server(cluster, job_name=FLAGS.job_name, task_index=FLAGS.task_index)
+
+        #Spread the variables over the parameter servers by their size in bytes, so that
+        #a large embedding does not share a parameter server with the other variables
+        ps_strategy = tf.contrib.training.GreedyLoadBalancingStrategy(
+            len(ps_hosts), tf.contrib.training.byte_size_load_fn)
         with tf.device(tf.train.replica_device_setter( \
                 worker_device="/job:worker/task:%d" % FLAGS.task_index,
-                cluster=cluster)):
+                cluster=cluster, ps_strategy=ps_strategy)):
 
             #Import the Computational Graph for Model to be trained
-            saved = tf.train.import_meta_graph('./Graph/Graph.meta', clear_devices=True)
+            meta_graph_def = tf.MetaGraphDef()
+            with open('./Graph/Graph.meta', 'rb') as meta_file:
+                meta_graph_def.ParseFromString(meta_file.read())
+            input_map = None
+            if tf_data:
+                #The placeholders of the graph are replaced by the outputs of a tf.data iterator
+                iterator, iterator_feed, input_map = build_input_pipeline(data, meta_graph_def,
+                                                                          batch_size)
+            saved = tf.train.import_meta_graph(meta_graph_def, clear_devices=True,
+                                               input_map=input_map)
             graph = tf.get_default_graph()
 
             #Obtain Placeholders to be fed into graph while training
@@ -62,6 +113,19 @@ def main():
             op_names = [str(op.name)+':0' for op in placeholders]
             feed_dict_keys = [graph.get_tensor_by_name(op) \
                               for op in op_names] + [K.learning_phase()]
+            if FLAGS.compact:
+                #Batches of the compact arrays are cast back to the placeholder types
+                data.feed_dtypes = [tensor.dtype.as_numpy_dtype for tensor in feed_dict_keys[:-1]]
+            if FLAGS.bucket_width > 0:
+                #Padding is only dropped if the model takes sequences of any length
+                shape = feed_dict_keys[0].shape
+                data.trim = shape.ndims is not None and shape.ndims > 1 and \
+                    shape.as_list()[1] is None
+                if not FLAGS.dynamic:
+                    efficiency = data.give_padding_efficiency(batch_size)
+                    print('Padding efficiency %.1f%% padded, %.1f%% with buckets of %d tokens'
+                          % (100*efficiency['padded'], 100*efficiency['bucketed'],
+                             FLAGS.bucket_width))
 
             #Obtain Loss Tensor from Graph Definition and wrap it in an optimizer
             loss_name = [op.name +':0'  for op in graph.get_operations() if 'loss' in op.name][-1]
@@ -69,6 +133,17 @@ def main():
 
 
             optimizer = tf.train.AdamOptimizer(learning_rate=0.0001)
+            is_chief = FLAGS.task_index == 0
+            if FLAGS.sync:
+                #Aggregate the gradients of the fastest replicas every step, the gradients
+                #of the backup workers that arrive last are dropped
+                replicas = give_replicas(len(worker_hosts), FLAGS.replicas_to_aggregate,
+                                         FLAGS.backup_workers)
+                print('Synchronous training aggregating %d of %d workers' % (replicas,
+                                                                            len(worker_hosts)))
+                optimizer = tf.train.SyncReplicasOptimizer(optimizer,
+                                                           replicas_to_aggregate=replicas,
+                                                           total_num_replicas=len(worker_hosts))
 
 
             global_step = tf.train.create_global_step()
@@ -79,23 +154,38 @@ def main():
 
             #Global step to co-ordinate training across all workers
 
-            #Initialize data class (See data_reader.py) and read the related chunks
-            data = Dataset()
-            read_time = data.read_data(bucket, keys)
-
-
-            num_batches = int(data.give_num_batches(batch_size))
-
-
             init_op = tf.global_variables_initializer()
+            local_init_op = tf.train.Supervisor.USE_DEFAULT
+            ready_for_local_init_op = tf.train.Supervisor.USE_DEFAULT
+            if FLAGS.sync:
+                #Set up the local steps and the token queue of the synchronous optimizer
+                local_init_op = optimizer.chief_init_op if is_chief else optimizer.local_step_init_op
+                ready_for_local_init_op = optimizer.ready_for_local_init_op
+                chief_queue_runner = optimizer.get_chief_queue_runner()
+                sync_init_op = optimizer.get_init_tokens_op()
+
+            #Checkpoints are written in the background from a snapshot on this worker
+            checkpointer = Checkpointer("/job:worker/task:%d" % FLAGS.task_index,
+                                        keep=FLAGS.keep_checkpoints,
+                                        every_steps=FLAGS.checkpoint_steps,
+                                        every_secs=FLAGS.checkpoint_secs)
 
             #Create a TensorFlow training supervisor which will
             #coordinate across all the worker and the parameter server
-            tf_supervisor = tf.train.Supervisor(is_chief=(FLAGS.task_index == 0),
+            tf_supervisor = tf.train.Supervisor(is_chief=is_chief,
                                                 logdir='./models/',
                                                 global_step=global_step,
-                                                init_op=init_op)
-
+                                                init_op=init_op,
+                                                local_init_op=local_init_op,
+                                                ready_for_local_init_op=ready_for_local_init_op)
+
+        #Per step timings of this worker
+        profiler = StepProfiler(FLAGS.metrics_file, batch_size, worker=FLAGS.task_index,
+                                sample_every=FLAGS.metrics_every)
+        reporter = None
+        if FLAGS.coordinator:
+            #Stream the latest metrics to the parameter server while training
+            reporter = MetricsReporter(FLAGS.coordinator, FLAGS.task_index, FLAGS.report_secs)
         avg_ep = 0 #To keep track of average epoch loss
         min_loss = -1 #Will be updated with lowest loss
         step = 0 #To keep track of the global step across all machines
@@ -103,6 +193,11 @@ def main():
         with tf_supervisor.prepare_or_wait_for_session(server.target) as sess:
             #Restore the weight values of the imported graph within the supervisor session
             saved.restore(sess, tf.train.latest_checkpoint('./Graph/.'))
+            if FLAGS.sync and is_chief:
+                #The chief fills the token queue and applies the aggregated gradients
+                sess.run(sync_init_op)
+                tf_supervisor.start_queue_runners(sess, [chief_queue_runner])
+            checkpointer.start(sess)
             print('Your Input Tensors Are: ', " , ".join(op_names))
             print('Your Loss Tensor is ', loss_name)
             print(num_batches, " are there")
@@ -111,14 +206,49 @@ def main():
                 epoch_cost = 0
 
                 #----------------Epoch Start----------------------
-                for i in range(num_batches):
-
-                    feed_dict_values = data.give_next(batch_size, i) + [1]
-                    feed_dict = dict(zip(feed_dict_keys, feed_dict_values))
-
-                    _, step, cost = sess.run([train_op, global_step, cost_op], feed_dict=feed_dict)
+                if tf_data:
+                    #Batches come from the iterator until it is exhausted
+                    sess.run(iterator.initializer, feed_dict=iterator_feed)
+                    batches = itertools.repeat([])
+                else:
+                    batches = give_batches(data, bucket, keys, batch_size, epoch)
+                if FLAGS.sync:
+                    #All the workers train the same number of steps, the smallest batch count
+                    steps = agree_steps(FLAGS.coordinator, FLAGS.task_index, epoch,
+                                        int(data.give_num_batches(batch_size)))
+                    batches = itertools.islice(batches, steps)
+                fetch_phase = 'fetch'
+                if FLAGS.prefetch > 0 and not tf_data:
+                    #Assemble the next batches while the current step runs
+                    batches = Prefetcher(batches, FLAGS.prefetch, FLAGS.prefetch_process)
+                    fetch_phase = 'wait'
+                profiler.start_step()
+                for i, batch in enumerate(profiler.timed(batches, fetch_phase)):
+
+                    with profiler.phase('feed'):
+                        if tf_data:
+                            feed_dict = {K.learning_phase(): 1}
+                        else:
+                            feed_dict_values = batch + [1]
+                            feed_dict = dict(zip(feed_dict_keys, feed_dict_values))
+
+                    with profiler.phase('run'):
+                        try:
+                            _, step, cost = sess.run([train_op, global_step, cost_op],
+                                                     feed_dict=feed_dict)
+                        except tf.errors.OutOfRangeError:
+                            break
 
                     epoch_cost = epoch_cost+cost
+                    with profiler.phase('checkpoint'):
+                        checkpointer.maybe_save(sess, step)
+                    if FLAGS.prefetch > 0 and not tf_data:
+                        sample = profiler.end_step(step, cost, epoch=epoch,
+                                                   queue_depth=batches.give_depth())
+                    else:
+                        sample = profiler.end_step(step, cost, epoch=epoch)
+                    if sample is not None and reporter is not None:
+                        reporter.update(sample)
 
                     if i%500 == 0:
                     #Print Current Progress in Epoch after every 500 batches
@@ -135,13 +265,26 @@ def main():
 
                 print('Finished Epoch ', epoch, ' in ', epoch_total_time)
                 print('At step ', step, ' ; Epoch Loss was ', epoch_cost)
+                if FLAGS.prefetch > 0 and not tf_data:
+                    stats = batches.give_stats()
+                    print('Prefetch queue: mean depth %.2f of %d, empty on %.0f%% of the steps,'
+                          ' waited %.2fs; training is %s bound' % (stats['mean_queue_depth'],
+                                                                  stats['depth'],
+                                                                  100*stats['empty_fraction'],
+                                                                  stats['wait_seconds'],
+                                                                  stats['bound']))
 
                 if min_loss == -1 or min_loss > epoch_cost:
                     min_loss = epoch_cost
-                    save_model(sess, tf_supervisor, step)
+                    checkpointer.save(sess, step, best=True)
 
                 print('**************************************')
 
+            #Wait for the last checkpoints to be written
+            checkpointer.close(sess)
+            profiler.close()
+            if reporter is not None:
+                reporter.close()
             print('Total time taken was ', time.time()-start_time)
             print('Time Taken to Pre-Process Data was ', read_time)
             print('Average Epoch Training Time was', float(avg_ep)/float(epochs))
@@ -149,13 +292,57 @@ def main():
             print('-*-*-*-*-*-*-*-*-*')
 
 
-def save_model(sess, tf_supervisor, step):
-    """ Saves the current model (graph + weights) as the
-    epochs proceed"""
-    tf.train.write_graph(graph_or_graph_def=sess.graph_def,
-                         logdir='./models/step_'+str(step)+'/',
-                         name='my_graph.prototxt')
-    _ = tf_supervisor.saver.save(sess, "./models/step_"+ str(step)+"/"+"mmmg_model")
+def give_batches(data, bucket, keys, batch_size, epoch):
+    """ Returns the batches of an epoch. In dynamic mode the
+    chunks are requested one at a time from the dispatcher
+    on the parameter server instead of using keys"""
+    if FLAGS.dynamic:
+        keys = remote_chunks(FLAGS.coordinator, FLAGS.task_index, epoch)
+    elif not FLAGS.stream:
+        return data.batches(batch_size)
+    return chunk_batches(data, bucket, keys, batch_size)
+
+
+def chunk_batches(data, bucket, keys, batch_size):
+    """ Reads the chunks one after the other and
+    yields their batches, the examples left over at
+    the end of a chunk complete the first batch of
+    the next one"""
+    if FLAGS.stream:
+        return data.stream_batches(bucket, keys, batch_size, FLAGS.buffer_size)
+    return data.read_batches(bucket, keys, batch_size)
+
+
+def build_input_pipeline(data, meta_graph_def, batch_size):
+    """ Builds a tf.data pipeline over the arrays of the
+    dataset which shuffles, batches and prefetches them
+    inside the TensorFlow runtime. The arrays are fed once
+    per epoch when the iterator is initialized.
+    Returns the iterator, the feed for its initializer and
+    the input map from the placeholder names of the graph
+    (inputs, outputs, weights) to the iterator outputs"""
+    placeholders = [node for node in meta_graph_def.graph_def.node if node.op == 'Placeholder']
+    arrays = [np.asarray(arr) for arr in list(data.inputs) + list(data.outputs)]
+    if len(placeholders) != len(arrays)+1:
+        raise ValueError('The graph has %d placeholders but the data has %d inputs and outputs'
+                         % (len(placeholders), len(arrays)))
+    sources = [tf.placeholder(arr.dtype, (None,)+arr.shape[1:]) for arr in arrays]
+    dtypes = [tf.as_dtype(node.attr['dtype'].type) for node in placeholders]
+
+    def add_weights(*batch):
+        """ Casts a batch to the placeholder types and appends
+        the default sample weights"""
+        batch = [tf.cast(tensor, dtype) for tensor, dtype in zip(batch, dtypes)]
+        return tuple(batch) + (tf.ones(tf.shape(batch[0])[:1], dtype=dtypes[-1]),)
+
+    dataset = tf.data.Dataset.from_tensor_slices(tuple(sources))
+    if FLAGS.shuffle_buffer > 0:
+        dataset = dataset.shuffle(FLAGS.shuffle_buffer)
+    dataset = dataset.batch(batch_size, drop_remainder=True).map(add_weights)
+    dataset = dataset.prefetch(max(FLAGS.prefetch, 1))
+    iterator = dataset.make_initializable_iterator()
+    input_map = dict(zip([node.name+':0' for node in placeholders], iterator.get_next()))
+    return iterator, dict(zip(sources, arrays)), input_map
 
 
 
@@ -171,5 +358,51 @@ if __name__ == '__main__':
     PARSER.add_argument("-e", "--epochs", type=int, required=True)
     PARSER.add_argument("-bs", "--batch_size", type=int, required=True)
     PARSER.add_argument("-opt", "--optimizer", type=str, required=True)
+    PARSER.add_argument("-str", "--stream", action="store_true")
+    PARSER.add_argument("-buf", "--buffer_size", type=int, default=10000)
+    PARSER.add_argument("-mif", "--max_in_flight", type=int, default=8)
+    PARSER.add_argument("-c_dir", "--cache_dir", type=str, default='~/.easydist')
+    PARSER.add_argument("-c_size", "--cache_size", type=float, default=10)
+    PARSER.add_argument("-in", "--input_mode", type=str, default='feed',
+                        choices=['feed', 'tf_data'])
+    PARSER.add_argument("-shuf", "--shuffle_buffer", type=int, default=10000)
+    PARSER.add_argument("-pf", "--prefetch", type=int, default=4)
+    PARSER.add_argument("-pf_proc", "--prefetch_process", action="store_true")
+    PARSER.add_argument("-dyn", "--dynamic", action="store_true")
+    PARSER.add_argument("-coord", "--coordinator", type=str, default='')
+    PARSER.add_argument("-c_bind", "--coordinator_bind", type=str, default=None)
+    PARSER.add_argument("-sync", "--sync", action="store_true")
+    PARSER.add_argument("-r_agg", "--replicas_to_aggregate", type=int, default=0)
+    PARSER.add_argument("-bw", "--backup_workers", type=int, default=0)
+    PARSER.add_argument("-keep", "--keep_checkpoints", type=int, default=3)
+    PARSER.add_argument("-ck_steps", "--checkpoint_steps", type=int, default=0)
+    PARSER.add_argument("-ck_secs", "--checkpoint_secs", type=float, default=0)
+    PARSER.add_argument("-m_file", "--metrics_file", type=str, default='metrics.jsonl')
+    PARSER.add_argument("-m_every", "--metrics_every", type=int, default=10)
+    PARSER.add_argument("-s3_e", "--s3_endpoint", type=str, default=None)
+    PARSER.add_argument("-r_secs", "--report_secs", type=float, default=10)
+    PARSER.add_argument("-mm_dir", "--memmap_dir", type=str, default='./arrays')
+    PARSER.add_argument("-pp_proc", "--preprocess_processes", type=int, default=0)
+    PARSER.add_argument("-b_width", "--bucket_width", type=int, default=0)
+    PARSER.add_argument("-pad", "--padding", type=str, default='pre', choices=['pre', 'post'])
+    PARSER.add_argument("-cmp", "--compact", action="store_true")
+    PARSER.add_argument("-f16", "--allow_float16", action="store_true")
     FLAGS, UNPARSED = PARSER.parse_known_args()
+    if FLAGS.input_mode == 'tf_data' and (FLAGS.stream or FLAGS.dynamic):
+        PARSER.error('--input_mode=tf_data reads the arrays of the dataset and cannot'
+                     ' be combined with --stream or --dynamic')
+    if FLAGS.bucket_width > 0 and (FLAGS.stream or FLAGS.input_mode == 'tf_data'):
+        PARSER.error('--bucket_width batches the arrays read by read_data and cannot'
+                     ' be combined with --stream or --input_mode=tf_data')
+    if FLAGS.sync:
+        if FLAGS.stream or FLAGS.dynamic or not FLAGS.coordinator:
+            PARSER.error('--sync needs the batch count of every worker upfront and the'
+                         ' --coordinator address, it cannot be combined with --stream or --dynamic')
+        try:
+            give_replicas(len(FLAGS.worker_hosts.split(',')), FLAGS.replicas_to_aggregate,
+                          FLAGS.backup_workers)
+        except ValueError as error:
+            PARSER.error(str(error))
+    if FLAGS.dynamic and not FLAGS.coordinator:
+        PARSER.error('--dynamic requires the --coordinator address of the parameter server')
     main()
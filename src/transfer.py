@@ -0,0 +1,256 @@
+# Copyright (c) 2019 American Express Travel Related Services Company, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except
+# in compliance with the License. You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License
+# is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+# or implied. See the License for the specific language governing permissions and limitations under
+# the License.
+
+""" This module copies files to the machines of the cluster.
+All files for a host are packed into one archive and streamed
+over a single ssh connection, the hosts are served concurrently.
+A manifest of the file hashes on every host is kept locally so
+that only changed files are sent again, the files it lists are
+checked on the host before they are skipped"""
+from __future__ import print_function
+import hashlib
+import io
+import json
+import os
+import shlex
+import subprocess
+import tarfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+USER = 'ec2-user'
+KEY_FILE = './aux/easyDist.pem'
+
+
+class TransferEngine:
+    """ Pushes files to many hosts at once. The ssh connections
+    are kept open by a control master so that repeated transfers
+    and commands skip the handshake. The ssh command can be
+    replaced, which the tests use to stand in for remote hosts"""
+    def __init__(self, user=USER, key_file=KEY_FILE, ssh_command=None,
+                 max_workers=8, retries=2, retry_delay=1.0, control_dir='~/.easydist/ssh',
+                 manifest_dir='~/.easydist/manifests'):
+        self.user = user
+        self.manifest_dir = os.path.expanduser(manifest_dir)
+        self.max_workers = max_workers
+        self.retries = retries
+        self.retry_delay = retry_delay
+        if ssh_command is None:
+            control_dir = os.path.expanduser(control_dir)
+            if not os.path.isdir(control_dir):
+                os.makedirs(control_dir)
+            ssh_command = ['ssh', '-i', key_file,
+                           '-o', 'StrictHostKeyChecking=no',
+                           '-o', 'ControlMaster=auto',
+                           '-o', 'ControlPath=%s' % os.path.join(control_dir, '%C'),
+                           '-o', 'ControlPersist=10m']
+        self.ssh_command = list(ssh_command)
+
+    def give_target(self, host):
+        """ Returns the ssh destination of a host"""
+        if self.user:
+            return '%s@%s' % (self.user, host)
+        return host
+
+    def push(self, hosts, files, remote_dir='.', force=False):
+        """ Copies the files to remote_dir on every host. Files
+        are paths or (path, name on the host) pairs, directories
+        are copied recursively. Only files whose hash differs from
+        the manifest of a host, or from the file found on the host,
+        are sent, unless force is set.
+        Returns the result of every host"""
+        return self.push_each(dict((host, files) for host in hosts), remote_dir, force)
+
+    def push_each(self, files_by_host, remote_dir='.', force=False):
+        """ Like push, with a separate list of files per host"""
+        hosts = list(files_by_host)
+        command = 'mkdir -p %s && tar xzf - -C %s' % (remote_dir, remote_dir)
+        file_hashes = {}
+        #Hosts missing the same files share one archive
+        archives = {}
+        jobs = {}
+        changed_files = {}
+        hashes = {}
+        entries = {}
+        unchanged = {}
+        for host in hosts:
+            entries[host] = expand(files_by_host[host])
+            for path, _ in entries[host]:
+                if path not in file_hashes:
+                    file_hashes[path] = give_hash(path)
+            hashes[host] = dict((name, file_hashes[path]) for path, name in entries[host])
+            manifest = {} if force else self.load_manifest(host, remote_dir)
+            unchanged[host] = [name for _, name in entries[host]
+                               if manifest.get(name) == hashes[host][name]]
+        #Files deleted or changed on a host since the last push are sent again
+        remote_hashes = self.give_remote_hashes(unchanged, remote_dir)
+        for host in hosts:
+            changed = tuple(sorted((path, name) for path, name in entries[host]
+                                   if remote_hashes.get(host, {}).get(name) != hashes[host][name]))
+            changed_files[host] = [name for _, name in changed]
+            if changed:
+                if changed not in archives:
+                    archives[changed] = pack(changed)
+                jobs[host] = (command, archives[changed])
+        results = self._run_all(jobs)
+        for host in hosts:
+            if host not in results:
+                results[host] = {'ok': True, 'attempts': 0, 'error': '', 'bytes': 0,
+                                 'seconds': 0.0}
+            results[host]['files'] = len(changed_files[host])
+            if results[host]['ok'] and changed_files[host]:
+                manifest = {} if force else self.load_manifest(host, remote_dir)
+                manifest.update((name, hashes[host][name]) for name in changed_files[host])
+                self.save_manifest(host, remote_dir, manifest)
+        sent = [result for result in results.values() if result['ok'] and result['attempts']]
+        print('Sent %d files (%d bytes) to %d of %d hosts' % (
+            sum(result['files'] for result in sent), sum(result['bytes'] for result in sent),
+            len(sent), len(hosts)))
+        return results
+
+    def give_remote_hashes(self, names_by_host, remote_dir='.'):
+        """ Returns the hashes of the named files in remote_dir
+        of every host, files missing on a host have none"""
+        jobs = {}
+        for host, names in names_by_host.items():
+            if names:
+                jobs[host] = ('cd %s 2>/dev/null && sha256sum -- %s 2>/dev/null; true' % (
+                    remote_dir, ' '.join(shlex.quote(name) for name in names)), None)
+        remote_hashes = {}
+        for host, result in self._run_all(jobs).items():
+            lines = result.get('output', '').splitlines() if result['ok'] else []
+            remote_hashes[host] = dict(line.split(None, 1)[::-1] for line in lines
+                                       if len(line.split(None, 1)) == 2)
+        return remote_hashes
+
+    def give_manifest_path(self, host):
+        """ Returns the local file holding the manifest of a host"""
+        return os.path.join(self.manifest_dir, '%s.json' % host)
+
+    def load_manifest(self, host, remote_dir='.'):
+        """ Returns the hashes of the files last sent to
+        remote_dir on a host"""
+        try:
+            with open(self.give_manifest_path(host)) as manifest_file:
+                return json.load(manifest_file).get(remote_dir, {})
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def save_manifest(self, host, remote_dir, manifest):
+        """ Stores the hashes of the files on a host"""
+        if not os.path.isdir(self.manifest_dir):
+            os.makedirs(self.manifest_dir)
+        path = self.give_manifest_path(host)
+        try:
+            with open(path) as manifest_file:
+                manifests = json.load(manifest_file)
+        except (IOError, OSError, ValueError):
+            manifests = {}
+        manifests[remote_dir] = manifest
+        with open(path+'.tmp', 'w') as manifest_file:
+            json.dump(manifests, manifest_file, indent=1, sort_keys=True)
+        os.rename(path+'.tmp', path)
+
+    def forget(self, hosts):
+        """ Drops the manifests of hosts, for example after they
+        were replaced, so that the next push sends every file"""
+        for host in hosts:
+            if os.path.exists(self.give_manifest_path(host)):
+                os.remove(self.give_manifest_path(host))
+
+    def run(self, hosts, command, stdin=None):
+        """ Runs a shell command on every host concurrently,
+        feeding it stdin, and returns the result of every host"""
+        return self._run_all(dict((host, (command, stdin)) for host in hosts))
+
+    def _run_all(self, jobs):
+        """ Runs a (command, stdin) job per host concurrently"""
+        if not jobs:
+            return {}
+        hosts = sorted(jobs)
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=max(1, min(self.max_workers, len(hosts)))) as pool:
+            futures = dict((host, pool.submit(self._run_host, host, jobs[host][0], jobs[host][1]))
+                           for host in hosts)
+            results = dict((host, future.result()) for host, future in futures.items())
+        failed = [host for host in hosts if not results[host]['ok']]
+        print('Reached %d of %d hosts in %.1fs' % (len(hosts)-len(failed), len(hosts),
+                                                   time.time()-start))
+        for host in failed:
+            print('Failed on host ', host, results[host]['error'])
+        return results
+
+    def _run_host(self, host, command, stdin):
+        """ Runs the command on one host, retrying failures"""
+        result = {'ok': False, 'attempts': 0, 'error': '',
+                  'bytes': len(stdin) if stdin is not None else 0}
+        start = time.time()
+        while result['attempts'] <= self.retries:
+            if result['attempts'] > 0:
+                time.sleep(self.retry_delay*result['attempts'])
+            result['attempts'] += 1
+            try:
+                process = subprocess.Popen(self.ssh_command+[self.give_target(host), command],
+                                           stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                           stderr=subprocess.PIPE)
+                output, error = process.communicate(stdin)
+            except OSError as error_message:
+                result['error'] = str(error_message)
+                continue
+            result['output'] = output.decode('utf-8', 'replace')
+            if process.returncode == 0:
+                result['ok'] = True
+                result['error'] = ''
+                break
+            result['error'] = error.decode('utf-8', 'replace').strip()
+        result['seconds'] = time.time()-start
+        return result
+
+
+def expand(files):
+    """ Returns a (path, name on the host) pair for every regular
+    file, walking into directories"""
+    entries = []
+    for entry in files:
+        if isinstance(entry, tuple):
+            path, name = entry
+        else:
+            path, name = entry, os.path.basename(os.path.normpath(entry))
+        if os.path.isdir(path):
+            for directory, _, file_names in os.walk(path):
+                for file_name in sorted(file_names):
+                    file_path = os.path.join(directory, file_name)
+                    entries.append((file_path, os.path.join(
+                        name, os.path.relpath(file_path, path)).replace(os.sep, '/')))
+        elif os.path.exists(path):
+            entries.append((path, name))
+        else:
+            print('Skipping missing file ', path)
+    return entries
+
+
+def give_hash(path, block_size=1024*1024):
+    """ Returns the sha256 of a file"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as hashed_file:
+        for block in iter(lambda: hashed_file.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def pack(entries):
+    """ Packs (path, name) pairs into an in memory tar.gz archive"""
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode='w:gz') as archive:
+        for path, name in entries:
+            archive.add(path, arcname=name)
+    return buffer.getvalue()
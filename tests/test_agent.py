@@ -0,0 +1,168 @@
+# Copyright (c) 2019 American Express Travel Related Services Company, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except
+# in compliance with the License. You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License
+# is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+# or implied. See the License for the specific language governing permissions and limitations under
+# the License.
+
+''' This module tests the resident agent within agent.py
+with local agents standing in for the machines'''
+import os
+import sys
+import shutil
+import socket
+import subprocess
+import tempfile
+import time
+from nose.tools import assert_equal
+from nose.tools import assert_true
+from nose.tools import raises
+sys.path.append('../src/')
+sys.path.append('.')
+from agent import WorkerAgent, AgentPool, CheckpointCollector, start_agents
+from coordinator import serve, connect
+from transfer import TransferEngine
+
+SCRIPT = '''echo started $HOST_NAME
+echo warning >&2
+echo $HOST_NAME > m_0_models.zip
+exit $EXIT_CODE
+'''
+
+#Runs the remote command with bash inside the directory given first
+FAKE_SSH = '''import subprocess, sys
+sys.exit(subprocess.call(['bash', '-c', sys.argv[-1]], cwd=sys.argv[1]))
+'''
+
+
+class TestAgent(object):
+
+    def test_jobs(self):
+        ''' Tests that jobs on several agents run concurrently,
+        stream their output and return their results'''
+        root = tempfile.mkdtemp()
+        servers = []
+        try:
+            addresses = {}
+            for host in ['host0', 'host1']:
+                os.makedirs(os.path.join(root, host))
+                servers.append(serve('127.0.0.1', 0, [WorkerAgent(os.path.join(root, host))]))
+                addresses[host] = '127.0.0.1:%d' % servers[-1].server_address[1]
+            log_dir = os.path.join(root, 'exp0')
+            pool = AgentPool(addresses, log_dir, poll_secs=0.05)
+            pool.submit(dict((host, {'script': SCRIPT,
+                                     'env': {'HOST_NAME': host, 'EXIT_CODE': str(code)},
+                                     'artifacts': {'Graph/notes.txt': 'graph'}})
+                             for code, host in enumerate(addresses)))
+            exit_codes = pool.wait({'host1': {'m_0_models.zip':
+                                              os.path.join(log_dir, 'm_0_models.zip')}})
+            assert_equal(exit_codes, {'host0': 0, 'host1': 1})
+            with open(os.path.join(log_dir, 'outs_train', 'host1')) as out:
+                assert_equal(out.read(), 'started host1\n')
+            with open(os.path.join(log_dir, 'errs_train', 'host0')) as err:
+                assert_equal(err.read(), 'warning\n')
+            with open(os.path.join(log_dir, 'm_0_models.zip')) as result:
+                assert_equal(result.read(), 'host1\n')
+            assert_true(os.path.exists(os.path.join(root, 'host0', 'Graph', 'notes.txt')))
+        finally:
+            for server in servers:
+                server.shutdown()
+                server.server_close()
+            shutil.rmtree(root)
+
+    def test_stop_servers(self):
+        ''' Tests that wait only follows the given hosts and then
+        kills the jobs that never exit, such as parameter servers'''
+        root = tempfile.mkdtemp()
+        servers = []
+        try:
+            addresses = {}
+            agents = {}
+            for host in ['ps', 'worker']:
+                os.makedirs(os.path.join(root, host))
+                agents[host] = WorkerAgent(os.path.join(root, host))
+                servers.append(serve('127.0.0.1', 0, [agents[host]]))
+                addresses[host] = '127.0.0.1:%d' % servers[-1].server_address[1]
+            pool = AgentPool(addresses, os.path.join(root, 'exp0'), poll_secs=0.05)
+            job_ids = pool.submit({'ps': {'script': 'sleep 1000\n'},
+                                   'worker': {'script': 'echo done\n'}})
+            assert_equal(pool.wait(hosts=['worker']), {'worker': 0})
+            assert_true(agents['ps'].poll(job_ids['ps'])['returncode'] is not None)
+        finally:
+            for server in servers:
+                server.shutdown()
+                server.server_close()
+            shutil.rmtree(root)
+
+    def test_checkpoints(self):
+        ''' Tests that only completed checkpoints are collected,
+        that partial copies are resumed and verified'''
+        root = tempfile.mkdtemp()
+        server = serve('127.0.0.1', 0, [WorkerAgent(os.path.join(root, 'host0'))])
+        try:
+            models = os.path.join(root, 'host0', 'models')
+            for checkpoint in ['step_10', 'step_20.tmp']:
+                os.makedirs(os.path.join(models, checkpoint))
+                with open(os.path.join(models, checkpoint, 'mmmg_model.index'), 'wb') as index:
+                    index.write(b'weights'*1000)
+            local_dir = os.path.join(root, 'collected')
+            #An interrupted copy of step_10
+            os.makedirs(os.path.join(local_dir, 'step_10.part'))
+            with open(os.path.join(local_dir, 'step_10.part', 'mmmg_model.index'), 'wb') as index:
+                index.write(b'weights'*10)
+            collector = CheckpointCollector('127.0.0.1:%d' % server.server_address[1], local_dir)
+            assert_equal(collector.sweep(), ['step_10'])
+            with open(os.path.join(local_dir, 'step_10', 'mmmg_model.index'), 'rb') as index:
+                assert_equal(index.read(), b'weights'*1000)
+            os.rename(os.path.join(models, 'step_20.tmp'), os.path.join(models, 'step_20'))
+            assert_equal(collector.sweep(), ['step_20'])
+            assert_equal(collector.sweep(), [])
+            assert_equal(sorted(os.listdir(local_dir)), ['step_10', 'step_20'])
+        finally:
+            server.shutdown()
+            server.server_close()
+            shutil.rmtree(root)
+
+    def test_start_agents(self):
+        ''' Tests that the start command launches an agent
+        which answers and is not launched a second time'''
+        root = tempfile.mkdtemp()
+        probe = socket.socket()
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+        probe.close()
+        pattern = 'agent.py --port=%d$' % port
+        try:
+            for module in ['agent.py', 'coordinator.py']:
+                shutil.copy(os.path.join('..', 'src', module), root)
+            script = os.path.join(root, 'fake_ssh.py')
+            with open(script, 'w') as fake_ssh:
+                fake_ssh.write(FAKE_SSH)
+            engine = TransferEngine(user=None, ssh_command=[sys.executable, script, root],
+                                    retries=0)
+            for _ in range(2):
+                assert_true(start_agents(engine, ['localhost'], port)['localhost']['ok'])
+                for _ in range(50):
+                    try:
+                        assert_equal(connect('127.0.0.1:%d' % port).ping(), True)
+                        break
+                    except (IOError, OSError):
+                        time.sleep(0.1)
+                else:
+                    raise AssertionError('The agent did not answer')
+            running = subprocess.check_output(['pgrep', '-f', pattern]).split()
+            assert_equal(len(running), 1)
+        finally:
+            subprocess.call(['pkill', '-f', pattern])
+            shutil.rmtree(root)
+
+    @raises(ValueError)
+    def test_outside_work_dir(self):
+        ''' Tests that files outside of the work directory
+        cannot be read'''
+        WorkerAgent('.').read_file('../../etc/passwd')
@@ -0,0 +1,109 @@
+# Copyright (c) 2019 American Express Travel Related Services Company, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except
+# in compliance with the License. You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License
+# is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+# or implied. See the License for the specific language governing permissions and limitations under
+# the License.
+
+''' This module tests the checkpoints written by
+checkpoint.py and their retention policy'''
+import os
+import sys
+import shutil
+import tempfile
+import threading
+from nose.tools import assert_equal
+import tensorflow as tf
+sys.path.append('../src/')
+sys.path.append('.')
+from checkpoint import Checkpointer, give_expired
+
+
+def read_weight(directory, step):
+    ''' Returns the value of the weight variable saved in
+    the checkpoint of a step'''
+    reader = tf.train.NewCheckpointReader(os.path.join(directory, 'step_%d' % step,
+                                                       'mmmg_model'))
+    return float(reader.get_tensor('weight'))
+
+
+class TestCheckpointer(object):
+
+    def test_save(self):
+        ''' Tests that checkpoints hold the weights of their step,
+        are only visible once complete and expire by the policy'''
+        directory = tempfile.mkdtemp()
+        try:
+            with tf.Graph().as_default():
+                weight = tf.Variable(0.0, name='weight')
+                checkpointer = Checkpointer('/cpu:0', directory, keep=1, every_steps=10)
+                with tf.Session() as sess:
+                    sess.run(tf.global_variables_initializer())
+                    checkpointer.start(sess)
+                    for step, best in [(10, True), (20, False), (30, False)]:
+                        sess.run(weight.assign(float(step)))
+                        if best:
+                            checkpointer.save(sess, step, best=True)
+                        else:
+                            checkpointer.maybe_save(sess, step)
+                        checkpointer.writer.join()
+                    checkpointer.close(sess)
+            #The last checkpoint and the best one are kept
+            assert_equal(sorted(os.listdir(directory)), ['step_10', 'step_30'])
+            assert_equal(os.path.isfile(os.path.join(directory, 'step_30', 'my_graph.prototxt')),
+                         True)
+            assert_equal(read_weight(directory, 10), 10.0)
+            assert_equal(read_weight(directory, 30), 30.0)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_deferred_saves(self):
+        ''' Tests that a periodic save requested while a checkpoint
+        is written is deferred, and that a best save holds the
+        weights of the step it was requested at'''
+        directory = tempfile.mkdtemp()
+        try:
+            with tf.Graph().as_default():
+                weight = tf.Variable(0.0, name='weight')
+                checkpointer = Checkpointer('/cpu:0', directory, keep=5)
+                with tf.Session() as sess:
+                    sess.run(tf.global_variables_initializer())
+                    checkpointer.start(sess)
+                    #Hold the first write until the deferred saves were requested
+                    released = threading.Event()
+                    write = checkpointer._write
+                    checkpointer._write = lambda *args: (released.wait(), write(*args))
+                    sess.run(weight.assign(1.0))
+                    assert_equal(checkpointer.save(sess, 1), True)
+                    sess.run(weight.assign(2.0))
+                    assert_equal(checkpointer.save(sess, 2), False)
+                    assert_equal(checkpointer.pending, 2)
+                    sess.run(weight.assign(3.0))
+                    threading.Timer(0.2, released.set).start()
+                    assert_equal(checkpointer.save(sess, 3, best=True), True)
+                    sess.run(weight.assign(4.0))
+                    checkpointer.close(sess)
+            assert_equal(checkpointer.best_step, 3)
+            assert_equal(read_weight(directory, 1), 1.0)
+            assert_equal(read_weight(directory, 3), 3.0)
+            assert_equal([name for name in os.listdir(directory) if name.endswith('.tmp')], [])
+        finally:
+            shutil.rmtree(directory)
+
+
+
+
+class TestRetention(object):
+
+    def test_keep_last_and_best(self):
+        ''' Tests that the last checkpoints and the best one
+        are retained and all others expire'''
+        assert_equal(give_expired([10, 20, 30, 40, 50], 2, 20), [10, 30])
+        assert_equal(give_expired([10, 20, 30], 2, 30), [10])
+        assert_equal(give_expired([10, 20], 0, 20), [10])
+        assert_equal(give_expired([10], 3, None), [])
@@ -0,0 +1,187 @@
+# Copyright (c) 2019 American Express Travel Related Services Company, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except
+# in compliance with the License. You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License
+# is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+# or implied. See the License for the specific language governing permissions and limitations under
+# the License.
+
+''' This module tests the coordination services
+within coordinator.py using local processes as
+the workers of the cluster'''
+import sys
+import time
+import multiprocessing
+from nose.tools import assert_equal
+from nose.tools import assert_true
+from nose.tools import assert_raises
+sys.path.append('../src/')
+sys.path.append('.')
+from coordinator import ChunkDispatcher, MetricsCollector, MetricsReporter, serve, connect, remote_chunks
+from coordinator import StepAgreement, agree_steps, give_replicas
+
+CHUNKS = ['chunk%d' % i for i in range(12)]
+#Seconds a worker needs per chunk, the second worker is deliberately slow
+SPEEDS = [0.02, 0.2]
+
+
+def static_worker(worker):
+    ''' Trains on a fixed share of the chunks'''
+    share = len(CHUNKS)//len(SPEEDS)
+    for _ in CHUNKS[worker*share:(worker+1)*share]:
+        time.sleep(SPEEDS[worker])
+
+
+def dynamic_worker(address, worker):
+    ''' Trains on the chunks handed out by the dispatcher'''
+    for _ in remote_chunks(address, worker, 0):
+        time.sleep(SPEEDS[worker])
+
+
+def run_epoch(target, args):
+    ''' Runs one process per worker and returns the wall time
+    until the last of them has finished'''
+    start = time.time()
+    workers = [multiprocessing.Process(target=target, args=args(worker))
+               for worker in range(len(SPEEDS))]
+    for process in workers:
+        process.start()
+    for process in workers:
+        process.join()
+    return time.time()-start
+
+
+class TestChunkDispatcher(object):
+
+    def test_epochs(self):
+        ''' Tests that every chunk is handed out once per epoch'''
+        dispatcher = ChunkDispatcher(['a', 'b', 'c'])
+        assert_equal([dispatcher.next_chunk(0, 0), dispatcher.next_chunk(1, 0)], ['a', 'b'])
+        assert_equal(dispatcher.next_chunk(1, 1), 'a')
+        assert_equal([dispatcher.next_chunk(0, 0), dispatcher.next_chunk(1, 0)], ['c', ''])
+        assert_equal(dispatcher.give_assignments(0), {'0': ['a', 'c'], '1': ['b']})
+
+    def test_uneven_workers(self):
+        ''' Tests that a local cluster with uneven worker speeds
+        finishes an epoch sooner when the chunks are dispatched
+        on demand than with a fixed assignment'''
+        dispatcher = ChunkDispatcher(CHUNKS)
+        server = serve('127.0.0.1', 0, [dispatcher])
+        address = '127.0.0.1:%d' % server.server_address[1]
+        try:
+            static_time = run_epoch(static_worker, lambda worker: (worker,))
+            dynamic_time = run_epoch(dynamic_worker, lambda worker: (address, worker))
+        finally:
+            server.shutdown()
+            server.server_close()
+        assignments = dispatcher.give_assignments(0)
+        assert_equal(sorted(sum(assignments.values(), [])), sorted(CHUNKS))
+        assert_true(len(assignments['0']) > len(assignments['1']))
+        assert_true(dynamic_time < static_time)
+
+
+class TestMetricsCollector(object):
+
+    def test_cluster_view(self):
+        ''' Tests the aggregation of the worker reports'''
+        collector = MetricsCollector()
+        collector.report(0, {'step': 120, 'samples_per_sec': 300.0, 'loss': 0.5})
+        collector.report(1, {'step': 100, 'samples_per_sec': 100.0, 'loss': 0.6})
+        view = collector.give_cluster_view()
+        assert_equal(view['global_step'], 120)
+        assert_equal(view['samples_per_sec'], 400.0)
+        assert_equal(view['slowest_worker'], '1')
+        assert_equal(view['workers']['1']['lag'], 20)
+        assert_equal(view['workers']['0']['lag'], 0)
+
+    def test_stale_workers(self):
+        ''' Tests that workers without recent reports are not
+        counted towards the cluster throughput'''
+        collector = MetricsCollector(stale_secs=0.05)
+        collector.report(0, {'step': 10, 'samples_per_sec': 50.0})
+        time.sleep(0.1)
+        collector.report(1, {'step': 12, 'samples_per_sec': 80.0})
+        view = collector.give_cluster_view()
+        assert_equal(view['active_workers'], 1)
+        assert_equal(view['samples_per_sec'], 80.0)
+        assert_equal(view['slowest_worker'], '1')
+
+    def test_reporter(self):
+        ''' Tests that a reporter streams the latest metrics
+        of a worker to the collector over XML-RPC'''
+        collector = MetricsCollector()
+        server = serve('127.0.0.1', 0, [collector])
+        address = '127.0.0.1:%d' % server.server_address[1]
+        try:
+            reporter = MetricsReporter(address, 3, interval=0.05)
+            reporter.update({'step': 7, 'samples_per_sec': 42.0, 'loss': 1.5})
+            reporter.close()
+            view = connect(address).give_cluster_view()
+        finally:
+            server.shutdown()
+            server.server_close()
+        assert_equal(view['workers']['3']['step'], 7)
+        assert_equal(view['samples_per_sec'], 42.0)
+        assert_true(view['workers']['3']['memory_mb'] > 0)
+
+    def test_reporter_fault(self):
+        ''' Tests that a reporter keeps reporting after the
+        collector failed to handle its metrics'''
+        collector = MetricsCollector()
+        report = collector.report
+        calls = []
+        def flaky_report(worker, metrics):
+            calls.append(worker)
+            if len(calls) == 1:
+                raise ValueError('collector failure')
+            return report(worker, metrics)
+        collector.report = flaky_report
+        server = serve('127.0.0.1', 0, [collector])
+        address = '127.0.0.1:%d' % server.server_address[1]
+        try:
+            reporter = MetricsReporter(address, 3, interval=0.05)
+            reporter.update({'step': 7, 'samples_per_sec': 42.0})
+            time.sleep(0.3)
+            reporter.close()
+            view = connect(address).give_cluster_view()
+        finally:
+            server.shutdown()
+            server.server_close()
+        assert_true(reporter.failed)
+        assert_equal(view['workers']['3']['step'], 7)
+
+
+class TestStepAgreement(object):
+
+    def test_agree_steps(self):
+        ''' Tests that all the workers of a synchronous training
+        train the smallest number of batches of any worker'''
+        server = serve('127.0.0.1', 0, [StepAgreement(3)])
+        try:
+            address = '127.0.0.1:%d' % server.server_address[1]
+            pool = multiprocessing.Pool(3)
+            try:
+                agreed = pool.starmap(agree_steps, [(address, worker, 0, steps, 0.05)
+                                                    for worker, steps in enumerate([5, 3, 4])])
+            finally:
+                pool.close()
+                pool.join()
+            assert_equal(agreed, [3, 3, 3])
+            #Every epoch is agreed on separately
+            assert_equal(connect(address).propose_steps(0, 1, 6), -1)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_give_replicas(self):
+        ''' Tests that only replica and backup counts the cluster
+        can satisfy are accepted'''
+        assert_equal(give_replicas(4), 4)
+        assert_equal(give_replicas(4, backup_workers=1), 3)
+        assert_equal(give_replicas(4, replicas_to_aggregate=2), 2)
+        for replicas, backups in [(5, 0), (-1, 0), (0, 4), (0, -1)]:
+            assert_raises(ValueError, give_replicas, 4, replicas, backups)
@@ -0,0 +1,107 @@
+# Copyright (c) 2019 American Express Travel Related Services Company, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except
+# in compliance with the License. You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License
+# is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+# or implied. See the License for the specific language governing permissions and limitations under
+# the License.
+
+''' This module tests the local worker caches
+within data_cache.py'''
+import sys
+import os
+import shutil
+import tempfile
+from nose.tools import assert_equal
+sys.path.append('../src/')
+sys.path.append('.')
+import numpy as np
+from data_cache import ChunkCache, PreprocessedCache
+
+
+class TestChunkCache(object):
+
+    def test_etag_validation(self):
+        ''' Tests that an entry is only returned for the
+        ETag it was stored with'''
+        cache_dir = tempfile.mkdtemp()
+        cache = ChunkCache(cache_dir, max_bytes=100)
+        cache.put('bucket', 'key', '"etag1"', b'chunk')
+        assert_equal(cache.get('bucket', 'key', '"etag1"'), b'chunk')
+        assert_equal(cache.get('bucket', 'key', '"etag2"'), None)
+        assert_equal(cache.get('bucket', 'other', '"etag1"'), None)
+        shutil.rmtree(cache_dir)
+
+    def test_lru_eviction(self):
+        ''' Tests that the least recently used entries are
+        evicted once the cache exceeds its size limit'''
+        cache_dir = tempfile.mkdtemp()
+        cache = ChunkCache(cache_dir, max_bytes=25)
+        cache.put('bucket', 'a', 'e', b'a'*10)
+        cache.put('bucket', 'b', 'e', b'b'*10)
+        #Age b so that it is the least recently used entry
+        os.utime(cache.give_path('bucket', 'b', 'e'), (0, 0))
+        assert_equal(cache.get('bucket', 'a', 'e'), b'a'*10)
+        cache.put('bucket', 'c', 'e', b'c'*10)
+        assert_equal(cache.get('bucket', 'b', 'e'), None)
+        assert_equal(cache.get('bucket', 'a', 'e'), b'a'*10)
+        assert_equal(cache.get('bucket', 'c', 'e'), b'c'*10)
+        #Objects larger than the whole cache are not stored
+        cache.put('bucket', 'd', 'e', b'd'*30)
+        assert_equal(cache.get('bucket', 'd', 'e'), None)
+        shutil.rmtree(cache_dir)
+
+
+class TestPreprocessedCache(object):
+
+    def test_round_trip(self):
+        ''' Tests that the preprocessed arrays are restored
+        and that the key depends on the ETags and the code'''
+        cache_dir = tempfile.mkdtemp()
+        code_file = os.path.join(cache_dir, 'preprocessing.py')
+        with open(code_file, 'w') as code:
+            code.write('version = 1')
+        cache = PreprocessedCache(os.path.join(cache_dir, 'preprocessed'))
+        key = cache.give_key('bucket', ['a', 'b'], ['e1', 'e2'], code_file)
+        assert_equal(cache.get(key), None)
+        cache.put(key, [np.arange(6).reshape(3, 2)], [[[0], [1], [1]]], 3)
+        inputs, outputs, train_size = cache.get(key)
+        assert_equal(inputs[0].tolist(), [[0, 1], [2, 3], [4, 5]])
+        assert_equal(outputs[0].tolist(), [[0], [1], [1]])
+        assert_equal(train_size, 3)
+
+        assert_equal(key == cache.give_key('bucket', ['a', 'b'], ['e1', 'e3'], code_file), False)
+        with open(code_file, 'w') as code:
+            code.write('version = 2')
+        assert_equal(key == cache.give_key('bucket', ['a', 'b'], ['e1', 'e2'], code_file), False)
+        #A change to a module the preprocessing depends on changes the key as well
+        helper_file = os.path.join(cache_dir, 'helpers.py')
+        with open(helper_file, 'w') as code:
+            code.write('version = 1')
+        key = cache.give_key('bucket', ['a'], ['e1'], [code_file, helper_file])
+        with open(helper_file, 'w') as code:
+            code.write('version = 2')
+        assert_equal(key == cache.give_key('bucket', ['a'], ['e1'], [code_file, helper_file]), False)
+        shutil.rmtree(cache_dir)
+
+    def test_shared_put(self):
+        ''' Tests that storing an entry which another worker
+        already stored succeeds, and that entries larger than
+        the cache are not stored'''
+        cache_dir = tempfile.mkdtemp()
+        try:
+            cache = PreprocessedCache(cache_dir, max_bytes=1000)
+            other = PreprocessedCache(cache_dir, max_bytes=1000)
+            cache.put('shard', [np.arange(10)], [np.zeros(10)], 10)
+            other.put('shard', [np.arange(10)], [np.zeros(10)], 10)
+            assert_equal(cache.get('shard')[0][0].tolist(), list(range(10)))
+            assert_equal(os.listdir(cache_dir), ['shard'])
+            cache.put('large', [np.arange(1000)], [np.zeros(1000)], 1000)
+            assert_equal(cache.get('large'), None)
+        finally:
+            shutil.rmtree(cache_dir)
+
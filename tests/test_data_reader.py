@@ -0,0 +1,270 @@
+# Copyright (c) 2019 American Express Travel Related Services Company, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except
+# in compliance with the License. You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License
+# is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+# or implied. See the License for the specific language governing permissions and limitations under
+# the License.
+
+''' This module tests the Dataset class within
+data_reader.py against a local S3 stand-in (moto)
+using the preprocessing file of the rnn example'''
+import sys
+import os
+import shutil
+import tempfile
+from nose.tools import assert_equal
+from nose.tools import assert_true
+import numpy as np
+import boto3
+try:
+    from moto import mock_s3
+except ImportError:
+    from moto import mock_aws as mock_s3
+sys.path.append('../src/')
+sys.path.append('../examples/rnn/')
+sys.path.append('.')
+import data_reader
+from data_reader import Dataset, BodyReader, compact_array, give_blocks
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+BUCKET = 'easydist.test'
+
+
+class TestDataset(object):
+
+    def put_chunks(self, rows_per_chunk):
+        ''' Helper function that uploads one csv chunk
+        per entry of rows_per_chunk to the mocked bucket'''
+        client = boto3.client('s3')
+        client.create_bucket(Bucket=BUCKET)
+        keys = []
+        for chunk, rows in enumerate(rows_per_chunk):
+            lines = ['x1,y'] + ['%d %d %d,%d' % (row, row+1, row+2, row%2)
+                                for row in range(rows)]
+            key = 'data/chunk%d.csv' % chunk
+            client.put_object(Bucket=BUCKET, Key=key, Body='\n'.join(lines).encode('utf8'))
+            keys.append(key)
+        return keys
+
+    @mock_s3
+    def test_read_data(self):
+        ''' Tests that read_data stores the preprocessed
+        inputs, outputs and train size of all the chunks'''
+        keys = self.put_chunks([5, 7])
+        data = Dataset()
+        data.read_data(BUCKET, keys)
+        assert_equal(data.train_size, 12)
+        assert_equal(len(list(data.batches(4))), 3)
+
+    @mock_s3
+    def test_read_data_parallel(self):
+        ''' Tests that chunks preprocessed by a pool of processes
+        are merged in the order of the keys'''
+        keys = self.put_chunks([5, 7, 3])
+        serial = Dataset()
+        serial.read_data(BUCKET, keys)
+        data = Dataset(processes=2)
+        data.read_data(BUCKET, keys)
+        assert_equal(data.train_size, 15)
+        for parallel, expected in zip(data.inputs+data.outputs, serial.inputs+serial.outputs):
+            assert_equal(parallel.tolist(), expected.tolist())
+        assert_equal(data.inputs[0][12][-3:].tolist(), [0, 1, 2])
+        #Without the fork start method the chunks are preprocessed at once
+        can_fork = data_reader.can_fork
+        data_reader.can_fork = lambda: False
+        try:
+            data = Dataset(processes=2)
+            data.read_data(BUCKET, keys)
+        finally:
+            data_reader.can_fork = can_fork
+        assert_equal(data.inputs[0].tolist(), serial.inputs[0].tolist())
+
+    @mock_s3
+    def test_read_data_parallel_empty(self):
+        ''' Tests that empty chunks are skipped by the pool'''
+        keys = self.put_chunks([5, 7])
+        boto3.client('s3').put_object(Bucket=BUCKET, Key='data/empty.csv', Body=b'')
+        serial = Dataset()
+        serial.read_data(BUCKET, keys)
+        data = Dataset(processes=2)
+        data.read_data(BUCKET, [keys[0], 'data/empty.csv', keys[1]])
+        assert_equal(data.train_size, 12)
+        assert_equal(data.inputs[0].tolist(), serial.inputs[0].tolist())
+
+    @mock_s3
+    def test_compact(self):
+        ''' Tests that compact stores narrow types, reports the
+        memory saved and casts the batches to the feed types'''
+        keys = self.put_chunks([5, 7])
+        data = Dataset(compact=True)
+        data.read_data(BUCKET, keys)
+        assert_equal([arr.dtype for arr in data.inputs+data.outputs],
+                     [np.dtype(np.uint8), np.dtype(np.uint8)])
+        assert_true(data.memory['after_bytes'] < data.memory['before_bytes'])
+        data.feed_dtypes = [np.float32, np.int64, None]
+        batch = data.give_next(4, 1)
+        assert_equal([arr.dtype for arr in batch],
+                     [np.dtype(np.float32), np.dtype(np.int64), np.dtype(np.float32)])
+        assert_equal(batch[0][0][-3:].tolist(), [4, 5, 6])
+
+    def test_compact_array(self):
+        ''' Tests that arrays are only narrowed to types which
+        hold all their values exactly'''
+        assert_equal(compact_array(np.array([0, 255])).dtype, np.uint8)
+        assert_equal(compact_array(np.array([-1, 4000])).dtype, np.int16)
+        assert_equal(compact_array(np.array([1.0, 70000.0])).dtype, np.uint32)
+        assert_equal(compact_array(np.array([0.5, 1.25])).dtype, np.float32)
+        assert_equal(compact_array(np.array([0.5, 1.25]), allow_float16=True).dtype, np.float16)
+        assert_equal(compact_array(np.array([0.1, 2.0])).dtype, np.float64)
+        assert_equal(compact_array(np.array([np.nan, 2.0])).dtype, np.float64)
+        assert_equal(compact_array(np.array([2**40])).dtype, np.int64)
+        assert_equal(compact_array(np.array(3.0)).dtype, np.uint8)
+        #Arrays are scanned a block of rows at a time
+        array = np.arange(30.0).reshape(10, 3)
+        assert_equal([len(block) for block in give_blocks(array, block_size=12)], [4, 4, 2])
+        assert_equal(compact_array(array).tolist(), array.tolist())
+
+    @mock_s3
+    def test_read_data_cached(self):
+        ''' Tests that a second read_data of the same chunks is
+        served from the preprocessed data cache without downloading'''
+        keys = self.put_chunks([5, 7])
+        cache_dir = tempfile.mkdtemp()
+        try:
+            Dataset(cache_dir=cache_dir, cache_size=2**20).read_data(BUCKET, keys)
+            data = Dataset(cache_dir=cache_dir, cache_size=2**20)
+            data.downloader.fetch = None
+            data.read_data(BUCKET, keys)
+            assert_equal(data.train_size, 12)
+            assert_equal(data.inputs[0][5][-3:].tolist(), [0, 1, 2])
+            #Both caches share the configured size
+            assert_equal(data.downloader.cache.max_bytes+data.preprocessed_cache.max_bytes,
+                         2**20)
+            #Compacted arrays are stored under a key of their own
+            Dataset(cache_dir=cache_dir, cache_size=2**20, compact=True).read_data(BUCKET, keys)
+            assert_equal(len(os.listdir(os.path.join(cache_dir, 'preprocessed'))), 2)
+        finally:
+            shutil.rmtree(cache_dir)
+
+    @mock_s3
+    def test_memmap_batches(self):
+        ''' Tests that the arrays are memory mapped from memmap_dir
+        and that batches are views sharing one weights array'''
+        keys = self.put_chunks([5, 7])
+        memmap_dir = tempfile.mkdtemp()
+        try:
+            data = Dataset(memmap_dir=memmap_dir)
+            data.read_data(BUCKET, keys)
+            assert_equal(isinstance(data.inputs[0], np.memmap), True)
+            assert_equal(os.path.dirname(data.inputs[0].filename), memmap_dir)
+            #The files are unlinked once mapped
+            assert_equal(os.listdir(memmap_dir), [])
+            first, second = list(data.batches(5))[:2]
+            assert_equal(np.shares_memory(first[0], data.inputs[0]), True)
+            assert_equal(np.shares_memory(first[2], second[2]), True)
+            assert_equal(second[0][0][-3:].tolist(), [0, 1, 2])
+            assert_equal(first[2].tolist(), [1]*5)
+        finally:
+            shutil.rmtree(memmap_dir)
+
+    @mock_s3
+    def test_stream_batches(self):
+        ''' Tests that stream_batches yields fixed size batches
+        across chunk and buffer boundaries and drops the
+        incomplete final batch'''
+        keys = self.put_chunks([5, 7, 3])
+        data = Dataset()
+        batches = list(data.stream_batches(BUCKET, keys, batch_size=4, buffer_size=2))
+        assert_equal(len(batches), 3)
+        for batch in batches:
+            #inputs, outputs and weights
+            assert_equal(len(batch), 3)
+            assert_equal([len(part) for part in batch], [4, 4, 4])
+        #Records keep their order across the chunk boundaries
+        assert_equal([row[-3] for row in batches[1][0]], [4, 0, 1, 2])
+
+    @mock_s3
+    def test_read_batches(self):
+        ''' Tests that the examples left over at the end of a
+        chunk read by read_data complete the next batch'''
+        keys = self.put_chunks([5, 7, 3])
+        data = Dataset()
+        batches = list(data.read_batches(BUCKET, iter(keys), batch_size=4))
+        assert_equal([[len(part) for part in batch] for batch in batches], [[4, 4, 4]]*3)
+        assert_equal([row[-3] for row in batches[1][0]], [4, 0, 1, 2])
+
+    def test_read_local_bucket(self):
+        ''' Tests that read_data and stream_batches read the chunks
+        of a file:// bucket from a local directory'''
+        root = tempfile.mkdtemp()
+        try:
+            keys = []
+            for chunk, rows in enumerate([5, 7]):
+                lines = ['x1,y'] + ['%d %d %d,%d' % (row, row+1, row+2, row%2)
+                                    for row in range(rows)]
+                keys.append('chunk%d.csv' % chunk)
+                with open(os.path.join(root, keys[-1]), 'w') as chunk_file:
+                    chunk_file.write('\n'.join(lines))
+            data = Dataset()
+            data.read_data('file://'+root, keys)
+            assert_equal(data.train_size, 12)
+            batches = list(data.stream_batches('file://'+root, keys, batch_size=4))
+            assert_equal(len(batches), 3)
+        finally:
+            shutil.rmtree(root)
+
+    def test_bucketed_batches(self):
+        ''' Tests that bucketed batches cover every example once,
+        only hold examples of one bucket and drop the padding
+        that none of their examples needs'''
+        root = tempfile.mkdtemp()
+        try:
+            lines = ['x1,y'] + [' '.join(['7']*(row % 9+1))+',%d' % (row%2) for row in range(50)]
+            with open(os.path.join(root, 'chunk0.csv'), 'w') as chunk_file:
+                chunk_file.write('\n'.join(lines))
+            data = Dataset(bucket_width=3, seed=0)
+            data.read_data('file://'+root, ['chunk0.csv'])
+            data.trim = True
+            seen = []
+            for batch in data.batches(4):
+                lengths = np.count_nonzero(batch[0], axis=1)
+                assert_equal(len(set(lengths//3)), 1)
+                assert_equal(batch[0].shape[1], lengths.max())
+                assert_equal(len(batch[0]), len(batch[1]))
+                seen.extend(lengths.tolist())
+            assert_equal(sorted(seen), sorted(row % 9+1 for row in range(50)))
+            efficiency = data.give_padding_efficiency(4)
+            assert_true(efficiency['bucketed'] > efficiency['padded'])
+        finally:
+            shutil.rmtree(root)
+
+    def test_body_reader(self):
+        ''' Tests that a body is read in place like a file'''
+        body = bytearray(b'x1,y\n1 2,0\n3,1\n')
+        reader = BodyReader(body)
+        assert_equal(reader.readline(), b'x1,y\n')
+        assert_equal(reader.read(3), b'1 2')
+        assert_equal(reader.read(), b',0\n3,1\n')
+        assert_equal(reader.read(), b'')
+        reader.seek(0)
+        assert_equal(list(reader), [b'x1,y\n', b'1 2,0\n', b'3,1\n'])
+
+    def test_bucketed_post_padding(self):
+        ''' Tests that the tokens of sequences padded at
+        their end are kept when the padding is dropped'''
+        data = Dataset(bucket_width=2, padding='post', seed=0)
+        lengths = np.arange(20) % 6+1
+        data.inputs = [np.array([[7]*length+[0]*(8-length) for length in lengths])]
+        data.outputs = [np.arange(20).reshape(20, 1)]
+        data.train_size = 20
+        data.trim = True
+        for batch in data.batches(3):
+            assert_equal(batch[0].shape[1], np.count_nonzero(batch[0], axis=1).max())
+            assert_true((batch[0][:, 0] == 7).all())
+            assert_equal(np.count_nonzero(batch[0], axis=1).tolist(),
+                         lengths[batch[1][:, 0]].tolist())
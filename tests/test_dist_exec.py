@@ -17,6 +17,7 @@ from pathlib import Path
 
 from nose.tools import assert_equal
 from nose.tools import assert_not_equal
+from nose.tools import assert_true
 from nose.tools import assert_raises
 from nose.tools import raises
 import keras
@@ -25,7 +26,7 @@ from keras.layers import Dense, Embedding,LSTM, Input, Activation, multiply
 from keras.preprocessing import sequence
 sys.path.append('../src/')
 sys.path.append('.')
-from dist_exec import ExecutionEnvironment, Execution
+from dist_exec import ExecutionEnvironment, Execution, partition_chunks, WORKER_FILES
 
 
 class TestExecutionEnvironment(object):
@@ -111,12 +112,64 @@ class TestExecutionEnvironment(object):
         os.popen('rm -r runscripts')
         os.popen('rm run.sh')
 
-
-
-
-
-     
-
-    
-
-   
\ No newline at end of file
+    def test_partition_chunks(self):
+        ''' Tests that partition_chunks assigns every chunk exactly
+        once and balances the bytes across the workers'''
+        chunks = ['c%d' % i for i in range(7)]
+        sizes = [10, 70, 20, 30, 40, 50, 60]
+        partitions = partition_chunks(chunks, sizes, 3)
+        assert_equal(sorted(sum(partitions, [])), sorted(chunks))
+        size_of = dict(zip(chunks, sizes))
+        loads = [sum(size_of[chunk] for chunk in part) for part in partitions]
+        assert_equal(sorted(loads), [90, 90, 100])
+        #More workers than chunks leaves some workers without data
+        partitions = partition_chunks(chunks[:2], sizes[:2], 3)
+        assert_equal(sorted(len(part) for part in partitions), [0, 1, 1])
+
+    def test_multiple_parameter_servers(self):
+        ''' Tests that the number of parameter servers is read from
+        the third line of resources.txt and that every additional
+        parameter server gets its own run script'''
+        with open('resources.txt') as res_file:
+            resources = res_file.read()
+        try:
+            with open('resources.txt', 'w') as res_file:
+                res_file.write('sample_ps sample_ps2 samplew0 samplew1\npsip1 psip2 psip3 psip4\n2\n')
+            environ = ExecutionEnvironment(bucket_name='sample1', prefix='sample2/',
+                                           epochs=1, batch_size=32, opt='adam',
+                                           test=True)
+            assert_equal(environ.ps_ips, ['psip1', 'psip2'])
+            assert_equal(environ.worker_ips, ['psip3', 'psip4'])
+            environ.create_run_scripts()
+            with open('runscripts/psip2.sh') as run_script:
+                script = run_script.read()
+            assert_equal('--ps_hosts=psip1:2222,psip2:2222' in script, True)
+            assert_equal('-j_name ps -t_id 1' in script, True)
+        finally:
+            with open('resources.txt', 'w') as res_file:
+                res_file.write(resources)
+            os.popen('rm -r runscripts')
+            os.popen('rm run.sh')
+
+    @raises(ValueError)
+    def test_sync_backup_workers(self):
+        ''' Tests that sync mode rejects more backup workers
+        than the cluster can spare, resources.txt has 3 workers'''
+        ExecutionEnvironment(bucket_name='sample1', prefix='sample2/', epochs=1,
+                             batch_size=32, opt='adam', test=True, sync=True,
+                             backup_workers=3)
+
+    def test_worker_files(self):
+        ''' Tests that every module imported on the workers
+        from src is shipped to them'''
+        imported = set()
+        for module in ['trainer.py', 'agent.py', 'data_reader.py']:
+            with open(os.path.join('..', 'src', module)) as source:
+                for line in source:
+                    words = line.split()
+                    if len(words) > 1 and words[0] in ['import', 'from'] and \
+                       os.path.exists(os.path.join('..', 'src', words[1]+'.py')):
+                        imported.add(words[1]+'.py')
+        assert_equal(imported - set(WORKER_FILES), set())
+        for name in WORKER_FILES:
+            assert_true(os.path.exists(os.path.join('..', 'src', name)))
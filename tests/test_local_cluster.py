@@ -0,0 +1,61 @@
+# Copyright (c) 2019 American Express Travel Related Services Company, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except
+# in compliance with the License. You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License
+# is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+# or implied. See the License for the specific language governing permissions and limitations under
+# the License.
+
+''' This module tests the LocalCluster class within
+local_cluster.py with small commands standing in for
+the parameter server and worker tasks'''
+import os
+import sys
+import shutil
+import tempfile
+import time
+from nose.tools import assert_equal
+from nose.tools import assert_true
+sys.path.append('../src/')
+sys.path.append('.')
+from local_cluster import LocalCluster
+
+#Serves until it is stopped, like a parameter server
+PS_COMMAND = '%s -c "import time; time.sleep(600)"' % sys.executable
+#Reads the graph of its work directory and exits with its task index
+WORKER_COMMAND = '%s -c "import sys; print(open(\'Graph/Graph.meta\').read()); sys.exit(%d)"'
+
+
+class TestLocalCluster(object):
+
+    def test_run(self):
+        ''' Tests that every task runs in its own work directory
+        and that the parameter servers are stopped once all the
+        workers have finished'''
+        root = tempfile.mkdtemp()
+        try:
+            graph_dir = os.path.join(root, 'graph0')
+            os.makedirs(graph_dir)
+            with open(os.path.join(graph_dir, 'Graph.meta'), 'w') as meta:
+                meta.write('graph')
+            cluster = LocalCluster(2, ps_num=1, work_dir=os.path.join(root, 'cluster'))
+            ports = cluster.ps_ports+cluster.worker_ports+[cluster.coordinator_port]
+            assert_equal(len(set(ports)), 4)
+            assert_equal(cluster.give_worker_hosts()[1], 'localhost:%d' % cluster.worker_ports[1])
+            commands = {'ps_0': PS_COMMAND}
+            for worker in range(2):
+                commands['worker_%d' % worker] = WORKER_COMMAND % (sys.executable, worker)
+            cluster.prepare(graph_dir, commands)
+            start = time.time()
+            exit_codes = cluster.run(commands, os.path.join(root, 'exp0'))
+            assert_true(time.time()-start < 60)
+            assert_equal(exit_codes, {'worker_0': 0, 'worker_1': 1})
+            with open(os.path.join(root, 'exp0', 'worker_1.log')) as log:
+                assert_equal(log.read(), 'graph\n')
+            assert_true(os.path.isdir(os.path.join(root, 'cluster', 'worker_0', 'models')))
+        finally:
+            shutil.rmtree(root)
@@ -0,0 +1,72 @@
+# Copyright (c) 2019 American Express Travel Related Services Company, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except
+# in compliance with the License. You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License
+# is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+# or implied. See the License for the specific language governing permissions and limitations under
+# the License.
+
+''' This module tests the Prefetcher class
+within prefetch.py'''
+import sys
+import time
+from nose.tools import assert_equal
+from nose.tools import raises
+sys.path.append('../src/')
+sys.path.append('.')
+from prefetch import Prefetcher
+
+
+def slow_batches(count, delay):
+    ''' Helper generator producing a batch every delay seconds'''
+    for i in range(count):
+        time.sleep(delay)
+        yield [i]
+
+
+class TestPrefetcher(object):
+
+    def test_thread_order(self):
+        ''' Tests that a thread prefetcher yields all batches in order'''
+        assert_equal(list(Prefetcher(slow_batches(20, 0), depth=3)), [[i] for i in range(20)])
+
+    def test_process_order(self):
+        ''' Tests that a process prefetcher yields all batches in order'''
+        batches = Prefetcher(slow_batches(20, 0), depth=3, use_process=True)
+        assert_equal(list(batches), [[i] for i in range(20)])
+
+    def test_unknown_depth(self):
+        ''' Tests that a queue without qsize, like a process
+        queue on macOS, reports no depth and still yields all
+        batches'''
+        batches = Prefetcher(slow_batches(5, 0), depth=3, use_process=True)
+        def qsize():
+            raise NotImplementedError()
+        batches.queue.qsize = qsize
+        assert_equal(batches.give_depth(), None)
+        assert_equal(list(batches), [[i] for i in range(5)])
+
+    def test_input_bound_stats(self):
+        ''' Tests that a slow producer is reported as input bound
+        and a slow consumer as compute bound'''
+        batches = Prefetcher(slow_batches(5, 0.05), depth=2)
+        list(batches)
+        assert_equal(batches.give_stats()['bound'], 'input')
+
+        batches = Prefetcher(slow_batches(5, 0), depth=2)
+        for _ in batches:
+            time.sleep(0.05)
+        assert_equal(batches.give_stats()['bound'], 'compute')
+        assert_equal(batches.give_stats()['batches'], 5)
+
+    @raises(ValueError)
+    def test_producer_error(self):
+        ''' Tests that errors of the producer reach the consumer'''
+        def failing():
+            yield [0]
+            raise ValueError('bad chunk')
+        list(Prefetcher(failing()))
@@ -0,0 +1,76 @@
+# Copyright (c) 2019 American Express Travel Related Services Company, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except
+# in compliance with the License. You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License
+# is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+# or implied. See the License for the specific language governing permissions and limitations under
+# the License.
+
+''' This module tests the preprocessing helpers within
+preprocess_utils.py against a plain python reference'''
+import io
+import sys
+from nose.tools import assert_equal
+from nose.tools import assert_raises
+import numpy as np
+sys.path.append('../src/')
+sys.path.append('.')
+from preprocess_utils import parse_sequences, parse_labels, read_csv_objects
+
+ROWS = ['3 14 159', '', '2653 5 8 97 9 3', '0 42', '7']
+
+
+def pad(rows, maxlen, padding, truncating):
+    ''' Reference padding and truncation of keras'''
+    out = np.zeros((len(rows), maxlen), dtype=np.int32)
+    for i, row in enumerate(rows):
+        tokens = [int(token) for token in row.split()]
+        tokens = tokens[-maxlen:] if truncating == 'pre' else tokens[:maxlen]
+        if not tokens:
+            continue
+        if padding == 'pre':
+            out[i, maxlen-len(tokens):] = tokens
+        else:
+            out[i, :len(tokens)] = tokens
+    return out
+
+
+class TestPreprocessUtils(object):
+
+    def test_parse_sequences(self):
+        ''' Tests all the padding and truncating combinations'''
+        for padding in ['pre', 'post']:
+            for truncating in ['pre', 'post']:
+                parsed = parse_sequences(ROWS, 4, padding=padding, truncating=truncating)
+                assert_equal(parsed.dtype, np.int32)
+                assert_equal(parsed.tolist(), pad(ROWS, 4, padding, truncating).tolist())
+
+    def test_separators(self):
+        ''' Tests that only white space and the delimiter
+        separate tokens and that other characters are refused'''
+        assert_equal(parse_sequences(['1\t2  3\r'], 3).tolist(), [[1, 2, 3]])
+        assert_equal(parse_sequences(['1;2', '3'], 2, delimiter=';').tolist(), [[1, 2], [0, 3]])
+        assert_raises(ValueError, parse_sequences, ['3.0 4'], 2)
+        assert_raises(ValueError, parse_sequences, ['2 -1'], 2)
+        assert_raises(ValueError, parse_sequences, ['1;2'], 2)
+        assert_raises(ValueError, parse_sequences, ['1 2'], 2, delimiter='1')
+
+    def test_parse_bytes(self):
+        ''' Tests that the lines of a bytes object are rows'''
+        parsed = parse_sequences(('\n'.join(ROWS)+'\n').encode('utf8'), 3)
+        assert_equal(parsed.tolist(), pad(ROWS, 3, 'pre', 'pre').tolist())
+        assert_equal(parse_sequences([], 3).shape, (0, 3))
+
+    def test_labels_and_csv(self):
+        ''' Tests the label parsing and the single concatenation
+        of the csv objects'''
+        assert_equal(parse_labels(np.array(['1', '0', '1'], dtype=object)).tolist(), [1, 0, 1])
+        assert_equal(parse_labels([0.0, 1.0], np.uint8).dtype, np.uint8)
+        objects = [io.BytesIO(b'x1,y\n1 2,1\n'), io.BytesIO(b'x1,y\n3,0\n4 5 6,1\n')]
+        frame = read_csv_objects(objects)
+        assert_equal(frame.index.tolist(), [0, 1, 2])
+        assert_equal(parse_sequences(frame['x1'].values, 2).tolist(), [[1, 2], [0, 3], [5, 6]])
@@ -0,0 +1,53 @@
+# Copyright (c) 2019 American Express Travel Related Services Company, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except
+# in compliance with the License. You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License
+# is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+# or implied. See the License for the specific language governing permissions and limitations under
+# the License.
+
+''' This module tests the StepProfiler class
+within profiler.py'''
+import sys
+import os
+import json
+import time
+import tempfile
+from nose.tools import assert_equal
+from nose.tools import assert_true
+sys.path.append('../src/')
+sys.path.append('.')
+from profiler import StepProfiler
+
+
+class TestStepProfiler(object):
+
+    def test_sampled_jsonl(self):
+        ''' Tests that every sample_every step is appended to the
+        metrics file with its phase times and throughput'''
+        handle, path = tempfile.mkstemp(suffix='.jsonl')
+        os.close(handle)
+        try:
+            profiler = StepProfiler(path, batch_size=32, worker=1, sample_every=2)
+            for step, _ in enumerate(profiler.timed(range(5), 'fetch')):
+                with profiler.phase('run'):
+                    time.sleep(0.01)
+                profiler.end_step(step, loss=0.5, epoch=0)
+            profiler.close()
+            with open(path) as metrics_file:
+                samples = [json.loads(line) for line in metrics_file]
+        finally:
+            os.remove(path)
+        assert_equal([sample['local_step'] for sample in samples], [2, 4])
+        sample = samples[-1]
+        assert_equal(sample['worker'], 1)
+        assert_equal(sample['epoch'], 0)
+        assert_equal(sorted(sample['phases'].keys()), ['fetch', 'run'])
+        assert_true(sample['phases']['run'] >= 0.01)
+        assert_true(sample['step_time'] >= sample['phases']['run'])
+        assert_true(0 < sample['samples_per_sec'] <= 32/0.01)
+        assert_true(sample['step_time_p50'] <= sample['step_time_p99'])
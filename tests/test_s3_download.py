@@ -0,0 +1,141 @@
+# Copyright (c) 2019 American Express Travel Related Services Company, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except
+# in compliance with the License. You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License
+# is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+# or implied. See the License for the specific language governing permissions and limitations under
+# the License.
+
+''' This module tests the Downloader class within
+s3_download.py against a local S3 stand-in (moto)'''
+import sys
+import os
+import shutil
+import tempfile
+from nose.tools import assert_equal
+import boto3
+try:
+    from moto import mock_s3
+except ImportError:
+    from moto import mock_aws as mock_s3
+sys.path.append('../src/')
+sys.path.append('.')
+from s3_download import Downloader, BucketClient
+from data_cache import ChunkCache
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+BUCKET = 'easydist.test'
+
+
+class TestDownloader(object):
+
+    def put_objects(self, client, sizes):
+        ''' Helper function that uploads one object of
+        each given size and returns the keys and bodies'''
+        client.create_bucket(Bucket=BUCKET)
+        keys, bodies = [], []
+        for i, size in enumerate(sizes):
+            body = bytes(bytearray((i+j) % 251 for j in range(size)))
+            key = 'data/chunk%d' % i
+            client.put_object(Bucket=BUCKET, Key=key, Body=body)
+            keys.append(key)
+            bodies.append(body)
+        return keys, bodies
+
+    def test_give_ranges(self):
+        ''' Tests that the byte ranges cover the whole object'''
+        downloader = Downloader(client=object(), part_size=10)
+        assert_equal(downloader.give_ranges(25), [(0, 9), (10, 19), (20, 24)])
+        assert_equal(downloader.give_ranges(10), [(0, 9)])
+        assert_equal(downloader.give_ranges(0), [])
+
+    @mock_s3
+    def test_fetch(self):
+        ''' Tests that ranged concurrent downloads reassemble
+        every object in key order and report their throughput'''
+        client = boto3.client('s3')
+        keys, bodies = self.put_objects(client, [1000, 0, 37, 4096])
+        downloader = Downloader(client, max_in_flight=3, part_size=100)
+        fetched = downloader.fetch(BUCKET, keys)
+        assert_equal([bytes(body) for body in fetched], bodies)
+        assert_equal(sorted(downloader.stats.keys()), sorted(keys))
+        assert_equal(downloader.stats[keys[0]]['bytes'], 1000)
+
+    @mock_s3
+    def test_fetch_cached(self):
+        ''' Tests that cached objects are served from the local
+        cache and that changed objects are downloaded again'''
+        client = boto3.client('s3')
+        keys, bodies = self.put_objects(client, [300, 50])
+        cache_dir = tempfile.mkdtemp()
+        try:
+            downloader = Downloader(client, part_size=100, cache=ChunkCache(cache_dir))
+            downloader.fetch(BUCKET, keys)
+            client.put_object(Bucket=BUCKET, Key=keys[1], Body=b'changed')
+            fetched = downloader.fetch(BUCKET, keys)
+            assert_equal([bytes(body) for body in fetched], [bodies[0], b'changed'])
+            assert_equal(downloader.stats[keys[0]].get('cached'), True)
+            assert_equal(downloader.stats[keys[1]].get('cached'), None)
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_local_bucket(self):
+        ''' Tests that file:// buckets are read from a local
+        directory, in byte ranges and line by line'''
+        root = tempfile.mkdtemp()
+        try:
+            os.makedirs(os.path.join(root, 'data'))
+            bodies = []
+            for i, size in enumerate([250, 30]):
+                body = bytes(bytearray((i+j) % 251 for j in range(size)))
+                with open(os.path.join(root, 'data', 'chunk%d' % i), 'wb') as chunk:
+                    chunk.write(body)
+                bodies.append(body)
+            bucket = 'file://'+root
+            client = BucketClient()
+            objects = client.list_objects(Bucket=bucket, Prefix='data/')['Contents']
+            assert_equal([(obj['Key'], obj['Size']) for obj in objects],
+                         [('data/chunk0', 250), ('data/chunk1', 30)])
+            downloader = Downloader(client, part_size=100)
+            fetched = downloader.fetch(bucket, ['data/chunk0', 'data/chunk1'])
+            assert_equal([bytes(body) for body in fetched], bodies)
+            with open(os.path.join(root, 'lines.csv'), 'wb') as lines:
+                lines.write(b'x,y\n1,2\r\n3,4')
+            body = client.get_object(Bucket=bucket, Key='lines.csv')['Body']
+            assert_equal(list(body.iter_lines()), [b'x,y', b'1,2', b'3,4'])
+        finally:
+            shutil.rmtree(root)
+
+    def test_overwritten_during_fetch(self):
+        ''' Tests that an object overwritten between two of its
+        ranges is downloaded again instead of stitching the
+        ranges of both versions together'''
+        root = tempfile.mkdtemp()
+        try:
+            path = os.path.join(root, 'chunk0')
+            with open(path, 'wb') as chunk:
+                chunk.write(b'a'*250)
+            client = BucketClient()
+            get_object = client.get_object
+            requests = []
+            def overwriting_get_object(**kwargs):
+                ''' Overwrites the object after the first range'''
+                requests.append(kwargs['IfMatch'])
+                response = get_object(**kwargs)
+                if len(requests) == 1:
+                    with open(path, 'wb') as chunk:
+                        chunk.write(b'b'*300)
+                    os.utime(path, (1, 1))
+                return response
+            client.get_object = overwriting_get_object
+            downloader = Downloader(client, max_in_flight=1, part_size=100)
+            fetched = downloader.fetch('file://'+root, ['chunk0'])
+            assert_equal(bytes(fetched[0]), b'b'*300)
+            assert_equal(downloader.stats['chunk0']['changed'], True)
+            assert_equal(len(set(requests)), 2)
+        finally:
+            shutil.rmtree(root)
@@ -0,0 +1,123 @@
+# Copyright (c) 2019 American Express Travel Related Services Company, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except
+# in compliance with the License. You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License
+# is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+# or implied. See the License for the specific language governing permissions and limitations under
+# the License.
+
+''' This module tests the transfer engine within transfer.py
+using local directories as stand-ins for the remote hosts'''
+import os
+import sys
+import shutil
+import tempfile
+from nose.tools import assert_equal
+from nose.tools import assert_true
+sys.path.append('../src/')
+sys.path.append('.')
+from transfer import TransferEngine
+
+#Runs the remote command inside <root>/<host>, the host named
+#"flaky" fails its first attempt
+FAKE_SSH = '''import os, subprocess, sys
+root, host, command = sys.argv[1], sys.argv[-2], sys.argv[-1]
+home = os.path.join(root, host)
+if not os.path.isdir(home):
+    os.makedirs(home)
+marker = os.path.join(root, host+'.tried')
+if host == 'flaky' and not os.path.exists(marker):
+    open(marker, 'w').close()
+    sys.exit(255)
+sys.exit(subprocess.call(command, shell=True, cwd=home))
+'''
+
+
+def give_engine(root, retries=1):
+    ''' Returns an engine whose ssh runs commands locally'''
+    script = os.path.join(root, 'fake_ssh.py')
+    with open(script, 'w') as fake_ssh:
+        fake_ssh.write(FAKE_SSH)
+    return TransferEngine(user=None, ssh_command=[sys.executable, script, root],
+                          retries=retries, retry_delay=0,
+                          manifest_dir=os.path.join(root, 'manifests'))
+
+
+class TestTransferEngine(object):
+
+    def test_push(self):
+        ''' Tests that files and renamed files arrive on all hosts'''
+        root = tempfile.mkdtemp()
+        try:
+            source = os.path.join(root, 'source.py')
+            with open(source, 'w') as source_file:
+                source_file.write('print(1)\n')
+            hosts = ['host%d' % i for i in range(4)]
+            results = give_engine(root).push(hosts, [source, (source, 'Graph/copy.py')])
+            for host in hosts:
+                assert_true(results[host]['ok'])
+                assert_equal(results[host]['attempts'], 1)
+                with open(os.path.join(root, host, 'Graph', 'copy.py')) as copy:
+                    assert_equal(copy.read(), 'print(1)\n')
+                assert_true(os.path.exists(os.path.join(root, host, 'source.py')))
+        finally:
+            shutil.rmtree(root)
+
+    def test_retries(self):
+        ''' Tests that a failed host is retried and that a host
+        failing every attempt is reported'''
+        root = tempfile.mkdtemp()
+        try:
+            results = give_engine(root).run(['flaky', 'host0'], 'true')
+            assert_true(results['flaky']['ok'])
+            assert_equal(results['flaky']['attempts'], 2)
+            results = give_engine(root, retries=2).run(['host0'], 'exit 3')
+            assert_true(not results['host0']['ok'])
+            assert_equal(results['host0']['attempts'], 3)
+        finally:
+            shutil.rmtree(root)
+
+    def test_incremental(self):
+        ''' Tests that only changed files are sent again and
+        that force and per host files are honoured'''
+        root = tempfile.mkdtemp()
+        try:
+            graph = os.path.join(root, 'graph')
+            os.makedirs(graph)
+            for name in ['model.index', 'model.data']:
+                with open(os.path.join(graph, name), 'w') as graph_file:
+                    graph_file.write(name)
+            engine = give_engine(root)
+            hosts = ['host0', 'host1']
+            results = engine.push(hosts, [(graph, 'Graph')])
+            assert_equal([results[host]['files'] for host in hosts], [2, 2])
+            results = engine.push(hosts, [(graph, 'Graph')])
+            assert_equal([results[host]['attempts'] for host in hosts], [0, 0])
+            with open(os.path.join(graph, 'model.data'), 'w') as graph_file:
+                graph_file.write('new weights')
+            results = engine.push(hosts, [(graph, 'Graph')])
+            assert_equal([results[host]['files'] for host in hosts], [1, 1])
+            with open(os.path.join(root, 'host1', 'Graph', 'model.data')) as graph_file:
+                assert_equal(graph_file.read(), 'new weights')
+            #A file deleted on a host is sent again although the manifest lists it
+            os.remove(os.path.join(root, 'host1', 'Graph', 'model.index'))
+            results = engine.push(hosts, [(graph, 'Graph')])
+            assert_equal([results[host]['files'] for host in hosts], [0, 1])
+            assert_true(os.path.exists(os.path.join(root, 'host1', 'Graph', 'model.index')))
+            assert_equal(engine.push(hosts, [(graph, 'Graph')], force=True)['host0']['files'], 2)
+            scripts = {}
+            for host in hosts:
+                scripts[host] = os.path.join(root, host+'.sh')
+                with open(scripts[host], 'w') as script:
+                    script.write('echo '+host)
+            results = engine.push_each(dict((host, [(graph, 'Graph'), (scripts[host], 'run.sh')])
+                                            for host in hosts))
+            assert_equal([results[host]['files'] for host in hosts], [1, 1])
+            with open(os.path.join(root, 'host1', 'run.sh')) as script:
+                assert_equal(script.read(), 'echo host1')
+        finally:
+            shutil.rmtree(root)